@@ -14,6 +14,46 @@ def helpers():
         ).layout(("from_", "txs")),
     ]
 
+    transfer_leg_type: type = sp.record(
+        sender_=sp.address,
+        receiver_=sp.address,
+        amount_=sp.nat,
+    )
+
+    # Sums of the mark and index prices weighted by the seconds each price was
+    # current, up to timestamp
+    price_cumulative_type: type = sp.record(
+        mark=sp.int, index=sp.int, timestamp=sp.timestamp
+    )
+
+    # Price cumulative carried forward to now with the prices current since its
+    # timestamp
+    def accrue_prices(params):
+        sp.cast(
+            params,
+            sp.record(
+                cumulative=price_cumulative_type, mark_price=sp.int, index_price=sp.int
+            ),
+        )
+        elapsed = sp.now - params.cumulative.timestamp
+        return sp.record(
+            mark=params.cumulative.mark + params.mark_price * elapsed,
+            index=params.cumulative.index + params.index_price * elapsed,
+            timestamp=sp.now,
+        )
+
+    # Time-weighted average mark and index prices between two price cumulatives
+    def twap(params):
+        sp.cast(
+            params, sp.record(start=price_cumulative_type, end=price_cumulative_type)
+        )
+        elapsed = params.end.timestamp - params.start.timestamp
+        assert elapsed > 0, "InvalidTwapInterval"
+        return sp.record(
+            mark_price=(params.end.mark - params.start.mark) / elapsed,
+            index_price=(params.end.index - params.start.index) / elapsed,
+        )
+
     class Helpers(sp.Contract):
         def __init__(self, oracle_address, usd_contract_address):
             self.data.current_index_price = sp.cast(0, sp.int)
@@ -31,85 +71,106 @@ def helpers():
             )
             self.data.total_long = sp.cast(0, sp.int)
             self.data.total_short = sp.cast(0, sp.int)
+            # Block in which current_index_price was last read from the oracle
+            self.data.index_price_block = sp.cast(
+                None, sp.option[sp.record(level=sp.nat, timestamp=sp.timestamp)]
+            )
+            # Accrued before every change of the mark or index price
+            self.data.price_cumulative = sp.cast(
+                sp.record(mark=0, index=0, timestamp=sp.now), price_cumulative_type
+            )
 
         @sp.private(with_storage="read-write")
-        def updateIndexPrice(self):
-            oracle_data = sp.view(
-                "getlastCompletedData",
-                self.data.oracle_address,
-                (),
+        def accruePrices(self):
+            self.data.price_cumulative = accrue_prices(
                 sp.record(
-                    round=sp.nat,
-                    epoch=sp.nat,
-                    data=sp.nat,
-                    percentOracleResponse=sp.nat,
-                    decimals=sp.nat,
-                    lastUpdatedAt=sp.timestamp,
-                ).layout(
-                    (
-                        "round",
+                    cumulative=self.data.price_cumulative,
+                    mark_price=self.data.current_mark_price,
+                    index_price=self.data.current_index_price,
+                )
+            )
+
+        @sp.private(with_storage="read-write")
+        def updateIndexPrice(self):
+            # The oracle is only read once per block
+            block = sp.record(level=sp.level, timestamp=sp.now)
+            if self.data.index_price_block != sp.Some(block):
+                oracle_data = sp.view(
+                    "getlastCompletedData",
+                    self.data.oracle_address,
+                    (),
+                    sp.record(
+                        round=sp.nat,
+                        epoch=sp.nat,
+                        data=sp.nat,
+                        percentOracleResponse=sp.nat,
+                        decimals=sp.nat,
+                        lastUpdatedAt=sp.timestamp,
+                    ).layout(
                         (
-                            "epoch",
+                            "round",
                             (
-                                "data",
+                                "epoch",
                                 (
-                                    "percentOracleResponse",
-                                    ("decimals", "lastUpdatedAt"),
+                                    "data",
+                                    (
+                                        "percentOracleResponse",
+                                        ("decimals", "lastUpdatedAt"),
+                                    ),
                                 ),
                             ),
-                        ),
-                    )
-                ),
-            ).unwrap_some()
-            assert sp.now - oracle_data.lastUpdatedAt <= sp.int(
-                600
-            ), "Oracle Data Expired"
-
-            self.data.current_index_price = sp.to_int(oracle_data.data)
+                        )
+                    ),
+                ).unwrap_some()
+                assert sp.now - oracle_data.lastUpdatedAt <= sp.int(
+                    600
+                ), "Oracle Data Expired"
 
-        @sp.private(with_storage="read-write", with_operations=True)
-        def transferUsd(self, params):
-            sp.cast(
-                params,
-                sp.record(
-                    sender_=sp.address,
-                    receiver_=sp.address,
-                    amount_=sp.nat,
-                ),
-            )
-            contractParams = sp.contract(
-                transfer_params_type,
-                self.data.usd_contract_address,
-                "transfer",
-            ).unwrap_some()
-
-            dataToBeSent = sp.cast(
-                [
+                # Entrypoints moving the mark price read the index price first,
+                # so accruing here also keeps the mark cumulative current
+                self.data.price_cumulative = accrue_prices(
                     sp.record(
-                        from_=params.sender_,
-                        txs=[
-                            sp.record(
-                                to_=params.receiver_,
-                                amount=params.amount_,
-                                token_id=sp.nat(0),
-                            )
-                        ],
+                        cumulative=self.data.price_cumulative,
+                        mark_price=self.data.current_mark_price,
+                        index_price=self.data.current_index_price,
                     )
-                ],
-                transfer_params_type,
-            )
+                )
+                self.data.current_index_price = sp.to_int(oracle_data.data)
+                self.data.index_price_block = sp.Some(block)
 
-            sp.transfer(dataToBeSent, sp.mutez(0), contractParams)
+        # Sends every non-zero leg, in order, as a single FA2 transfer call
+        @sp.private(with_storage="read-write", with_operations=True)
+        def transferUsdBatch(self, legs):
+            sp.cast(legs, sp.list[transfer_leg_type])
+            dataToBeSent = sp.cast([], transfer_params_type)
+            for leg in legs:
+                if leg.amount_ > 0:
+                    dataToBeSent.push(
+                        sp.record(
+                            from_=leg.sender_,
+                            txs=[
+                                sp.record(
+                                    to_=leg.receiver_,
+                                    amount=leg.amount_,
+                                    token_id=sp.nat(0),
+                                )
+                            ],
+                        )
+                    )
+            if sp.len(dataToBeSent) > 0:
+                contractParams = sp.contract(
+                    transfer_params_type,
+                    self.data.usd_contract_address,
+                    "transfer",
+                ).unwrap_some()
+                sp.transfer(reversed(dataToBeSent), sp.mutez(0), contractParams)
 
         @sp.private(with_storage="read-write", with_operations=True)
-        def calculateFundingRate(self):
-            price_difference = (
-                self.data.current_mark_price - self.data.current_index_price
-            )
+        def calculateFundingRate(self, prices):
+            sp.cast(prices, sp.record(mark_price=sp.int, index_price=sp.int))
+            price_difference = prices.mark_price - prices.index_price
             funding_rate = price_difference / sp.int(24)
-            average_value = (
-                self.data.current_mark_price + self.data.current_index_price
-            ) / 2
+            average_value = (prices.mark_price + prices.index_price) / 2
             percentage = (funding_rate * self.data.decimal * 100) / average_value
             if percentage >= (5 * self.data.decimal):
                 percentage = 5 * self.data.decimal
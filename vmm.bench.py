@@ -0,0 +1,437 @@
+"""Gas and storage benchmarks of the VMM and VmmOrders entrypoints.
+
+For every size N the scenario opens like vmm.test.py (``vmm_scenario``),
+migrating N positions and N under-collateralized longs, populates N pending
+orders that expire before the entrypoints run, then calls each benchmarked
+entrypoint once and records:
+
+* ``parameter_bytes``: binary Micheline size of the call's parameter,
+* ``operation_bytes``: the same plus the parameters of the internal
+  transfers it emitted, with ``internal_operations`` the number of
+  transfers and events,
+* ``storage_bytes`` / ``storage_diff_bytes``: binary Micheline size of each
+  contract's storage (big_map contents included) after the call and its
+  change.
+
+The report is written as JSON, keyed by commit, so runs can be diffed:
+
+    python vmm.bench.py --sizes 10,100,1000,10000 --output vmm_bench.json
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import re
+import subprocess
+
+import smartpy as sp  # type: ignore
+from USDt import usdt
+from vmm_contract import vmm
+from vmm_orders import orders
+import utilities.Address as Address
+from utilities.FA2 import fa2
+from utilities.Helpers import helpers
+from Oracle import oracle
+from vmm_contract_types import vmm_types
+from vmm_scenario import originate
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+# Expiration of the populated orders, before the entrypoints run at 3700
+ORDER_EXPIRATION = 3600
+
+
+def zarith_size(value):
+    bits = abs(value).bit_length()
+    if bits <= 6:
+        return 1
+    return 1 + (bits - 6 + 6) // 7
+
+
+def micheline_size(node):
+    """Size of ``node`` (Micheline JSON) in the binary encoding."""
+    if isinstance(node, list):
+        return 5 + sum(micheline_size(n) for n in node)
+    if "int" in node:
+        return 1 + zarith_size(int(node["int"]))
+    if "string" in node:
+        return 5 + len(node["string"].encode())
+    if "bytes" in node:
+        return 5 + len(node["bytes"]) // 2
+    args = node.get("args", [])
+    annots = " ".join(node.get("annots", []))
+    size = 2 + sum(micheline_size(n) for n in args)
+    if len(args) > 2:
+        size += 4
+    if annots or len(args) > 2:
+        size += 4 + len(annots.encode())
+    return size
+
+
+def internal_operations(result):
+    """Transfers and events emitted by a call, recursively."""
+    messages, events = [], 0
+    for kind, sub in result.get("sub_results", []):
+        if kind == "Message_node":
+            messages.append(sub["message"])
+            sub_messages, sub_events = internal_operations(sub)
+            messages.extend(sub_messages)
+            events += sub_events
+        if kind == "Event":
+            events += 1
+    return messages, events
+
+
+def parameter_size(message):
+    return micheline_size(json.loads(message["arg_micheline"])) + len(
+        message["entrypoint"]
+    )
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Bench:
+    def __init__(self, sc, output_dir, contracts):
+        self.sc = sc
+        self.output_dir = pathlib.Path(output_dir)
+        self.contracts = contracts
+        self.storage = {name: self.storage_size(c) for name, c in contracts.items()}
+        self.results = []
+
+    def storage_size(self, contract):
+        self.sc.show(contract.data, compile=True)
+
+        def step(path):
+            return int(re.match(r"step_(\d+)_", path.name).group(1))
+
+        latest = max(self.output_dir.glob("step_*_expression.json"), key=step)
+        return micheline_size(json.loads(latest.read_text()))
+
+    def measure(self, n, contract_name, entrypoint, call):
+        call()
+        message = self.sc.entrypoint_calls[-1][1]
+        storage = {name: self.storage_size(c) for name, c in self.contracts.items()}
+        internal, events = internal_operations(message)
+        parameter_bytes = parameter_size(message["message"])
+        self.results.append(
+            {
+                "contract": contract_name,
+                "entrypoint": entrypoint,
+                "n": n,
+                "parameter_bytes": parameter_bytes,
+                "operation_bytes": parameter_bytes
+                + sum(parameter_size(m) for m in internal),
+                "internal_operations": len(internal) + events,
+                "storage_bytes": storage,
+                "storage_diff_bytes": {
+                    name: storage[name] - self.storage[name] for name in storage
+                },
+            }
+        )
+        self.storage = storage
+
+
+def create_order(
+    vmm_orders, vmm_contract, holder, order_type, trigger_price, expiration=0
+):
+    vmm_orders.createOrder(
+        sp.record(
+            position_holder=holder,
+            vmm_address=vmm_contract.address,
+            order_type=sp.int(order_type),
+            trigger_price=sp.int(trigger_price),
+            limit_price=sp.int(trigger_price),
+            amount_in=sp.int(10000000),
+            leverage_multiple=sp.int(2),
+            direction=sp.int(1),
+            stop_trigger_price=None,
+            stop_limit_price=None,
+            take_trigger_price=None,
+            take_limit_price=None,
+            expiration=sp.int(expiration),
+            order_status=sp.int(0),
+        ),
+        _sender=holder,
+    )
+
+
+def run(n):
+    name = "vmm_bench_%d" % n
+    sc = sp.test_scenario(
+        name, [vmm_types, sp.utils, oracle, fa2, usdt, helpers, vmm, orders]
+    )
+    output_dir = pathlib.Path(os.environ.get("SMARTPY_OUTPUT_DIR", ""), name)
+    sc.h1("VMM Benchmarks (N = %d)" % n)
+
+    holders = [sp.address("tz1ooHOLDER%d" % i) for i in range(n)]
+    underwater = [sp.address("tz1ooUNDERWATER%d" % i) for i in range(n)]
+    # Long and short positions of 10 USD at 2x, plus longs without collateral
+    migrated = [
+        sp.record(
+            position_holder=holder,
+            position=sp.int(1 + i % 2),
+            entry_price=sp.int(8000000),
+            funding_amount=sp.int(0),
+            position_value=sp.int(2500000),
+            collateral_amount=sp.int(10000000),
+            usd_amount=sp.int(20000000),
+        )
+        for i, holder in enumerate(holders)
+    ] + [
+        sp.record(
+            position_holder=holder,
+            position=sp.int(1),
+            entry_price=sp.int(8000000),
+            funding_amount=sp.int(0),
+            position_value=sp.int(2500000),
+            collateral_amount=sp.int(0),
+            usd_amount=sp.int(20000000),
+        )
+        for holder in [Address.bob] + underwater
+    ]
+    usdt_token, oracle_contract, vmm_contract, vmm_orders = originate(
+        sc, positions=migrated, token_amount=12500000000000
+    )
+    # Liquidity for the payouts of the migrated positions
+    usdt_token.mint(
+        sp.record(
+            amount=sp.nat(1000000000000),
+            to_=vmm_contract.address,
+            token=sp.variant("existing", sp.nat(0)),
+        ),
+        _sender=Address.admin,
+    )
+
+    sc.h2("Populate %d Orders" % n)
+    # Pending long limit orders below the mark price, never triggered and
+    # expired once the entrypoints run
+    for i, holder in enumerate(holders):
+        create_order(vmm_orders, vmm_contract, holder, 1, 7000000 - i, ORDER_EXPIRATION)
+
+    bench = Bench(sc, output_dir, {"VMM": vmm_contract, "VmmOrders": vmm_orders})
+
+    sc.h2("VMM Entrypoints")
+    bench.measure(
+        n,
+        "VMM",
+        "deposit",
+        lambda: vmm_contract.deposit(10000000000, _sender=Address.alice),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "increasePosition",
+        lambda: vmm_contract.increasePosition(
+            position_holder=Address.alice,
+            direction=sp.int(1),
+            usd_amount=sp.int(1000000000),
+            leverage_multiple=sp.int(2),
+            _sender=Address.alice,
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "increasePositions",
+        lambda: vmm_contract.increasePositions(
+            fills=[
+                sp.record(
+                    position_holder=Address.alice,
+                    direction=sp.int(1),
+                    usd_amount=sp.int(1000000),
+                    leverage_multiple=sp.int(2),
+                )
+                for i in range(n)
+            ],
+            match_at_mark=False,
+            _sender=Address.alice,
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "addMargin",
+        lambda: vmm_contract.addMargin(
+            position_holder=Address.alice, amount=100000000, _sender=Address.alice
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "removeMargin",
+        lambda: vmm_contract.removeMargin(
+            position_holder=Address.alice, amount=10000000, _sender=Address.alice
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "multicall",
+        lambda: vmm_contract.multicall(
+            [
+                sp.variant(
+                    "addMargin",
+                    sp.record(position_holder=Address.alice, amount=sp.int(1000000)),
+                )
+                for i in range(n)
+            ],
+            _sender=Address.alice,
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "decreasePosition",
+        lambda: vmm_contract.decreasePosition(
+            position_holder=Address.alice,
+            usd_amount=100000000,
+            leverage_multiple=2,
+            _sender=Address.alice,
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "liquidate",
+        lambda: vmm_contract.liquidate(Address.bob, _sender=Address.alice),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "liquidateBatch",
+        lambda: vmm_contract.liquidateBatch(underwater, _sender=Address.alice),
+    )
+    sc.verify(~vmm_contract.data.positions.contains(underwater[-1]))
+    oracle_contract.updatePrice(8000000, _now=sp.timestamp(3690))
+    bench.measure(
+        n,
+        "VMM",
+        "distributeFunding",
+        lambda: vmm_contract.distributeFunding(
+            _sender=Address.admin, _now=sp.timestamp(3700)
+        ),
+    )
+    vmm_contract.updateConditionalOrders(True, _sender=Address.admin)
+    # A long limit order above the mark price, executed by the VMM itself
+    bench.measure(
+        n,
+        "VMM",
+        "placeConditionalOrder",
+        lambda: vmm_contract.placeConditionalOrder(
+            position_holder=Address.alice,
+            kind=0,
+            direction=1,
+            trigger_price=9000000,
+            usd_amount=1000000,
+            leverage_multiple=2,
+            expiration=0,
+            _sender=Address.alice,
+            _now=sp.timestamp(3700),
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "triggerConditionalOrders",
+        lambda: vmm_contract.triggerConditionalOrders(
+            [0], _sender=Address.elon, _now=sp.timestamp(3700)
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "closePosition",
+        lambda: vmm_contract.closePosition(
+            Address.alice, _sender=Address.alice, _now=sp.timestamp(3700)
+        ),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "withdraw",
+        lambda: vmm_contract.withdraw(1000000000, _sender=Address.alice),
+    )
+    bench.measure(
+        n,
+        "VMM",
+        "sweepFees",
+        lambda: vmm_contract.sweepFees(_sender=Address.elon),
+    )
+
+    sc.h2("VmmOrders Entrypoints")
+    # Long limit orders above the mark price, executable right away
+    bench.measure(
+        n,
+        "VmmOrders",
+        "createOrder",
+        lambda: create_order(vmm_orders, vmm_contract, Address.alice, 1, 9000000),
+    )
+    create_order(vmm_orders, vmm_contract, Address.alice, 1, 9000000)
+    bench.measure(
+        n,
+        "VmmOrders",
+        "executeLimitOrder",
+        lambda: vmm_orders.executeLimitOrder(n, _now=sp.timestamp(3700)),
+    )
+    bench.measure(
+        n,
+        "VmmOrders",
+        "executeLimitOrders",
+        lambda: vmm_orders.executeLimitOrders(
+            vmm_address=vmm_contract.address,
+            order_ids=[n + 1],
+            _now=sp.timestamp(3700),
+        ),
+    )
+    bench.measure(
+        n,
+        "VmmOrders",
+        "cancelOrder",
+        lambda: vmm_orders.cancelOrder(0, _sender=holders[0]),
+    )
+    bench.measure(
+        n,
+        "VmmOrders",
+        "pruneOrders",
+        lambda: vmm_orders.pruneOrders(list(range(n + 2)), _now=sp.timestamp(3700)),
+    )
+    sc.verify(~vmm_orders.data.orders.contains(n - 1))
+    vmm_orders.updateBatchAuction(True, _sender=Address.admin)
+    vmm_orders.updateMaxBatchSize(n, _sender=Address.admin)
+    for i in range(n):
+        create_order(vmm_orders, vmm_contract, Address.alice, 0, 0)
+    bench.measure(
+        n,
+        "VmmOrders",
+        "settleBatch",
+        lambda: vmm_orders.settleBatch(vmm_contract.address, _now=sp.timestamp(3700)),
+    )
+    return bench.results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(n) for n in DEFAULT_SIZES),
+        help="comma separated numbers of positions and orders",
+    )
+    parser.add_argument("--output", default="vmm_bench.json")
+    args = parser.parse_args()
+
+    report = {"commit": current_commit(), "results": []}
+
+    @sp.add_test()
+    def test():
+        for n in [int(n) for n in args.sizes.split(",")]:
+            report["results"].extend(run(n))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
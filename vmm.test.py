@@ -7,6 +7,7 @@ from utilities.FA2 import fa2
 from utilities.Helpers import helpers
 from Oracle import oracle
 from vmm_contract_types import vmm_types
+from vmm_scenario import originate
 
 
 if __name__ == "__main__":
@@ -18,107 +19,29 @@ if __name__ == "__main__":
         )
         sc.h1("VMM Contract")
 
-        sc.h2("Originate USDt Contract")
-        usdt_token = usdt.USDt(
-            administrator=Address.admin,
-            metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
-        )
-        sc += usdt_token
-
-        sc.h2("Originate Oracle Contract")
-        oracle_contract = oracle.Oracle()
-        sc += oracle_contract
-        oracle_contract.updatePrice(8000000, _now=sp.timestamp(12))
-
-        sc.h2("Originate VMM Contract")
-        vmm_contract = vmm.VMM(
-            metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
-            administrator=Address.alice,
-            usd_contract_address=usdt_token.address,
-            oracle_address=oracle_contract.address,
-            fund_manager=Address.elon,
-        )
-        sc += vmm_contract
+        usdt_token, oracle_contract, vmm_contract, vmm_orders = originate(sc)
 
-        sc.h2("Originate Orders Contract")
-        vmm_orders = orders.VmmOrders(
-            metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
-            administrator=Address.admin,
-            fund_manager=Address.elon,
-        )
-        sc += vmm_orders
-
-        sc.h2("Testing Propose Admin")
-        vmm_contract.proposeAdmin(Address.admin, _sender=Address.alice)
-        vmm_contract.updateAdmin(_sender=Address.bob, _valid=False)
-        vmm_contract.updateAdmin(_sender=Address.admin)
-
-        sc.h2("Testing Set VMM")
-        vmm_contract.setVmm(12500000000, _sender=Address.admin)
-
-        sc.h2("Testing Set Position Manager")
-        vmm_contract.addPositionManager(vmm_orders.address, _sender=Address.admin)
+        # oracle_contract.updatePrice(1000000).run(now=sp.timestamp(12))
 
-        usdt_token.mint(
-            sp.record(
-                amount=sp.nat(1000000000000),
-                to_=Address.admin,
-                token=sp.variant("new", {"0": sp.bytes("0x746f6b656e30")}),
-            ),
-            _sender=Address.admin,
-        )
-        usdt_token.mint(
-            sp.record(
-                amount=sp.nat(1000000000000),
-                to_=Address.alice,
-                token=sp.variant("existing", sp.nat(0)),
-            ),
-            _sender=Address.admin,
-        )
-        usdt_token.mint(
-            sp.record(
-                amount=sp.nat(1000000000000),
-                to_=Address.bob,
-                token=sp.variant("existing", sp.nat(0)),
-            ),
-            _sender=Address.admin,
+        sc.h2("Testing Deposit and Withdraw")
+        vmm_contract.deposit(10000000000, _sender=Address.alice)
+        bob_tokens = sc.compute(usdt_token.data.ledger[(Address.bob, 0)])
+        vmm_tokens = sc.compute(usdt_token.data.ledger[(vmm_contract.address, 0)])
+        vmm_contract.deposit(10000000000, _sender=Address.bob)
+        vmm_contract.deposit(0, _sender=Address.bob, _valid=False)
+        vmm_contract.withdraw(1000000000, _sender=Address.bob)
+        # Each call moved its one leg through the batched FA2 transfer
+        sc.verify(usdt_token.data.ledger[(Address.bob, 0)] + 9000000000 == bob_tokens)
+        sc.verify(
+            usdt_token.data.ledger[(vmm_contract.address, 0)] == vmm_tokens + 9000000000
         )
-
-        usdt_token.update_operators(
-            [
-                sp.variant(
-                    "add_operator",
-                    sp.record(
-                        owner=Address.alice, operator=vmm_contract.address, token_id=0
-                    ),
-                )
-            ],
-            _sender=Address.alice,
-        )
-        usdt_token.update_operators(
-            [
-                sp.variant(
-                    "add_operator",
-                    sp.record(
-                        owner=Address.bob, operator=vmm_contract.address, token_id=0
-                    ),
-                )
-            ],
+        vmm_contract.withdraw(
+            10000000000,
             _sender=Address.bob,
+            _valid=False,
+            _exception="INSUFFICIENT_BALANCE",
         )
-        usdt_token.update_operators(
-            [
-                sp.variant(
-                    "add_operator",
-                    sp.record(
-                        owner=Address.admin, operator=vmm_contract.address, token_id=0
-                    ),
-                )
-            ],
-            _sender=Address.admin,
-        )
-
-        # oracle_contract.updatePrice(1000000).run(now=sp.timestamp(12))
+        sc.verify(vmm_contract.getBalance(Address.bob) == 9000000000)
 
         sc.h2("Testing Increase Position")
         vmm_contract.increasePosition(
@@ -141,11 +64,19 @@ if __name__ == "__main__":
             _sender=Address.bob,
             _valid=False,
         )
+        sc.verify(vmm_contract.data.index_price_block.is_some())
+        sc.verify(
+            ~vmm_contract.getPositionHealth([Address.alice, Address.bob])[
+                Address.alice
+            ].liquidatable
+        )
+        sc.verify(~vmm_contract.getPositionHealth([Address.bob]).contains(Address.bob))
 
         oracle_contract.updatePrice(8000000, _now=sp.timestamp(3618))
 
         sc.h2("Testing Distribute Funding")
         vmm_contract.distributeFunding(_sender=Address.alice, _now=sp.timestamp(3620))
+        sc.verify(vmm_contract.getPositionData(Address.alice).funding_amount < 0)
 
         sc.h2("Testing Close Position")
         vmm_contract.closePosition(Address.alice, _sender=Address.alice)
@@ -175,6 +106,7 @@ if __name__ == "__main__":
             ),
             _sender=Address.alice,
         )
+        sc.verify(vmm_orders.getHolderOrders(Address.alice).contains(0))
 
         sc.show(vmm_contract.data)
         sc.show(usdt_token.data.ledger)
@@ -183,6 +115,820 @@ if __name__ == "__main__":
         sc.h2("Testing Close Order")
         vmm_orders.executeCloseOrder(0, _sender=Address.alice)
         vmm_orders.executeCloseOrder(0, _sender=Address.alice, _valid=False)
+        sc.verify(sp.len(vmm_orders.getHolderOrders(Address.alice)) == 0)
 
         sc.show(vmm_contract.data)
         sc.show(usdt_token.data.ledger)
+
+        sc.h2("Testing Batched Order Execution")
+        vmm_orders.createOrder(
+            sp.record(
+                position_holder=Address.alice,
+                vmm_address=vmm_contract.address,
+                order_type=sp.int(1),
+                trigger_price=sp.int(9000000),
+                limit_price=sp.int(9000000),
+                amount_in=sp.int(2000000000),
+                leverage_multiple=sp.int(2),
+                direction=sp.int(1),
+                stop_trigger_price=sp.Some(sp.int(9000000)),
+                stop_limit_price=sp.Some(sp.int(9000000)),
+                take_trigger_price=None,
+                take_limit_price=None,
+                expiration=sp.int(0),
+                order_status=sp.int(0),
+            ),
+            _sender=Address.alice,
+        )
+        sc.verify(
+            sp.len(
+                vmm_orders.getTriggeredOrders(
+                    sp.record(
+                        vmm_address=vmm_contract.address,
+                        mark_price=8000000,
+                        max_buckets=10,
+                        resume={},
+                    )
+                ).limit_orders
+            )
+            == 1
+        )
+        vmm_orders.executeLimitOrders(
+            vmm_address=vmm_contract.address, order_ids=[1, 7], _sender=Address.bob
+        )
+        sc.verify(
+            sp.len(
+                vmm_orders.getTriggeredOrders(
+                    sp.record(
+                        vmm_address=vmm_contract.address,
+                        mark_price=8000000,
+                        max_buckets=10,
+                        resume={},
+                    )
+                ).stop_loss_orders
+            )
+            == 1
+        )
+        sc.verify(vmm_orders.getOrder(1).order_status == 1)
+        sc.verify(vmm_orders.getOrder(1).vmm_address == vmm_contract.address)
+        sc.verify(vmm_orders.getOrder(1).direction == 1)
+        sc.verify(vmm_orders.getOrder(1).stop_trigger_price == sp.Some(9000000))
+        sc.verify(vmm_orders.getOrder(1).take_trigger_price == None)
+        sc.verify(vmm_orders.getHolderOrders(Address.alice)[1].order_status == 1)
+        vmm_orders.triggerStopLosses(
+            vmm_address=vmm_contract.address, order_ids=[0, 1], _sender=Address.bob
+        )
+        sc.verify(vmm_orders.getOrder(1).order_status == 2)
+        sc.verify(~vmm_orders.data.holder_orders.contains(Address.alice))
+        sc.verify(
+            sp.len(
+                vmm_orders.getTriggeredOrders(
+                    sp.record(
+                        vmm_address=vmm_contract.address,
+                        mark_price=8000000,
+                        max_buckets=10,
+                        resume={},
+                    )
+                ).stop_loss_orders
+            )
+            == 0
+        )
+
+        sc.h2("Testing Order Expiration and Pruning")
+        vmm_orders.createOrder(
+            sp.record(
+                position_holder=Address.alice,
+                vmm_address=vmm_contract.address,
+                order_type=sp.int(1),
+                trigger_price=sp.int(9000000),
+                limit_price=sp.int(9000000),
+                amount_in=sp.int(2000000000),
+                leverage_multiple=sp.int(2),
+                direction=sp.int(1),
+                stop_trigger_price=None,
+                stop_limit_price=None,
+                take_trigger_price=None,
+                take_limit_price=None,
+                expiration=sp.int(100),
+                order_status=sp.int(0),
+            ),
+            _sender=Address.alice,
+            _now=sp.timestamp(50),
+        )
+        vmm_orders.pruneOrders([2], _sender=Address.bob, _now=sp.timestamp(50))
+        sc.verify(vmm_orders.data.orders.contains(2))
+        sc.verify(vmm_orders.getHolderOrders(Address.alice).contains(2))
+        vmm_orders.executeLimitOrder(
+            2,
+            _sender=Address.bob,
+            _now=sp.timestamp(200),
+            _valid=False,
+            _exception="OrderExpired",
+        )
+        vmm_orders.executeLimitOrders(
+            vmm_address=vmm_contract.address,
+            order_ids=[2],
+            _sender=Address.bob,
+            _now=sp.timestamp(200),
+        )
+        sc.verify(vmm_orders.getOrder(2).order_status == 0)
+        vmm_orders.pruneOrders(
+            [0, 1, 2, 7], _sender=Address.bob, _now=sp.timestamp(200)
+        )
+        sc.verify(~vmm_orders.data.orders.contains(0))
+        sc.verify(~vmm_orders.data.orders.contains(1))
+        sc.verify(~vmm_orders.data.orders.contains(2))
+        sc.verify(sp.len(vmm_orders.getHolderOrders(Address.alice)) == 0)
+
+        sc.h2("Testing Batch Auction")
+        vmm_orders.updateBatchAuction(True, _sender=Address.alice, _valid=False)
+        vmm_orders.updateBatchAuction(True, _sender=Address.admin)
+        for holder, direction, amount_in, leverage_multiple in [
+            (Address.alice, 1, 1000000000, 2),
+            (Address.bob, 2, 500000000, 3),
+            (Address.bob, 1, 100000000, 2),
+        ]:
+            vmm_orders.createOrder(
+                sp.record(
+                    position_holder=holder,
+                    vmm_address=vmm_contract.address,
+                    order_type=sp.int(0),
+                    trigger_price=sp.int(0),
+                    limit_price=sp.int(0),
+                    amount_in=sp.int(amount_in),
+                    leverage_multiple=sp.int(leverage_multiple),
+                    direction=sp.int(direction),
+                    stop_trigger_price=None,
+                    stop_limit_price=None,
+                    take_trigger_price=None,
+                    take_limit_price=None,
+                    expiration=sp.int(0),
+                    order_status=sp.int(0),
+                ),
+                _sender=holder,
+            )
+        sc.verify(vmm_orders.getOrder(3).order_status == 0)
+        sc.verify(
+            ~vmm_contract.getPositionsData([Address.alice])[Address.alice].is_some()
+        )
+        vmm_orders.settleBatch(vmm_contract.address, _sender=Address.elon)
+        sc.verify(vmm_orders.getOrder(3).order_status == 1)
+        sc.verify(vmm_orders.getOrder(4).order_status == 1)
+        sc.verify(vmm_orders.getOrder(5).order_status == 2)
+        sc.verify(~vmm_orders.getHolderOrders(Address.bob).contains(5))
+        sc.verify(vmm_contract.getPositionData(Address.alice).position == 1)
+        sc.verify(vmm_contract.getPositionData(Address.bob).position == 2)
+        sc.verify(
+            vmm_contract.getPositionData(Address.alice).entry_price
+            == vmm_contract.getPositionData(Address.bob).entry_price
+        )
+        vmm_orders.settleBatch(
+            vmm_contract.address,
+            _sender=Address.elon,
+            _valid=False,
+            _exception="EmptyBatch",
+        )
+        vmm_orders.updateBatchAuction(False, _sender=Address.admin)
+
+        sc.h2("Testing Netting of Opposing Limit Orders")
+        mark_price = sc.compute(vmm_contract.getIndexAndMarkPrice().mark_price)
+        bob_entry = sc.compute(vmm_contract.getPositionData(Address.bob).entry_price)
+        # admin has no balance and bob already holds a short position, so the
+        # last two orders are skipped
+        for holder, direction, amount_in, trigger_price in [
+            (Address.alice, 1, 500000000, 9000000),
+            (Address.bob, 2, 300000000, 7000000),
+            (Address.admin, 1, 500000000, 9000000),
+            (Address.bob, 1, 100000000, 9000000),
+        ]:
+            vmm_orders.createOrder(
+                sp.record(
+                    position_holder=holder,
+                    vmm_address=vmm_contract.address,
+                    order_type=sp.int(1),
+                    trigger_price=sp.int(trigger_price),
+                    limit_price=sp.int(trigger_price),
+                    amount_in=sp.int(amount_in),
+                    leverage_multiple=sp.int(2),
+                    direction=sp.int(direction),
+                    stop_trigger_price=None,
+                    stop_limit_price=None,
+                    take_trigger_price=None,
+                    take_limit_price=None,
+                    expiration=sp.int(0),
+                    order_status=sp.int(0),
+                ),
+                _sender=holder,
+            )
+        vmm_orders.executeLimitOrders(
+            vmm_address=vmm_contract.address,
+            order_ids=[6, 7, 8, 9],
+            _sender=Address.elon,
+        )
+        sc.verify(vmm_orders.getOrder(6).order_status == 1)
+        sc.verify(vmm_orders.getOrder(7).order_status == 1)
+        sc.verify(vmm_orders.getOrder(8).order_status == 0)
+        sc.verify(vmm_orders.getOrder(9).order_status == 0)
+        # The short is matched at the mark price, only the long residual moves
+        # the reserves and blends its price into the long's entry
+        new_bob_entry = vmm_contract.getPositionData(Address.bob).entry_price
+        sc.verify(2 * new_bob_entry <= bob_entry + mark_price)
+        sc.verify(bob_entry + mark_price <= 2 * new_bob_entry + 1)
+        sc.verify(
+            vmm_contract.getPositionData(Address.alice).entry_price > new_bob_entry
+        )
+        sc.verify(vmm_contract.getIndexAndMarkPrice().mark_price > mark_price)
+        vmm_orders.cancelOrder(8, _sender=Address.admin)
+        vmm_orders.cancelOrder(9, _sender=Address.bob)
+
+        sc.h2("Testing Multicall")
+        vmm_contract.deposit(1000000000, _sender=Address.admin)
+        vmm_contract.multicall(
+            [
+                sp.variant(
+                    "increasePosition",
+                    sp.record(
+                        position_holder=Address.admin,
+                        direction=sp.int(1),
+                        usd_amount=sp.int(500000000),
+                        leverage_multiple=sp.int(2),
+                    ),
+                ),
+                sp.variant(
+                    "addMargin",
+                    sp.record(position_holder=Address.admin, amount=sp.int(100000000)),
+                ),
+                sp.variant(
+                    "decreasePosition",
+                    sp.record(
+                        position_holder=Address.admin,
+                        usd_amount=sp.int(100000000),
+                        leverage_multiple=sp.int(2),
+                    ),
+                ),
+            ],
+            _sender=Address.alice,
+        )
+        sc.verify(vmm_contract.getPositionData(Address.admin).position == 1)
+        # A failing action reverts the actions before it
+        balance = sc.compute(vmm_contract.getBalance(Address.admin))
+        vmm_contract.multicall(
+            [
+                sp.variant(
+                    "addMargin",
+                    sp.record(position_holder=Address.admin, amount=sp.int(100000000)),
+                ),
+                sp.variant(
+                    "removeMargin",
+                    sp.record(
+                        position_holder=Address.admin, amount=sp.int(100000000000)
+                    ),
+                ),
+            ],
+            _sender=Address.alice,
+            _valid=False,
+            _exception="INVALID_MARGIN",
+        )
+        sc.verify(vmm_contract.getBalance(Address.admin) == balance)
+        vmm_contract.multicall(
+            [sp.variant("closePosition", Address.admin)],
+            _sender=Address.elon,
+            _valid=False,
+            _exception="NotPositionManager",
+        )
+        vmm_contract.multicall(
+            [sp.variant("closePosition", Address.admin)], _sender=Address.alice
+        )
+        sc.verify(vmm_contract.getBalance(Address.admin) > balance)
+
+        sc.h2("Testing Conditional Orders")
+        vmm_contract.placeConditionalOrder(
+            position_holder=Address.admin,
+            kind=0,
+            direction=1,
+            trigger_price=1,
+            usd_amount=100000000,
+            leverage_multiple=2,
+            expiration=0,
+            _sender=Address.alice,
+            _valid=False,
+            _exception="ConditionalOrdersDisabled",
+        )
+        vmm_contract.updateConditionalOrders(True, _sender=Address.alice, _valid=False)
+        vmm_contract.updateConditionalOrders(True, _sender=Address.admin)
+        mark_price = sc.compute(vmm_contract.getIndexAndMarkPrice().mark_price)
+        balance = sc.compute(vmm_contract.getBalance(Address.admin))
+        # Holders place their orders through a position manager
+        vmm_contract.placeConditionalOrder(
+            position_holder=Address.admin,
+            kind=0,
+            direction=1,
+            trigger_price=mark_price * 2,
+            usd_amount=100000000,
+            leverage_multiple=2,
+            expiration=0,
+            _sender=Address.admin,
+            _valid=False,
+            _exception="NotPositionManager",
+        )
+        for holder, kind, direction, trigger_price in [
+            (Address.admin, 0, 1, mark_price * 2),
+            (Address.bob, 1, 2, mark_price),
+            (Address.alice, 2, 1, mark_price * 2),
+        ]:
+            vmm_contract.placeConditionalOrder(
+                position_holder=holder,
+                kind=kind,
+                direction=direction,
+                trigger_price=trigger_price,
+                usd_amount=100000000,
+                leverage_multiple=2,
+                expiration=0,
+                _sender=Address.alice,
+            )
+        vmm_contract.placeConditionalOrder(
+            position_holder=Address.elon,
+            kind=1,
+            direction=1,
+            trigger_price=mark_price,
+            usd_amount=0,
+            leverage_multiple=0,
+            expiration=0,
+            _sender=Address.alice,
+            _valid=False,
+            _exception="InvalidPosition",
+        )
+        # The limit order escrows its amount
+        sc.verify(vmm_contract.getBalance(Address.admin) + 100000000 == balance)
+        vmm_contract.triggerConditionalOrders([0, 1, 2, 9], _sender=Address.elon)
+        sc.verify(vmm_contract.getPositionData(Address.admin).position == 1)
+        sc.verify(~vmm_contract.getPositionHealth([Address.bob]).contains(Address.bob))
+        sc.verify(~vmm_contract.data.conditional_orders.contains(0))
+        sc.verify(~vmm_contract.data.conditional_orders.contains(1))
+        sc.verify(vmm_contract.data.conditional_order_counts[Address.bob] == 0)
+        sc.verify(vmm_contract.getConditionalOrder(2).trigger_price == mark_price * 2)
+        vmm_contract.cancelConditionalOrder(
+            position_holder=Address.bob,
+            order_id=2,
+            _sender=Address.alice,
+            _valid=False,
+            _exception="InvalidPositionHolder",
+        )
+        vmm_contract.cancelConditionalOrder(
+            position_holder=Address.alice,
+            order_id=2,
+            _sender=Address.bob,
+            _valid=False,
+            _exception="NotPositionManager",
+        )
+        vmm_contract.cancelConditionalOrder(
+            position_holder=Address.alice, order_id=2, _sender=Address.alice
+        )
+        sc.verify(vmm_contract.data.conditional_order_counts[Address.alice] == 0)
+        # An expired limit order is dropped and its escrow refunded
+        balance = sc.compute(vmm_contract.getBalance(Address.admin))
+        vmm_contract.placeConditionalOrder(
+            position_holder=Address.admin,
+            kind=0,
+            direction=1,
+            trigger_price=1,
+            usd_amount=100000000,
+            leverage_multiple=2,
+            expiration=4000,
+            _sender=Address.alice,
+            _now=sp.timestamp(3700),
+        )
+        vmm_contract.triggerConditionalOrders(
+            [3], _sender=Address.elon, _now=sp.timestamp(3800)
+        )
+        sc.verify(vmm_contract.data.conditional_orders.contains(3))
+        vmm_contract.triggerConditionalOrders(
+            [3], _sender=Address.elon, _now=sp.timestamp(4100)
+        )
+        sc.verify(~vmm_contract.data.conditional_orders.contains(3))
+        sc.verify(vmm_contract.getBalance(Address.admin) == balance)
+        # A stop-loss left over from a closed position does not close the next
+        # position in the same direction
+        vmm_contract.increasePosition(
+            sp.record(
+                position_holder=Address.bob,
+                direction=sp.int(1),
+                usd_amount=sp.int(100000000),
+                leverage_multiple=sp.int(2),
+            ),
+            _sender=Address.alice,
+            _now=sp.timestamp(4100),
+        )
+        mark_price = sc.compute(vmm_contract.getIndexAndMarkPrice().mark_price)
+        vmm_contract.placeConditionalOrder(
+            position_holder=Address.bob,
+            kind=1,
+            direction=1,
+            trigger_price=mark_price * 2,
+            usd_amount=0,
+            leverage_multiple=0,
+            expiration=0,
+            _sender=Address.alice,
+            _now=sp.timestamp(4100),
+        )
+        vmm_contract.closePosition(
+            Address.bob, _sender=Address.alice, _now=sp.timestamp(4100)
+        )
+        vmm_contract.increasePosition(
+            sp.record(
+                position_holder=Address.bob,
+                direction=sp.int(1),
+                usd_amount=sp.int(100000000),
+                leverage_multiple=sp.int(2),
+            ),
+            _sender=Address.alice,
+            _now=sp.timestamp(4100),
+        )
+        vmm_contract.triggerConditionalOrders(
+            [4], _sender=Address.elon, _now=sp.timestamp(4100)
+        )
+        sc.verify(~vmm_contract.data.conditional_orders.contains(4))
+        sc.verify(vmm_contract.getPositionData(Address.bob).position == 1)
+        sc.verify(vmm_contract.data.conditional_order_counts[Address.bob] == 0)
+        # Each holder has a cap on open conditional orders
+        vmm_contract.updateMaxConditionalOrders(
+            0, _sender=Address.admin, _valid=False, _exception="InvalidMaxOrders"
+        )
+        vmm_contract.updateMaxConditionalOrders(1, _sender=Address.alice, _valid=False)
+        vmm_contract.updateMaxConditionalOrders(1, _sender=Address.admin)
+        stop_loss = sp.record(
+            position_holder=Address.bob,
+            kind=sp.int(1),
+            direction=sp.int(1),
+            trigger_price=sp.int(1),
+            usd_amount=sp.int(0),
+            leverage_multiple=sp.int(0),
+            expiration=sp.int(0),
+        )
+        vmm_contract.placeConditionalOrder(
+            stop_loss, _sender=Address.alice, _now=sp.timestamp(4100)
+        )
+        vmm_contract.placeConditionalOrder(
+            stop_loss,
+            _sender=Address.alice,
+            _now=sp.timestamp(4100),
+            _valid=False,
+            _exception="TooManyOrders",
+        )
+        vmm_contract.cancelConditionalOrder(
+            position_holder=Address.bob, order_id=5, _sender=Address.alice
+        )
+        vmm_contract.updateMaxConditionalOrders(10, _sender=Address.admin)
+        vmm_contract.closePosition(
+            Address.bob, _sender=Address.alice, _now=sp.timestamp(4100)
+        )
+
+        sc.h2("Testing Price Accumulators")
+        oracle_contract.updatePrice(8000000, _now=sp.timestamp(7210))
+        vmm_contract.distributeFunding(_sender=Address.alice, _now=sp.timestamp(7220))
+        # setVmm and the two funding distributions each started a period
+        sc.verify(vmm_contract.data.price_checkpoint_count == 3)
+        start_mark_price = sc.compute(vmm_contract.getIndexAndMarkPrice().mark_price)
+        oracle_contract.updatePrice(8100000, _now=sp.timestamp(9000))
+        vmm_contract.increasePosition(
+            sp.record(
+                position_holder=Address.alice,
+                direction=sp.int(1),
+                usd_amount=sp.int(100000000),
+                leverage_multiple=sp.int(2),
+            ),
+            _sender=Address.alice,
+            _now=sp.timestamp(9010),
+        )
+        end_mark_price = sc.compute(vmm_contract.getIndexAndMarkPrice().mark_price)
+        vmm_contract.updateTwapFunding(True, _sender=Address.alice, _valid=False)
+        vmm_contract.updateTwapFunding(True, _sender=Address.admin)
+        oracle_contract.updatePrice(8100000, _now=sp.timestamp(10810))
+        vmm_contract.distributeFunding(_sender=Address.alice, _now=sp.timestamp(10820))
+        # Each price weighs by the seconds it was current in the period
+        twap = sc.compute(vmm_contract.getTwap(sp.record(start=2, end=sp.Some(3))))
+        sc.verify(
+            twap.mark_price == (start_mark_price * 1790 + end_mark_price * 1810) / 3600
+        )
+        sc.verify(twap.index_price == (8000000 * 1790 + 8100000 * 1810) // 3600)
+
+        sc.h2("Testing Trigger Index Paging")
+        vmm_orders.updateTriggerBucketSize(
+            vmm_address=Address.eth,
+            bucket_size=0,
+            _sender=Address.admin,
+            _valid=False,
+            _exception="InvalidBucketSize",
+        )
+        vmm_orders.updateTriggerBucketSize(
+            vmm_address=Address.eth,
+            bucket_size=500000,
+            _sender=Address.alice,
+            _valid=False,
+        )
+        vmm_orders.updateTriggerBucketSize(
+            vmm_address=Address.eth, bucket_size=500000, _sender=Address.admin
+        )
+        first_order_id = sc.compute(vmm_orders.data.last_order_id)
+        # Long limit orders in buckets 17, 19 and 24, the mark is in bucket 16
+        for trigger_price in [8600000, 9600000, 12100000]:
+            vmm_orders.createOrder(
+                sp.record(
+                    position_holder=Address.bob,
+                    vmm_address=Address.eth,
+                    order_type=sp.int(1),
+                    trigger_price=sp.int(trigger_price),
+                    limit_price=sp.int(trigger_price),
+                    amount_in=sp.int(100000000),
+                    leverage_multiple=sp.int(2),
+                    direction=sp.int(1),
+                    stop_trigger_price=None,
+                    stop_limit_price=None,
+                    take_trigger_price=None,
+                    take_limit_price=None,
+                    expiration=sp.int(0),
+                    order_status=sp.int(0),
+                ),
+                _sender=Address.bob,
+            )
+        vmm_orders.updateTriggerBucketSize(
+            vmm_address=Address.eth,
+            bucket_size=1000000,
+            _sender=Address.admin,
+            _valid=False,
+            _exception="MarketHasOrders",
+        )
+        resume = sp.cast({}, vmm_types.trigger_cursor_type)
+        # Pages of 3 buckets from the lowest one: 17-19, 20-22 and 23-25
+        for orders_found, next_bucket in [(2, 20), (0, 23), (1, None)]:
+            page = sc.compute(
+                vmm_orders.getTriggeredOrders(
+                    sp.record(
+                        vmm_address=Address.eth,
+                        mark_price=8000000,
+                        max_buckets=3,
+                        resume=resume,
+                    )
+                )
+            )
+            sc.verify(sp.len(page.limit_orders) == orders_found)
+            if next_bucket is None:
+                sc.verify(sp.len(page.resume) == 0)
+            else:
+                sc.verify_equal(
+                    page.resume, {sp.record(direction=1, kind=0): next_bucket}
+                )
+            resume = page.resume
+        # Emptying an edge bucket shrinks the bounds to the next order
+        key = sp.record(vmm_address=Address.eth, direction=1, kind=0)
+        vmm_orders.cancelOrder(first_order_id + 2, _sender=Address.bob)
+        sc.verify_equal(
+            vmm_orders.data.trigger_bounds[key], sp.record(low=17, high=19, buckets=2)
+        )
+        vmm_orders.cancelOrder(first_order_id, _sender=Address.bob)
+        vmm_orders.cancelOrder(first_order_id + 1, _sender=Address.bob)
+        sc.verify(~vmm_orders.data.trigger_bounds.contains(key))
+        vmm_orders.updateTriggerBucketSize(
+            vmm_address=Address.eth, bucket_size=1000000, _sender=Address.admin
+        )
+
+        sc.h2("Testing Order Leg Round Trip")
+        order_id = sc.compute(vmm_orders.data.last_order_id)
+        vmm_orders.createOrder(
+            sp.record(
+                position_holder=Address.bob,
+                vmm_address=Address.eth,
+                order_type=sp.int(1),
+                trigger_price=sp.int(7500000),
+                limit_price=sp.int(7500000),
+                amount_in=sp.int(100000000),
+                leverage_multiple=sp.int(2),
+                direction=sp.int(1),
+                stop_trigger_price=sp.Some(sp.int(7000000)),
+                stop_limit_price=None,
+                take_trigger_price=sp.Some(sp.int(9000000)),
+                take_limit_price=sp.Some(sp.int(8900000)),
+                expiration=sp.int(0),
+                order_status=sp.int(0),
+            ),
+            _sender=Address.bob,
+        )
+        # A leg without a limit price reads back without one
+        order = vmm_orders.getOrder(order_id)
+        sc.verify(order.stop_trigger_price == sp.Some(7000000))
+        sc.verify(order.stop_limit_price == None)
+        sc.verify(order.take_trigger_price == sp.Some(9000000))
+        sc.verify(order.take_limit_price == sp.Some(8900000))
+        vmm_orders.cancelOrder(order_id, _sender=Address.bob)
+        # A limit price needs the trigger price of its leg
+        vmm_orders.createOrder(
+            sp.record(
+                position_holder=Address.bob,
+                vmm_address=Address.eth,
+                order_type=sp.int(1),
+                trigger_price=sp.int(7500000),
+                limit_price=sp.int(7500000),
+                amount_in=sp.int(100000000),
+                leverage_multiple=sp.int(2),
+                direction=sp.int(1),
+                stop_trigger_price=None,
+                stop_limit_price=sp.Some(sp.int(7000000)),
+                take_trigger_price=None,
+                take_limit_price=None,
+                expiration=sp.int(0),
+                order_status=sp.int(0),
+            ),
+            _sender=Address.bob,
+            _valid=False,
+            _exception="InvalidLimitPrice",
+        )
+
+        sc.h2("Testing Batch Queue Limits")
+        vmm_orders.updateMaxBatchSize(1, _sender=Address.alice, _valid=False)
+        vmm_orders.updateMaxBatchSize(
+            0, _sender=Address.admin, _valid=False, _exception="InvalidBatchSize"
+        )
+        vmm_orders.updateMaxBatchSize(1, _sender=Address.admin)
+        vmm_orders.updateBatchAuction(True, _sender=Address.admin)
+        market_order = sp.record(
+            position_holder=Address.bob,
+            vmm_address=vmm_contract.address,
+            order_type=sp.int(0),
+            trigger_price=sp.int(0),
+            limit_price=sp.int(0),
+            amount_in=sp.int(100000000),
+            leverage_multiple=sp.int(2),
+            direction=sp.int(2),
+            stop_trigger_price=None,
+            stop_limit_price=None,
+            take_trigger_price=None,
+            take_limit_price=None,
+            expiration=sp.int(0),
+            order_status=sp.int(0),
+        )
+        vmm_orders.createOrder(market_order, _sender=Address.bob)
+        vmm_orders.createOrder(
+            market_order, _sender=Address.bob, _valid=False, _exception="BatchFull"
+        )
+        vmm_orders.settleBatch(vmm_contract.address, _sender=Address.elon, _level=1000)
+        # The queue accepts orders again, settled from the next block on
+        vmm_orders.createOrder(market_order, _sender=Address.bob)
+        vmm_orders.settleBatch(
+            vmm_contract.address,
+            _sender=Address.elon,
+            _level=1000,
+            _valid=False,
+            _exception="BatchAlreadySettled",
+        )
+        vmm_orders.settleBatch(vmm_contract.address, _sender=Address.elon, _level=1001)
+        sc.verify(~vmm_orders.data.batch_queue.contains(vmm_contract.address))
+        vmm_orders.updateBatchAuction(False, _sender=Address.admin)
+
+        sc.h2("Testing Exit Orders Without a Position")
+        first_order_id = sc.compute(vmm_orders.data.last_order_id)
+        # Three long limit orders above the mark price, with a stop-loss and a
+        # take-profit that are both triggered right away
+        for i in range(3):
+            vmm_orders.createOrder(
+                sp.record(
+                    position_holder=Address.alice,
+                    vmm_address=vmm_contract.address,
+                    order_type=sp.int(1),
+                    trigger_price=sp.int(20000000),
+                    limit_price=sp.int(20000000),
+                    amount_in=sp.int(100000000),
+                    leverage_multiple=sp.int(2),
+                    direction=sp.int(1),
+                    stop_trigger_price=sp.Some(sp.int(20000000)),
+                    stop_limit_price=None,
+                    take_trigger_price=sp.Some(sp.int(1)),
+                    take_limit_price=None,
+                    expiration=sp.int(0),
+                    order_status=sp.int(0),
+                ),
+                _sender=Address.alice,
+            )
+        vmm_orders.executeLimitOrders(
+            vmm_address=vmm_contract.address,
+            order_ids=[first_order_id, first_order_id + 1, first_order_id + 2],
+            _sender=Address.bob,
+        )
+        for i in range(3):
+            sc.verify(vmm_orders.getOrder(first_order_id + i).order_status == 1)
+        # The first stop-loss closes the position, the second finds none
+        vmm_orders.triggerStopLosses(
+            vmm_address=vmm_contract.address,
+            order_ids=[first_order_id, first_order_id + 1],
+            _sender=Address.bob,
+        )
+        sc.verify(~vmm_contract.data.positions.contains(Address.alice))
+        # A take-profit whose position was closed is closed as well
+        vmm_orders.triggerTakeProfits(
+            vmm_address=vmm_contract.address,
+            order_ids=[first_order_id + 2],
+            _sender=Address.bob,
+        )
+        for i in range(3):
+            sc.verify(vmm_orders.getOrder(first_order_id + i).order_status == 2)
+
+        sc.h2("Testing Funding Across Rounds")
+        vmm_contract.increasePosition(
+            sp.record(
+                position_holder=Address.alice,
+                direction=sp.int(1),
+                usd_amount=sp.int(100000000),
+                leverage_multiple=sp.int(2),
+            ),
+            _sender=Address.alice,
+            _now=sp.timestamp(10900),
+        )
+        position = sc.compute(vmm_contract.data.positions[Address.alice])
+        funding_index = position.funding_index
+        # The index stays below the mark, so longs pay a negative rate each round
+        for i in range(3):
+            oracle_contract.updatePrice(7000000, _now=sp.timestamp(14420 + 3600 * i))
+            vmm_contract.distributeFunding(
+                _sender=Address.alice, _now=sp.timestamp(14430 + 3600 * i)
+            )
+            long_funding_index = sc.compute(vmm_contract.data.long_funding_index)
+            sc.verify(long_funding_index < funding_index)
+            funding_index = long_funding_index
+        # The three rounds settle at once, rounded towards zero
+        funding = sc.compute(vmm_contract.getPositionData(Address.alice).funding_amount)
+        accrued = sc.compute(
+            position.position_value * (position.funding_index - funding_index)
+        )
+        decimal = sc.compute(vmm_contract.data.decimal)
+        sc.verify(funding < 0)
+        sc.verify(-funding * decimal <= accrued)
+        sc.verify(accrued < (1 - funding) * decimal)
+        vmm_contract.closePosition(
+            Address.alice, _sender=Address.alice, _now=sp.timestamp(21640)
+        )
+
+        sc.h2("Testing Sweep Fees")
+        vmm_contract.sweepFees(_sender=Address.alice, _valid=False)
+        accrued_fees = sc.compute(vmm_contract.data.accrued_fees)
+        vmm_contract.sweepFees(_sender=Address.elon)
+        sc.verify(vmm_contract.data.accrued_fees == 0)
+        sc.verify(usdt_token.data.ledger[(Address.elon, 0)] == accrued_fees)
+        vmm_contract.sweepFees(_sender=Address.elon, _valid=False)
+
+        sc.h2("Testing Migrate Positions")
+        migrated_vmm = vmm.VMM(
+            metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
+            administrator=Address.admin,
+            usd_contract_address=usdt_token.address,
+            oracle_address=oracle_contract.address,
+            fund_manager=Address.elon,
+        )
+        sc += migrated_vmm
+        # The imported reserves must not be empty
+        migrated_vmm.migratePositions(
+            vmm_state=sp.Some(
+                sp.record(token_amount=0, usd_amount=102040816326, invariant=0)
+            ),
+            positions=[],
+            _sender=Address.admin,
+            _valid=False,
+            _exception="INVALID_VMM_STATE",
+        )
+        migrated_vmm.migratePositions(
+            vmm_state=sp.Some(
+                sp.record(
+                    token_amount=12250000000,
+                    usd_amount=102040816326,
+                    invariant=1250000000000000,
+                )
+            ),
+            positions=[
+                sp.record(
+                    position_holder=Address.alice,
+                    position=1,
+                    entry_price=8000000,
+                    funding_amount=0,
+                    position_value=250000000,
+                    collateral_amount=1960000000,
+                    usd_amount=3920000000,
+                )
+            ],
+            _sender=Address.admin,
+        )
+        migrated_vmm.migratePositions(
+            vmm_state=None,
+            positions=[
+                sp.record(
+                    position_holder=Address.alice,
+                    position=1,
+                    entry_price=8000000,
+                    funding_amount=0,
+                    position_value=250000000,
+                    collateral_amount=1960000000,
+                    usd_amount=3920000000,
+                )
+            ],
+            _sender=Address.admin,
+            _valid=False,
+        )
+        sc.verify(migrated_vmm.data.positions[Address.alice].position == 1)
+        sc.verify(migrated_vmm.data.total_long == 250000000)
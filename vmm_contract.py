@@ -6,6 +6,111 @@ from utilities.Helpers import helpers
 
 @sp.module
 def vmm():
+    # Applies the funding accrued since the position's last index snapshot
+    def settle_funding(params):
+        sp.cast(
+            params,
+            sp.record(
+                position=vmm_types.positions_value,
+                funding_index=sp.int,
+                decimal=sp.int,
+            ),
+        )
+        position = params.position
+        # One rounding towards zero over the whole index delta. The per-position
+        # loop this replaces floored position_value * rate on every round, so a
+        # position held across several rounds can settle a different amount.
+        index_delta = params.funding_index - position.funding_index
+        funding = sp.mul(position.position_value, abs(index_delta)) / params.decimal
+        if index_delta < 0:
+            funding = -funding
+        position.funding_amount += funding
+        position.collateral_amount += funding
+        position.funding_index = params.funding_index
+        return position
+
+    # USD the VMM pays out (long) or takes in (short) to close the position
+    def closing_value(params):
+        sp.cast(
+            params,
+            sp.record(
+                position=vmm_types.positions_value,
+                vmm=sp.record(token_amount=sp.int, usd_amount=sp.int, invariant=sp.int),
+                decimal=sp.int,
+            ),
+        )
+        k = params.vmm.invariant * params.decimal
+        value = sp.int(0)
+        if params.position.position == 1:
+            value = params.vmm.usd_amount - k / (
+                params.vmm.token_amount + params.position.position_value
+            )
+        else:
+            value = (
+                k / (params.vmm.token_amount - params.position.position_value)
+                - params.vmm.usd_amount
+            )
+        return value
+
+    def isqrt(n):
+        sp.cast(n, sp.nat)
+        x = n
+        y = (n + 1) / 2
+        while y < x:
+            x = y
+            y = (x + n / x) / 2
+        return x
+
+    # PnL, margin ratio and the mark price at which liquidate starts accepting
+    # the position (closed form on the constant product curve)
+    def position_health(params):
+        sp.cast(
+            params,
+            sp.record(
+                position=vmm_types.positions_value,
+                vmm=sp.record(token_amount=sp.int, usd_amount=sp.int, invariant=sp.int),
+                decimal=sp.int,
+            ),
+        )
+        position = params.position
+        decimal = params.decimal
+        threshold = (85 * decimal) / 1000
+        value = closing_value(params)
+        pnl = value - position.usd_amount
+        if position.position == 2:
+            pnl = position.usd_amount - value
+        final_value = position.collateral_amount + pnl
+        margin_ratio = final_value * decimal / position.usd_amount
+        k = params.vmm.invariant * decimal
+        pv = position.position_value
+        liquidation_price = sp.nat(0)
+        if (pv > 0) and (k > 0):
+            target = position.usd_amount * (decimal + threshold) / decimal
+            target = target - position.collateral_amount
+            if position.position == 2:
+                target = position.usd_amount * (decimal - threshold) / decimal
+                target = target + position.collateral_amount
+            if target > 0:
+                root = sp.to_int(
+                    isqrt(abs(target * target * pv * pv + 4 * pv * target * k))
+                )
+                usd_reserve = (target * pv + root) / (2 * pv)
+                if position.position == 2:
+                    usd_reserve = (root - target * pv) / (2 * pv)
+                liquidation_price = abs(usd_reserve * usd_reserve * decimal / k)
+        return sp.record(
+            pnl=pnl,
+            margin_ratio=margin_ratio,
+            liquidation_price=liquidation_price,
+            liquidatable=(final_value <= 0) or (margin_ratio < threshold),
+        )
+
+    # Expiration is in seconds since the epoch, 0 for orders that never expire
+    def order_expired(expiration):
+        sp.cast(expiration, sp.int)
+        return (expiration != 0) and (
+            sp.add_seconds(sp.timestamp(0), expiration) < sp.now
+        )
 
     class VMM(helpers.Helpers):
 
@@ -35,8 +140,14 @@ def vmm():
             )
             # Active Positions
             self.data.positions = sp.cast(
-                {}, sp.map[sp.address, vmm_types.positions_value]
+                sp.big_map(), sp.big_map[sp.address, vmm_types.positions_value]
             )
+            # Internal USD balances of holders, moved in and out with deposit/withdraw
+            self.data.balances = sp.cast(sp.big_map(), sp.big_map[sp.address, sp.nat])
+            # Cumulative funding per unit of long position value
+            self.data.long_funding_index = sp.cast(0, sp.int)
+            # Cumulative funding per unit of short position value
+            self.data.short_funding_index = sp.cast(0, sp.int)
             # Funding Period of the contract
             self.data.funding_period = sp.cast(3600, sp.int)
             #  Previous Funding Time
@@ -53,6 +164,35 @@ def vmm():
             self.data.status = sp.cast(0, sp.int)
             # Transaction Fees
             self.data.transaction_fees = sp.cast(2, sp.int)
+            # Fees collected since the last sweep to the fund manager
+            self.data.accrued_fees = sp.cast(0, sp.nat)
+            # Whether holders can place conditional orders on this contract
+            self.data.conditional_orders_enabled = False
+            # Limit, stop-loss and take-profit orders executed by this contract
+            self.data.conditional_orders = sp.cast(
+                sp.big_map(), sp.big_map[sp.int, vmm_types.conditional_order_type]
+            )
+            # Id of the next conditional order
+            self.data.last_conditional_order_id = sp.int(0)
+            # Conditional orders a holder can have open at once
+            self.data.max_conditional_orders = sp.nat(10)
+            # Open conditional orders of each holder
+            self.data.conditional_order_counts = sp.cast(
+                sp.big_map(), sp.big_map[sp.address, sp.nat]
+            )
+            # Positions closed or liquidated by each holder, stop-loss and
+            # take-profit orders placed against an earlier position are stale
+            self.data.position_nonces = sp.cast(
+                sp.big_map(), sp.big_map[sp.address, sp.nat]
+            )
+            # Price cumulatives at the start of each funding period
+            self.data.price_checkpoints = sp.cast(
+                sp.big_map(), sp.big_map[sp.nat, helpers.price_cumulative_type]
+            )
+            # Number of price checkpoints, the last one starts the current period
+            self.data.price_checkpoint_count = sp.nat(0)
+            # Whether funding uses the mark and index TWAPs of the period
+            self.data.twap_funding = False
             # Helper functions for the VMM contract
             helpers.Helpers.__init__(self, oracle_address, usd_contract_address)
 
@@ -71,265 +211,140 @@ def vmm():
             sp.cast(statusCode, sp.int)
             assert self.data.status == statusCode, "InvalidStatus"
 
-        # Update Admin
-        @sp.entrypoint
-        def proposeAdmin(self, newAdminAddress):
-            sp.cast(newAdminAddress, sp.address)
-            self._isAdmin()
-            self.data.administration_panel.pendingAdministrator = sp.Some(
-                newAdminAddress
-            )
-
-        # Verify Admin
-        @sp.entrypoint
-        def updateAdmin(self):
-            assert (
-                self.data.administration_panel.pendingAdministrator.is_some()
-            ), "NoPendingAdministrator"
-            assert (
-                sp.sender
-                == self.data.administration_panel.pendingAdministrator.unwrap_some()
-            ), "NotAuthorized"
-            self.data.administration_panel.administrator = (
-                self.data.administration_panel.pendingAdministrator.unwrap_some()
-            )
-            self.data.administration_panel.pendingAdministrator = None
-
-        # Update Status
-        @sp.entrypoint
-        def updateStatus(self, new_status_code):
-            self._isAdmin()
-            sp.cast(new_status_code, sp.int)
-            self.data.status = new_status_code
-
-        # Add Position Manager
-        @sp.entrypoint
-        def addPositionManager(self, position_manager):
-            sp.cast(position_manager, sp.address)
-            self._isAdmin()
-            self.data.administration_panel.positionManagers.add(position_manager)
-
-        # Remove Position Manager
-        @sp.entrypoint
-        def removePositionManager(self, position_manager):
-            sp.cast(position_manager, sp.address)
-            self._isAdmin()
-            assert self.data.administration_panel.positionManagers.contains(
-                position_manager
-            ), "NotAPositionManager"
-            self.data.administration_panel.positionManagers.remove(position_manager)
-
-        #  Update Fund Manager
-        @sp.entrypoint
-        def updateFundManager(self, new_fund_manager):
-            sp.cast(new_fund_manager, sp.address)
-            self._isAdmin()
-            self.data.administration_panel.fundManager = new_fund_manager
-
-        # Update Oracle Address
-        @sp.entrypoint
-        def updateOracleAddress(self, oracle_address):
-            self._isAdmin()
-            sp.cast(oracle_address, sp.address)
-            self.updateIndexPrice()
-            self.data.oracle_address = oracle_address
-            sp.emit(
-                sp.record(oracle_address=self.data.oracle_address),
-                tag="ORACLE_ADDRESS_UPDATED",
-            )
-
-        #  Update Funding Period
-        @sp.entrypoint
-        def updateFundingPeriod(self, funding_period):
-            self._isAdmin()
-            sp.cast(funding_period, sp.int)
-            self.updateIndexPrice()
-            self.data.funding_period = funding_period
-            sp.emit(
-                sp.record(funding_period=funding_period),
-                tag="FUNDING_PERIOD_UPDATED",
+        # Position with the funding accrued since its last index snapshot applied
+        @sp.private(with_storage="read-only")
+        def _settledPosition(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            position = self.data.positions[position_holder]
+            funding_index = self.data.long_funding_index
+            if position.position == 2:
+                funding_index = self.data.short_funding_index
+            return settle_funding(
+                sp.record(
+                    position=position,
+                    funding_index=funding_index,
+                    decimal=self.data.decimal,
+                )
             )
 
-        # Update Transaction Fees
-        @sp.entrypoint
-        def updateTransactionFees(self, transaction_fees):
-            self._isAdmin()
-            sp.cast(transaction_fees, sp.int)
-            self.data.transaction_fees = transaction_fees
-
-        # Update Decimal
-        @sp.entrypoint
-        def updateDecimal(self, decimal, decimal_amount):
-            self._isAdmin()
-            sp.cast(decimal, sp.int)
-            self.data.decimal = decimal
-            sp.cast(decimal_amount, sp.int)
-            self.data.decimal_amount = decimal_amount
-
-        # Set VMM
-        @sp.entrypoint
-        def setVmm(self, token_amount):
-            self._isAdmin()
-            sp.cast(token_amount, sp.int)
-            assert self.data.vmm == sp.record(
-                token_amount=sp.int(0), usd_amount=sp.int(0), invariant=sp.int(0)
-            ), "VMM_ALREADY_SET"
-            assert token_amount >= sp.int(0) * self.data.decimal, "INVALID_TOKEN_AMOUNT"
-            self.updateIndexPrice()
-            usd_amount = (
-                token_amount * self.data.current_index_price
-            ) / self.data.decimal
-            self.data.vmm = sp.record(
-                token_amount=token_amount,
-                usd_amount=usd_amount,
-                invariant=sp.mul(token_amount, usd_amount) / self.data.decimal,
-            )
-            self.data.status = sp.int(1)
+        @sp.private(with_storage="read-write")
+        def _creditBalance(self, params):
+            sp.cast(params, sp.record(holder=sp.address, amount=sp.nat))
+            if params.amount > 0:
+                self.data.balances[params.holder] = (
+                    self.data.balances.get(params.holder, default=0) + params.amount
+                )
 
-            self.data.current_mark_price = (
-                self.data.vmm.usd_amount * self.data.decimal
-            ) / self.data.vmm.token_amount
-            self.data.previous_funding_time = sp.now
-            self.data.upcoming_funding_time = sp.add_seconds(
-                sp.now, self.data.funding_period
-            )
-            sp.emit(self.data.vmm, tag="VMM_CONFIGURED")
+        @sp.private(with_storage="read-write")
+        def _debitBalance(self, params):
+            sp.cast(params, sp.record(holder=sp.address, amount=sp.nat))
+            balance = self.data.balances.get(params.holder, default=0)
+            assert balance >= params.amount, "INSUFFICIENT_BALANCE"
+            if balance == params.amount:
+                del self.data.balances[params.holder]
+            else:
+                self.data.balances[params.holder] = sp.as_nat(balance - params.amount)
 
-        #  Distribute Funding
-        @sp.entrypoint
-        def distributeFunding(self):
-            self._checkStatus(1)
-            assert utils.seconds_of_timestamp(  # type: ignore
-                self.data.upcoming_funding_time
-            ) <= utils.seconds_of_timestamp(  # type: ignore
-                sp.now
-            ), "FUNDING_NOT_DUE"
-            self.updateIndexPrice()
-            self.data.current_mark_price = (
-                self.data.vmm.usd_amount * self.data.decimal
-            ) / self.data.vmm.token_amount
-            self.calculateFundingRate()
-            price_difference = (
-                self.data.current_mark_price - self.data.current_index_price
+        # Records the price cumulative at the start of a funding period
+        @sp.private(with_storage="read-write")
+        def _checkpointPrices(self):
+            self.data.price_cumulative = helpers.accrue_prices(
+                sp.record(
+                    cumulative=self.data.price_cumulative,
+                    mark_price=self.data.current_mark_price,
+                    index_price=self.data.current_index_price,
+                )
             )
-            if price_difference < 0:
-                if self.data.total_short > 0:
-                    for y in self.data.positions.items():
-                        if y.value.position == 2:
-                            self.data.positions[
-                                y.key
-                            ].funding_amount = self.data.positions[
-                                y.key
-                            ].funding_amount - (
-                                sp.mul(
-                                    y.value.position_value,
-                                    self.data.short_funding_rate.value,
-                                )
-                                / self.data.decimal
-                            )
-                            self.data.positions[y.key].collateral_amount = (
-                                self.data.positions[y.key].collateral_amount
-                                - (
-                                    sp.mul(
-                                        y.value.position_value,
-                                        self.data.short_funding_rate.value,
-                                    )
-                                )
-                                / self.data.decimal
-                            )
-
-                if self.data.total_long > 0:
-                    for x in self.data.positions.items():
-                        if x.value.position == 1:
-                            self.data.positions[x.key].funding_amount += (
-                                sp.mul(
-                                    x.value.position_value,
-                                    self.data.long_funding_rate.value,
-                                )
-                            ) / self.data.decimal
-                            self.data.positions[x.key].collateral_amount += (
-                                sp.mul(
-                                    x.value.position_value,
-                                    self.data.long_funding_rate.value,
-                                )
-                            ) / self.data.decimal
-            if price_difference > 0:
-                if self.data.total_long > 0:
-                    for y in self.data.positions.items():
-                        if y.value.position == 1:
-                            self.data.positions[
-                                y.key
-                            ].funding_amount = self.data.positions[
-                                y.key
-                            ].funding_amount - (
-                                (
-                                    sp.mul(
-                                        y.value.position_value,
-                                        self.data.long_funding_rate.value,
-                                    )
-                                )
-                                / self.data.decimal
-                            )
-                            self.data.positions[y.key].collateral_amount = (
-                                self.data.positions[y.key].collateral_amount
-                                - (
-                                    sp.mul(
-                                        y.value.position_value,
-                                        self.data.long_funding_rate.value,
-                                    )
-                                )
-                                / self.data.decimal
-                            )
-                if self.data.total_short > 0:
-                    for x in self.data.positions.items():
-                        if x.value.position == 2:
-                            self.data.positions[x.key].funding_amount += (
-                                sp.mul(
-                                    x.value.position_value,
-                                    self.data.short_funding_rate.value,
-                                )
-                            ) / self.data.decimal
-                            self.data.positions[x.key].collateral_amount += (
-                                sp.mul(
-                                    x.value.position_value,
-                                    self.data.short_funding_rate.value,
-                                )
-                            ) / self.data.decimal
-            self.data.previous_funding_time = sp.now
-            self.data.upcoming_funding_time = sp.add_seconds(
-                sp.now, self.data.funding_period
+            self.data.price_checkpoints[self.data.price_checkpoint_count] = (
+                self.data.price_cumulative
             )
-            self.data.current_mark_price = (
-                self.data.vmm.usd_amount * self.data.decimal
-            ) / self.data.vmm.token_amount
-            sp.emit(sp.record(funding_time=sp.now), tag="FUNDING_DISTRIBUTED")
+            self.data.price_checkpoint_count += 1
 
-        # Increase Position
-        @sp.entrypoint
-        def increasePosition(
-            self, position_holder, direction, usd_amount, leverage_multiple
-        ):
+        # Closes position_holder if it is under the 8.5% maintenance margin and
+        # returns its payout and the fund manager's cut. The caller pays them out
+        # and updates the mark price.
+        @sp.private(with_storage="read-write", with_operations=True)
+        def _liquidatePosition(self, position_holder):
             sp.cast(position_holder, sp.address)
-            sp.cast(direction, sp.int)
-            sp.cast(usd_amount, sp.int)
-            sp.cast(leverage_multiple, sp.int)
-
-            self._checkStatus(1)
-            self._isPositionManager()
-            assert direction == sp.int(1) or direction == sp.int(2), "INVALID_DIRECTION"
-            assert usd_amount >= sp.int(0) * self.data.decimal, "INVALID_USD_AMOUNT"
-            assert (
-                leverage_multiple >= sp.int(0) * self.data.decimal
-            ), "INVALID_LEVERAGE_AMOUNT"
-
-            self.updateIndexPrice()
-            self.transferUsd(
-                sp.record(
-                    sender_=position_holder,
-                    receiver_=sp.self_address(),
-                    amount_=abs(usd_amount),
-                )
+            outcome = sp.cast(
+                None,
+                sp.option[sp.record(receiver=sp.address, reward=sp.nat, fee=sp.nat)],
             )
+            if self.data.positions.contains(position_holder):
+                position = self.data.positions[position_holder]
+                funding_index = self.data.long_funding_index
+                if position.position == 2:
+                    funding_index = self.data.short_funding_index
+                position = settle_funding(
+                    sp.record(
+                        position=position,
+                        funding_index=funding_index,
+                        decimal=self.data.decimal,
+                    )
+                )
+                position_value = closing_value(
+                    sp.record(
+                        position=position, vmm=self.data.vmm, decimal=self.data.decimal
+                    )
+                )
+                final_value = position.collateral_amount + (
+                    position_value - position.usd_amount
+                )
+                # Longs pay the liquidator, shorts pay the remainder to the holder
+                receiver = sp.sender
+                if position.position == 2:
+                    final_value = position.collateral_amount + (
+                        position.usd_amount - position_value
+                    )
+                    receiver = position_holder
+                liquidatable = True
+                if final_value > 0:
+                    margin_ratio = final_value * self.data.decimal / position.usd_amount
+                    liquidatable = margin_ratio < ((85 * self.data.decimal) / 1000)
+                if liquidatable:
+                    if position.position == 1:
+                        self.data.vmm.usd_amount = (
+                            self.data.vmm.usd_amount - position_value
+                        )
+                        self.data.vmm.token_amount += position.position_value
+                        self.data.total_long = (
+                            self.data.total_long - position.position_value
+                        )
+                    else:
+                        self.data.vmm.usd_amount += position_value
+                        self.data.vmm.token_amount = (
+                            self.data.vmm.token_amount - position.position_value
+                        )
+                        self.data.total_short = (
+                            self.data.total_short - position.position_value
+                        )
+                    del self.data.positions[position_holder]
+                    self.data.position_nonces[position_holder] = (
+                        self.data.position_nonces.get(position_holder, default=0) + 1
+                    )
+                    fee = (abs(final_value) * 3) / 100
+                    outcome = sp.Some(
+                        sp.record(
+                            receiver=receiver,
+                            reward=abs(abs(final_value) - fee),
+                            fee=fee,
+                        )
+                    )
+                    sp.emit(
+                        sp.record(position_holder=position_holder),
+                        tag="POSITION_LIQUIDATED",
+                    )
+            return outcome
+
+        # Trades an increase of position_holder's position against the reserves.
+        # The caller debits usd_amount and settles the position's funding first.
+        @sp.private(with_storage="read-write", with_operations=True)
+        def _increasePosition(self, params):
+            sp.cast(params, vmm_types.position_fill_type)
+            position_holder = params.position_holder
+            direction = params.direction
+            usd_amount = params.usd_amount
+            leverage_multiple = params.leverage_multiple
 
             net_usd_amount = (
                 usd_amount - (usd_amount * self.data.transaction_fees) / 100
@@ -353,6 +368,7 @@ def vmm():
                         position_value=sp.to_int(position_value),
                         collateral_amount=net_usd_amount,
                         usd_amount=sp.mul(net_usd_amount, leverage_multiple),
+                        funding_index=self.data.long_funding_index,
                     )
                     self.data.vmm.usd_amount += sp.mul(
                         net_usd_amount, leverage_multiple
@@ -433,6 +449,7 @@ def vmm():
                             position_value=(position_value),
                             collateral_amount=net_usd_amount,
                             usd_amount=sp.mul(net_usd_amount, leverage_multiple),
+                            funding_index=self.data.short_funding_index,
                         )
                         self.data.vmm.usd_amount = self.data.vmm.usd_amount - sp.mul(
                             net_usd_amount, leverage_multiple
@@ -490,30 +507,28 @@ def vmm():
                 else:
                     raise "INVALID_DIRECTION"
 
-            self.transferUsd(
-                sp.record(
-                    sender_=sp.self_address(),
-                    receiver_=self.data.administration_panel.fundManager,
-                    amount_=abs(usd_amount - net_usd_amount),
-                )
-            )
+            self.data.accrued_fees += abs(usd_amount - net_usd_amount)
 
             self.data.current_mark_price = (
                 self.data.vmm.usd_amount * self.data.decimal
             ) / self.data.vmm.token_amount
 
-        # Decrease Position
-        @sp.entrypoint
-        def decreasePosition(self, position_holder, usd_amount, leverage_multiple):
-            sp.cast(position_holder, sp.address)
-            sp.cast(leverage_multiple, sp.int)
-            sp.cast(usd_amount, sp.int)
-            self._checkStatus(1)
-            self._isPositionManager()
-            assert self.data.positions.contains(position_holder), "POSITION_NOT_FOUND"
-            assert leverage_multiple > 0, "LEVERAGE_MULTIPLE_INVALID"
-            assert usd_amount > 0, "POSITION_AMOUNT_INVALID"
-            self.updateIndexPrice()
+        # Trades a decrease of position_holder's settled position against the
+        # reserves and returns the amount the caller credits to the holder
+        @sp.private(with_storage="read-write", with_operations=True)
+        def _decreasePosition(self, params):
+            sp.cast(
+                params,
+                sp.record(
+                    position_holder=sp.address,
+                    usd_amount=sp.int,
+                    leverage_multiple=sp.int,
+                ),
+            )
+            position_holder = params.position_holder
+            usd_amount = params.usd_amount
+            leverage_multiple = params.leverage_multiple
+            credit = sp.nat(0)
 
             if self.data.positions[position_holder].position == 1:
                 position_value = abs(
@@ -558,13 +573,7 @@ def vmm():
                     ),
                     tag="LONG_POSITION_DECREASED",
                 )
-                self.transferUsd(
-                    sp.record(
-                        sender_=sp.self_address(),
-                        receiver_=position_holder,
-                        amount_=position_value,
-                    )
-                )
+                credit = position_value
 
             if self.data.positions[position_holder].position == 2:
                 position_value = abs(
@@ -614,22 +623,15 @@ def vmm():
                     tag="SHORT_POSITION_DECREASED",
                 )
 
-                self.transferUsd(
-                    sp.record(
-                        sender_=sp.self_address(),
-                        receiver_=position_holder,
-                        amount_=position_value,
-                    )
-                )
+                credit = position_value
+            return credit
 
-        # Close Position
-        @sp.entrypoint
-        def closePosition(self, position_holder):
+        # Trades position_holder's settled position back into the reserves and
+        # returns the amount the caller credits to the holder
+        @sp.private(with_storage="read-write", with_operations=True)
+        def _closePosition(self, position_holder):
             sp.cast(position_holder, sp.address)
-            assert self.data.status == 1 or self.data.status == 2, "InvalidStatus"
-            assert self.data.positions.contains(position_holder), "InvalidPosition"
-            self._isPositionManager()
-            self.updateIndexPrice()
+            credit = sp.nat(0)
             if self.data.positions[position_holder].position == 1:
                 position_value = self.data.vmm.usd_amount - (
                     self.data.vmm.invariant
@@ -642,14 +644,8 @@ def vmm():
 
                 pnl = position_value - (self.data.positions[position_holder].usd_amount)
 
-                self.transferUsd(
-                    sp.record(
-                        sender_=sp.self_address(),
-                        receiver_=position_holder,
-                        amount_=abs(
-                            self.data.positions[position_holder].collateral_amount + pnl
-                        ),
-                    )
+                credit = abs(
+                    self.data.positions[position_holder].collateral_amount + pnl
                 )
 
                 self.data.vmm.usd_amount = self.data.vmm.usd_amount - position_value
@@ -661,6 +657,9 @@ def vmm():
                     - self.data.positions[position_holder].position_value
                 )
                 del self.data.positions[position_holder]
+                self.data.position_nonces[position_holder] = (
+                    self.data.position_nonces.get(position_holder, default=0) + 1
+                )
                 self.data.current_mark_price = (
                     self.data.vmm.usd_amount * self.data.decimal
                 ) / self.data.vmm.token_amount
@@ -683,15 +682,8 @@ def vmm():
                         self.data.positions[position_holder].usd_amount - position_value
                     )
 
-                    self.transferUsd(
-                        sp.record(
-                            sender_=sp.self_address(),
-                            receiver_=position_holder,
-                            amount_=abs(
-                                self.data.positions[position_holder].collateral_amount
-                                + pnl
-                            ),
-                        )
+                    credit = abs(
+                        self.data.positions[position_holder].collateral_amount + pnl
                     )
                     self.data.vmm.usd_amount += position_value
                     self.data.vmm.token_amount = (
@@ -703,6 +695,9 @@ def vmm():
                         - self.data.positions[position_holder].position_value
                     )
                     del self.data.positions[position_holder]
+                    self.data.position_nonces[position_holder] = (
+                        self.data.position_nonces.get(position_holder, default=0) + 1
+                    )
                     self.data.current_mark_price = (
                         self.data.vmm.usd_amount * self.data.decimal
                     ) / self.data.vmm.token_amount
@@ -710,60 +705,39 @@ def vmm():
                         sp.record(pnl=pnl, position_holder=position_holder),
                         tag="SHORT_POSITION_CLOSED",
                     )
+            return credit
 
-        # Add Margin
-        @sp.entrypoint
-        def addMargin(self, position_holder, amount):
-            sp.cast(amount, sp.int)
-            sp.cast(position_holder, sp.address)
-            self._checkStatus(1)
-            self._isPositionManager()
-            self.updateIndexPrice()
+        # Adds amount, net of fees, to the collateral of position_holder's settled
+        # position. The caller debits amount first.
+        @sp.private(with_storage="read-write", with_operations=True)
+        def _addMargin(self, params):
+            sp.cast(params, sp.record(position_holder=sp.address, amount=sp.int))
+            position_holder = params.position_holder
+            amount = params.amount
             amount1 = amount - (amount * self.data.transaction_fees) / 100
-            self.transferUsd(
-                sp.record(
-                    sender_=position_holder,
-                    receiver_=sp.self_address(),
-                    amount_=abs(amount),
-                )
-            )
             self.data.positions[position_holder].collateral_amount += amount1
             self.data.current_mark_price = (
                 self.data.vmm.usd_amount * self.data.decimal
             ) / self.data.vmm.token_amount
-            self.transferUsd(
-                sp.record(
-                    sender_=sp.self_address(),
-                    receiver_=self.data.administration_panel.fundManager,
-                    amount_=abs(amount - amount1),
-                )
-            )
+            self.data.accrued_fees += abs(amount - amount1)
             sp.emit(
                 sp.record(amount=amount1, position_holder=position_holder),
                 tag="MARGIN_ADDED",
             )
 
-        # Remove Margin
-        @sp.entrypoint
-        def removeMargin(self, position_holder, amount):
-            sp.cast(amount, sp.int)
-            sp.cast(position_holder, sp.address)
-            self._checkStatus(1)
-            self._isPositionManager()
-            self.updateIndexPrice()
+        # Takes amount out of the collateral of position_holder's settled position
+        # and returns the amount the caller credits to the holder
+        @sp.private(with_storage="read-write", with_operations=True)
+        def _removeMargin(self, params):
+            sp.cast(params, sp.record(position_holder=sp.address, amount=sp.int))
+            position_holder = params.position_holder
+            amount = params.amount
             margin_ratio = (
                 (self.data.positions[position_holder].collateral_amount - amount)
                 * self.data.decimal
                 / self.data.positions[position_holder].usd_amount
             )
             assert margin_ratio > ((30 * self.data.decimal) / 100), "INVALID_MARGIN"
-            self.transferUsd(
-                sp.record(
-                    sender_=sp.self_address(),
-                    receiver_=position_holder,
-                    amount_=abs(amount),
-                )
-            )
             self.data.positions[position_holder].collateral_amount = (
                 self.data.positions[position_holder].collateral_amount - amount
             )
@@ -774,164 +748,1134 @@ def vmm():
                 sp.record(amount=amount, position_holder=position_holder),
                 tag="MARGIN_REMOVED",
             )
+            return abs(amount)
 
-        # Liquidate
+        # Update Admin
         @sp.entrypoint
-        def liquidate(self, position_holder):
-            sp.cast(position_holder, sp.address)
-            self._checkStatus(1)
-            self._isPositionManager()
-            self.updateIndexPrice()
-            if self.data.positions[position_holder].position == 1:
-                position_value = self.data.vmm.usd_amount - (
-                    self.data.vmm.invariant
-                    * self.data.decimal
-                    / (
-                        self.data.vmm.token_amount
-                        + self.data.positions[position_holder].position_value
-                    )
-                )
-                final_value = self.data.positions[position_holder].collateral_amount + (
-                    position_value - self.data.positions[position_holder].usd_amount
-                )
-                if final_value > 0:
-                    margin_ratio = (
-                        final_value
-                        * self.data.decimal
-                        / self.data.positions[position_holder].usd_amount
-                    )
-                    assert margin_ratio < (
-                        (85 * self.data.decimal) / 1000
-                    ), "MARIGN_RATIO_GREATER"
+        def proposeAdmin(self, newAdminAddress):
+            sp.cast(newAdminAddress, sp.address)
+            self._isAdmin()
+            self.data.administration_panel.pendingAdministrator = sp.Some(
+                newAdminAddress
+            )
 
-                self.data.vmm.usd_amount = self.data.vmm.usd_amount - position_value
-                self.data.vmm.token_amount += self.data.positions[
-                    position_holder
-                ].position_value
-                self.data.current_mark_price = (
-                    self.data.vmm.usd_amount * self.data.decimal
-                ) / self.data.vmm.token_amount
-                self.data.total_long = (
-                    self.data.total_long
-                    - self.data.positions[position_holder].position_value
-                )
-                self.transferUsd(
-                    sp.record(
-                        sender_=sp.self_address(),
-                        receiver_=sp.sender,
-                        amount_=abs(abs(final_value) - (abs(final_value) * 3) / 100),
-                    )
-                )
-                self.transferUsd(
-                    sp.record(
-                        sender_=sp.self_address(),
-                        receiver_=self.data.administration_panel.fundManager,
-                        amount_=(abs(final_value) * 3) / 100,
-                    )
-                )
-                del self.data.positions[position_holder]
+        # Verify Admin
+        @sp.entrypoint
+        def updateAdmin(self):
+            assert (
+                self.data.administration_panel.pendingAdministrator.is_some()
+            ), "NoPendingAdministrator"
+            assert (
+                sp.sender
+                == self.data.administration_panel.pendingAdministrator.unwrap_some()
+            ), "NotAuthorized"
+            self.data.administration_panel.administrator = (
+                self.data.administration_panel.pendingAdministrator.unwrap_some()
+            )
+            self.data.administration_panel.pendingAdministrator = None
 
-            else:
-                if self.data.positions[position_holder].position == 2:
-                    position_value = (
-                        self.data.vmm.invariant
-                        * self.data.decimal
-                        / (
-                            self.data.vmm.token_amount
-                            - self.data.positions[position_holder].position_value
-                        )
-                        - self.data.vmm.usd_amount
-                    )
-                    final_value = (
-                        self.data.positions[position_holder].collateral_amount
-                    ) + (
-                        (self.data.positions[position_holder].usd_amount)
-                        - position_value
-                    )
-                    if final_value > 0:
-                        margin_ratio = (
-                            final_value
-                            * self.data.decimal
-                            / self.data.positions[position_holder].usd_amount
-                        )
-                        assert margin_ratio < (
-                            (85 * self.data.decimal) / 1000
-                        ), "MARIGN_RATIO_GREATER"
+        # Update Status
+        @sp.entrypoint
+        def updateStatus(self, new_status_code):
+            self._isAdmin()
+            sp.cast(new_status_code, sp.int)
+            self.data.status = new_status_code
 
-                    self.data.vmm.usd_amount += position_value
-                    self.data.vmm.token_amount = (
-                        self.data.vmm.token_amount
-                        - self.data.positions[position_holder].position_value
-                    )
-                    self.data.current_mark_price = (
-                        self.data.vmm.usd_amount * self.data.decimal
-                    ) / self.data.vmm.token_amount
-                    self.data.total_short = (
-                        self.data.total_short
-                        - self.data.positions[position_holder].position_value
-                    )
-                    self.transferUsd(
-                        sp.record(
-                            sender_=sp.self_address(),
-                            receiver_=position_holder,
-                            amount_=abs(abs(final_value) - abs(final_value * 3) / 100),
-                        )
-                    )
-                    self.transferUsd(
-                        sp.record(
-                            sender_=sp.self_address(),
-                            receiver_=self.data.administration_panel.fundManager,
-                            amount_=(abs(final_value) * 3) / 100,
-                        )
-                    )
-                    del self.data.positions[position_holder]
+        # Add Position Manager
+        @sp.entrypoint
+        def addPositionManager(self, position_manager):
+            sp.cast(position_manager, sp.address)
+            self._isAdmin()
+            self.data.administration_panel.positionManagers.add(position_manager)
+
+        # Remove Position Manager
+        @sp.entrypoint
+        def removePositionManager(self, position_manager):
+            sp.cast(position_manager, sp.address)
+            self._isAdmin()
+            assert self.data.administration_panel.positionManagers.contains(
+                position_manager
+            ), "NotAPositionManager"
+            self.data.administration_panel.positionManagers.remove(position_manager)
+
+        #  Update Fund Manager
+        @sp.entrypoint
+        def updateFundManager(self, new_fund_manager):
+            sp.cast(new_fund_manager, sp.address)
+            self._isAdmin()
+            self.data.administration_panel.fundManager = new_fund_manager
+
+        # Update Oracle Address
+        @sp.entrypoint
+        def updateOracleAddress(self, oracle_address):
+            self._isAdmin()
+            sp.cast(oracle_address, sp.address)
+            self.updateIndexPrice()
+            self.data.oracle_address = oracle_address
+            self.data.index_price_block = None
             sp.emit(
-                sp.record(position_holder=position_holder), tag="POSITION_LIQUIDATED"
+                sp.record(oracle_address=self.data.oracle_address),
+                tag="ORACLE_ADDRESS_UPDATED",
             )
 
-        # Take Profit
+        #  Update Funding Period
         @sp.entrypoint
-        def takeProfit(self, position_holder):
-            sp.cast(position_holder, sp.address)
-            self._checkStatus(1)
-            self._isPositionManager()
+        def updateFundingPeriod(self, funding_period):
+            self._isAdmin()
+            sp.cast(funding_period, sp.int)
             self.updateIndexPrice()
-            self.transferUsd(
+            self.data.funding_period = funding_period
+            sp.emit(
+                sp.record(funding_period=funding_period),
+                tag="FUNDING_PERIOD_UPDATED",
+            )
+
+        # Sweep Fees
+        @sp.entrypoint
+        def sweepFees(self):
+            assert (
+                sp.sender == self.data.administration_panel.fundManager
+            ), "NotFundManager"
+            assert self.data.accrued_fees > 0, "NO_FEES_ACCRUED"
+            self.transferUsdBatch(
+                [
+                    sp.record(
+                        sender_=sp.self_address(),
+                        receiver_=self.data.administration_panel.fundManager,
+                        amount_=self.data.accrued_fees,
+                    ),
+                ]
+            )
+            sp.emit(
                 sp.record(
-                    sender_=position_holder,
-                    receiver_=sp.self_address(),
-                    amount_=abs(self.data.positions[position_holder].funding_amount),
-                )
+                    fund_manager=self.data.administration_panel.fundManager,
+                    amount=self.data.accrued_fees,
+                ),
+                tag="FEES_SWEPT",
             )
-            self.data.positions[position_holder].funding_amount = sp.int(0)
+            self.data.accrued_fees = 0
 
-        # Views
+        # Update Transaction Fees
+        @sp.entrypoint
+        def updateTransactionFees(self, transaction_fees):
+            self._isAdmin()
+            sp.cast(transaction_fees, sp.int)
+            self.data.transaction_fees = transaction_fees
 
-        # Get Position View
-        @sp.onchain_view()
-        def getPositionData(self, position_holder):
-            sp.cast(position_holder, sp.address)
-            return self.data.positions[position_holder]
+        # Update Conditional Orders
+        @sp.entrypoint
+        def updateConditionalOrders(self, enabled):
+            self._isAdmin()
+            sp.cast(enabled, sp.bool)
+            self.data.conditional_orders_enabled = enabled
 
-        # Get VMM View
-        @sp.onchain_view()
-        def getVmmData(self):
-            return self.data.vmm
+        # Update the number of conditional orders a holder can have open
+        @sp.entrypoint
+        def updateMaxConditionalOrders(self, max_conditional_orders):
+            self._isAdmin()
+            sp.cast(max_conditional_orders, sp.nat)
+            assert max_conditional_orders > 0, "InvalidMaxOrders"
+            self.data.max_conditional_orders = max_conditional_orders
 
-        # Get Index and Mark Price View
-        @sp.onchain_view()
-        def getIndexAndMarkPrice(self):
-            return sp.record(
-                index_price=self.data.current_index_price,
-                mark_price=self.data.current_mark_price,
+        # Update TWAP Funding
+        @sp.entrypoint
+        def updateTwapFunding(self, enabled):
+            self._isAdmin()
+            sp.cast(enabled, sp.bool)
+            self.data.twap_funding = enabled
+
+        # Update Decimal
+        @sp.entrypoint
+        def updateDecimal(self, decimal, decimal_amount):
+            self._isAdmin()
+            sp.cast(decimal, sp.int)
+            self.data.decimal = decimal
+            sp.cast(decimal_amount, sp.int)
+            self.data.decimal_amount = decimal_amount
+
+        # Set VMM
+        @sp.entrypoint
+        def setVmm(self, token_amount):
+            self._isAdmin()
+            sp.cast(token_amount, sp.int)
+            assert self.data.vmm == sp.record(
+                token_amount=sp.int(0), usd_amount=sp.int(0), invariant=sp.int(0)
+            ), "VMM_ALREADY_SET"
+            assert token_amount >= sp.int(0) * self.data.decimal, "INVALID_TOKEN_AMOUNT"
+            self.updateIndexPrice()
+            usd_amount = (
+                token_amount * self.data.current_index_price
+            ) / self.data.decimal
+            self.data.vmm = sp.record(
+                token_amount=token_amount,
+                usd_amount=usd_amount,
+                invariant=sp.mul(token_amount, usd_amount) / self.data.decimal,
             )
+            self.data.status = sp.int(1)
 
-        # Get Funding Rate View
-        @sp.onchain_view()
-        def getFundingRate(self):
-            return sp.record(
-                long_funding_rate=self.data.long_funding_rate,
-                short_funding_rate=self.data.short_funding_rate,
+            self.data.current_mark_price = (
+                self.data.vmm.usd_amount * self.data.decimal
+            ) / self.data.vmm.token_amount
+            self.data.previous_funding_time = sp.now
+            self.data.upcoming_funding_time = sp.add_seconds(
+                sp.now, self.data.funding_period
+            )
+            self._checkpointPrices()
+            sp.emit(self.data.vmm, tag="VMM_CONFIGURED")
+
+        # Migrate Positions
+        @sp.entrypoint
+        def migratePositions(self, vmm_state, positions):
+            sp.cast(
+                vmm_state,
+                sp.option[
+                    sp.record(token_amount=sp.int, usd_amount=sp.int, invariant=sp.int)
+                ],
+            )
+            sp.cast(positions, sp.list[vmm_types.migrated_position_type])
+            self._isAdmin()
+            self._checkStatus(0)
+            if vmm_state.is_some():
+                imported = vmm_state.unwrap_some()
+                assert (imported.token_amount > 0) and (
+                    imported.usd_amount > 0
+                ), "INVALID_VMM_STATE"
+                self.accruePrices()
+                self.data.vmm = imported
+                self.data.current_mark_price = (
+                    self.data.vmm.usd_amount * self.data.decimal
+                ) / self.data.vmm.token_amount
+                self.data.previous_funding_time = sp.now
+                self.data.upcoming_funding_time = sp.add_seconds(
+                    sp.now, self.data.funding_period
+                )
+                self._checkpointPrices()
+            for migrated in positions:
+                assert (
+                    self.data.positions.contains(migrated.position_holder) == False
+                ), "POSITION_ALREADY_MIGRATED"
+                assert (
+                    migrated.position == 1 or migrated.position == 2
+                ), "INVALID_POSITION"
+                funding_index = self.data.long_funding_index
+                if migrated.position == 2:
+                    funding_index = self.data.short_funding_index
+                self.data.positions[migrated.position_holder] = sp.record(
+                    position=migrated.position,
+                    entry_price=migrated.entry_price,
+                    funding_amount=migrated.funding_amount,
+                    position_value=migrated.position_value,
+                    collateral_amount=migrated.collateral_amount,
+                    usd_amount=migrated.usd_amount,
+                    funding_index=funding_index,
+                )
+                if migrated.position == 1:
+                    self.data.total_long += migrated.position_value
+                else:
+                    self.data.total_short += migrated.position_value
+            sp.emit(
+                sp.record(migrated_positions=sp.len(positions)),
+                tag="POSITIONS_MIGRATED",
+            )
+
+        #  Distribute Funding
+        @sp.entrypoint
+        def distributeFunding(self):
+            self._checkStatus(1)
+            assert utils.seconds_of_timestamp(  # type: ignore
+                self.data.upcoming_funding_time
+            ) <= utils.seconds_of_timestamp(  # type: ignore
+                sp.now
+            ), "FUNDING_NOT_DUE"
+            self.updateIndexPrice()
+            self.data.current_mark_price = (
+                self.data.vmm.usd_amount * self.data.decimal
+            ) / self.data.vmm.token_amount
+            funding_prices = sp.record(
+                mark_price=self.data.current_mark_price,
+                index_price=self.data.current_index_price,
+            )
+            if self.data.twap_funding and (self.data.price_checkpoint_count > 0):
+                funding_prices = helpers.twap(
+                    sp.record(
+                        start=self.data.price_checkpoints[
+                            sp.as_nat(self.data.price_checkpoint_count - 1)
+                        ],
+                        end=helpers.accrue_prices(
+                            sp.record(
+                                cumulative=self.data.price_cumulative,
+                                mark_price=self.data.current_mark_price,
+                                index_price=self.data.current_index_price,
+                            )
+                        ),
+                    )
+                )
+            self.calculateFundingRate(funding_prices)
+            price_difference = funding_prices.mark_price - funding_prices.index_price
+            if price_difference < 0:
+                if self.data.total_short > 0:
+                    self.data.short_funding_index = (
+                        self.data.short_funding_index
+                        - self.data.short_funding_rate.value
+                    )
+                if self.data.total_long > 0:
+                    self.data.long_funding_index += self.data.long_funding_rate.value
+            if price_difference > 0:
+                if self.data.total_long > 0:
+                    self.data.long_funding_index = (
+                        self.data.long_funding_index - self.data.long_funding_rate.value
+                    )
+                if self.data.total_short > 0:
+                    self.data.short_funding_index += self.data.short_funding_rate.value
+            self.data.previous_funding_time = sp.now
+            self.data.upcoming_funding_time = sp.add_seconds(
+                sp.now, self.data.funding_period
+            )
+            self.data.current_mark_price = (
+                self.data.vmm.usd_amount * self.data.decimal
+            ) / self.data.vmm.token_amount
+            self._checkpointPrices()
+            sp.emit(
+                sp.record(
+                    funding_time=sp.now,
+                    long_funding_index=self.data.long_funding_index,
+                    short_funding_index=self.data.short_funding_index,
+                ),
+                tag="FUNDING_DISTRIBUTED",
+            )
+
+        # Deposit USD into the sender's internal balance
+        @sp.entrypoint
+        def deposit(self, amount):
+            sp.cast(amount, sp.nat)
+            assert amount > 0, "INVALID_AMOUNT"
+            self.transferUsdBatch(
+                [
+                    sp.record(
+                        sender_=sp.sender,
+                        receiver_=sp.self_address(),
+                        amount_=amount,
+                    ),
+                ]
+            )
+            self._creditBalance(sp.record(holder=sp.sender, amount=amount))
+            sp.emit(sp.record(holder=sp.sender, amount=amount), tag="USD_DEPOSITED")
+
+        # Withdraw USD from the sender's internal balance
+        @sp.entrypoint
+        def withdraw(self, amount):
+            sp.cast(amount, sp.nat)
+            assert amount > 0, "INVALID_AMOUNT"
+            self._debitBalance(sp.record(holder=sp.sender, amount=amount))
+            self.transferUsdBatch(
+                [
+                    sp.record(
+                        sender_=sp.self_address(),
+                        receiver_=sp.sender,
+                        amount_=amount,
+                    ),
+                ]
+            )
+            sp.emit(sp.record(holder=sp.sender, amount=amount), tag="USD_WITHDRAWN")
+
+        # Increase Position
+        @sp.entrypoint
+        def increasePosition(
+            self, position_holder, direction, usd_amount, leverage_multiple
+        ):
+            sp.cast(position_holder, sp.address)
+            sp.cast(direction, sp.int)
+            sp.cast(usd_amount, sp.int)
+            sp.cast(leverage_multiple, sp.int)
+
+            self._checkStatus(1)
+            self._isPositionManager()
+            assert direction == sp.int(1) or direction == sp.int(2), "INVALID_DIRECTION"
+            assert usd_amount >= sp.int(0) * self.data.decimal, "INVALID_USD_AMOUNT"
+            assert (
+                leverage_multiple >= sp.int(0) * self.data.decimal
+            ), "INVALID_LEVERAGE_AMOUNT"
+
+            self.updateIndexPrice()
+            self._debitBalance(
+                sp.record(holder=position_holder, amount=abs(usd_amount))
+            )
+
+            if self.data.positions.contains(position_holder):
+                self.data.positions[position_holder] = self._settledPosition(
+                    position_holder
+                )
+            self._increasePosition(
+                sp.record(
+                    position_holder=position_holder,
+                    direction=direction,
+                    usd_amount=usd_amount,
+                    leverage_multiple=leverage_multiple,
+                )
+            )
+
+        # Increase several positions at one clearing price. Only the net notional
+        # of the longs and shorts trades against the reserves. With
+        # match_at_mark, the notional the two sides match is booked at the
+        # mark price instead and only the net gets the curve's price.
+        @sp.entrypoint
+        def increasePositions(self, fills, match_at_mark):
+            sp.cast(fills, sp.list[vmm_types.position_fill_type])
+            sp.cast(match_at_mark, sp.bool)
+
+            self._checkStatus(1)
+            self._isPositionManager()
+            self.updateIndexPrice()
+
+            long_notional = sp.int(0)
+            short_notional = sp.int(0)
+            fees = sp.int(0)
+            for fill in fills:
+                assert (fill.direction == 1) or (
+                    fill.direction == 2
+                ), "INVALID_DIRECTION"
+                assert fill.usd_amount >= 0, "INVALID_USD_AMOUNT"
+                assert fill.leverage_multiple >= 0, "INVALID_LEVERAGE_AMOUNT"
+                self._debitBalance(
+                    sp.record(holder=fill.position_holder, amount=abs(fill.usd_amount))
+                )
+                net_usd_amount = (
+                    fill.usd_amount
+                    - (fill.usd_amount * self.data.transaction_fees) / 100
+                )
+                fees += fill.usd_amount - net_usd_amount
+                if fill.direction == 1:
+                    long_notional += sp.mul(net_usd_amount, fill.leverage_multiple)
+                else:
+                    short_notional += sp.mul(net_usd_amount, fill.leverage_multiple)
+
+            # Every fill gets the average price of the net trade, or the mark
+            # price when longs and shorts cancel out
+            net_notional = long_notional - short_notional
+            mark_price = self.data.current_mark_price
+            clearing_price = mark_price
+            if net_notional != 0:
+                token_amount = (
+                    self.data.vmm.invariant
+                    * self.data.decimal
+                    / (self.data.vmm.usd_amount + net_notional)
+                )
+                if token_amount != self.data.vmm.token_amount:
+                    clearing_price = sp.to_int(
+                        abs(net_notional)
+                        * abs(self.data.decimal)
+                        / abs(token_amount - self.data.vmm.token_amount)
+                    )
+                self.data.vmm.usd_amount += net_notional
+                self.data.vmm.token_amount = token_amount
+            long_price = clearing_price
+            short_price = clearing_price
+            if match_at_mark and (net_notional != 0):
+                # The notional matched between both sides is booked at the
+                # pre-trade mark price. The smaller side gets the mark, the
+                # larger one the blend of the mark and the net trade's price
+                matched_notional = short_notional
+                if net_notional < 0:
+                    matched_notional = long_notional
+                if matched_notional > 0:
+                    tokens = (
+                        matched_notional * self.data.decimal / mark_price
+                        + sp.to_int(abs(net_notional))
+                        * self.data.decimal
+                        / clearing_price
+                    )
+                    if tokens > 0:
+                        blended_price = (
+                            (matched_notional + sp.to_int(abs(net_notional)))
+                            * self.data.decimal
+                            / tokens
+                        )
+                        if net_notional > 0:
+                            long_price = blended_price
+                            short_price = mark_price
+                        else:
+                            long_price = mark_price
+                            short_price = blended_price
+
+            filled = sp.cast(
+                [],
+                sp.list[
+                    sp.record(
+                        position_holder=sp.address,
+                        direction=sp.int,
+                        position_value=sp.int,
+                    )
+                ],
+            )
+            for fill in fills:
+                net_usd_amount = (
+                    fill.usd_amount
+                    - (fill.usd_amount * self.data.transaction_fees) / 100
+                )
+                notional = sp.mul(net_usd_amount, fill.leverage_multiple)
+                fill_price = long_price
+                if fill.direction == 2:
+                    fill_price = short_price
+                position_value = notional * self.data.decimal / fill_price
+                if self.data.positions.contains(fill.position_holder):
+                    assert (
+                        self.data.positions[fill.position_holder].position
+                        == fill.direction
+                    ), "INVALID_POSITION"
+                    position = self._settledPosition(fill.position_holder)
+                    position.entry_price = (position.entry_price + fill_price) / 2
+                    position.position_value += position_value
+                    position.collateral_amount += net_usd_amount
+                    position.usd_amount += notional
+                    self.data.positions[fill.position_holder] = position
+                else:
+                    funding_index = self.data.long_funding_index
+                    if fill.direction == 2:
+                        funding_index = self.data.short_funding_index
+                    self.data.positions[fill.position_holder] = sp.record(
+                        position=fill.direction,
+                        entry_price=fill_price,
+                        funding_amount=sp.int(0),
+                        position_value=position_value,
+                        collateral_amount=net_usd_amount,
+                        usd_amount=notional,
+                        funding_index=funding_index,
+                    )
+                if fill.direction == 1:
+                    self.data.total_long += position_value
+                else:
+                    self.data.total_short += position_value
+                filled.push(
+                    sp.record(
+                        position_holder=fill.position_holder,
+                        direction=fill.direction,
+                        position_value=position_value,
+                    )
+                )
+
+            self.data.accrued_fees += abs(fees)
+
+            self.data.current_mark_price = (
+                self.data.vmm.usd_amount * self.data.decimal
+            ) / self.data.vmm.token_amount
+            sp.emit(
+                sp.record(
+                    long_price=long_price,
+                    short_price=short_price,
+                    long_notional=long_notional,
+                    short_notional=short_notional,
+                    fills=filled,
+                ),
+                tag="POSITIONS_INCREASED",
+            )
+
+        # Decrease Position
+        @sp.entrypoint
+        def decreasePosition(self, position_holder, usd_amount, leverage_multiple):
+            sp.cast(position_holder, sp.address)
+            sp.cast(leverage_multiple, sp.int)
+            sp.cast(usd_amount, sp.int)
+            self._checkStatus(1)
+            self._isPositionManager()
+            assert self.data.positions.contains(position_holder), "POSITION_NOT_FOUND"
+            assert leverage_multiple > 0, "LEVERAGE_MULTIPLE_INVALID"
+            assert usd_amount > 0, "POSITION_AMOUNT_INVALID"
+            self.updateIndexPrice()
+            self.data.positions[position_holder] = self._settledPosition(
+                position_holder
+            )
+            credit = self._decreasePosition(
+                sp.record(
+                    position_holder=position_holder,
+                    usd_amount=usd_amount,
+                    leverage_multiple=leverage_multiple,
+                )
+            )
+            self._creditBalance(sp.record(holder=position_holder, amount=credit))
+
+        # Close Position
+        @sp.entrypoint
+        def closePosition(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            assert self.data.status == 1 or self.data.status == 2, "InvalidStatus"
+            assert self.data.positions.contains(position_holder), "InvalidPosition"
+            self._isPositionManager()
+            self.updateIndexPrice()
+            self.data.positions[position_holder] = self._settledPosition(
+                position_holder
+            )
+            self._creditBalance(
+                sp.record(
+                    holder=position_holder, amount=self._closePosition(position_holder)
+                )
+            )
+
+        # Add Margin
+        @sp.entrypoint
+        def addMargin(self, position_holder, amount):
+            sp.cast(amount, sp.int)
+            sp.cast(position_holder, sp.address)
+            self._checkStatus(1)
+            self._isPositionManager()
+            self.updateIndexPrice()
+            self.data.positions[position_holder] = self._settledPosition(
+                position_holder
+            )
+            self._debitBalance(sp.record(holder=position_holder, amount=abs(amount)))
+            self._addMargin(sp.record(position_holder=position_holder, amount=amount))
+
+        # Remove Margin
+        @sp.entrypoint
+        def removeMargin(self, position_holder, amount):
+            sp.cast(amount, sp.int)
+            sp.cast(position_holder, sp.address)
+            self._checkStatus(1)
+            self._isPositionManager()
+            self.updateIndexPrice()
+            self.data.positions[position_holder] = self._settledPosition(
+                position_holder
+            )
+            credit = self._removeMargin(
+                sp.record(position_holder=position_holder, amount=amount)
+            )
+            self._creditBalance(sp.record(holder=position_holder, amount=credit))
+
+        # Run several position actions in order, checking the position manager
+        # and refreshing the index price once for all of them
+        @sp.entrypoint
+        def multicall(self, actions):
+            sp.cast(actions, sp.list[vmm_types.position_action_type])
+            self._isPositionManager()
+            self.updateIndexPrice()
+            for action in actions:
+                match action:
+                    case increasePosition(params):
+                        self._checkStatus(1)
+                        assert (params.direction == 1) or (
+                            params.direction == 2
+                        ), "INVALID_DIRECTION"
+                        assert params.usd_amount >= 0, "INVALID_USD_AMOUNT"
+                        assert params.leverage_multiple >= 0, "INVALID_LEVERAGE_AMOUNT"
+                        self._debitBalance(
+                            sp.record(
+                                holder=params.position_holder,
+                                amount=abs(params.usd_amount),
+                            )
+                        )
+                        if self.data.positions.contains(params.position_holder):
+                            self.data.positions[params.position_holder] = (
+                                self._settledPosition(params.position_holder)
+                            )
+                        self._increasePosition(params)
+                    case decreasePosition(params):
+                        self._checkStatus(1)
+                        assert self.data.positions.contains(
+                            params.position_holder
+                        ), "POSITION_NOT_FOUND"
+                        assert params.leverage_multiple > 0, "LEVERAGE_MULTIPLE_INVALID"
+                        assert params.usd_amount > 0, "POSITION_AMOUNT_INVALID"
+                        self.data.positions[params.position_holder] = (
+                            self._settledPosition(params.position_holder)
+                        )
+                        credit = self._decreasePosition(params)
+                        self._creditBalance(
+                            sp.record(holder=params.position_holder, amount=credit)
+                        )
+                    case closePosition(position_holder):
+                        assert (self.data.status == 1) or (
+                            self.data.status == 2
+                        ), "InvalidStatus"
+                        assert self.data.positions.contains(
+                            position_holder
+                        ), "InvalidPosition"
+                        self.data.positions[position_holder] = self._settledPosition(
+                            position_holder
+                        )
+                        credit = self._closePosition(position_holder)
+                        self._creditBalance(
+                            sp.record(holder=position_holder, amount=credit)
+                        )
+                    case addMargin(params):
+                        self._checkStatus(1)
+                        self.data.positions[params.position_holder] = (
+                            self._settledPosition(params.position_holder)
+                        )
+                        self._debitBalance(
+                            sp.record(
+                                holder=params.position_holder, amount=abs(params.amount)
+                            )
+                        )
+                        self._addMargin(params)
+                    case removeMargin(params):
+                        self._checkStatus(1)
+                        self.data.positions[params.position_holder] = (
+                            self._settledPosition(params.position_holder)
+                        )
+                        credit = self._removeMargin(params)
+                        self._creditBalance(
+                            sp.record(holder=params.position_holder, amount=credit)
+                        )
+
+        # Liquidate
+        @sp.entrypoint
+        def liquidate(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            self._checkStatus(1)
+            self._isPositionManager()
+            self.updateIndexPrice()
+            assert self.data.positions.contains(position_holder), "POSITION_NOT_FOUND"
+            payout = self._liquidatePosition(position_holder).unwrap_some(
+                error="MARIGN_RATIO_GREATER"
+            )
+            self.data.current_mark_price = (
+                self.data.vmm.usd_amount * self.data.decimal
+            ) / self.data.vmm.token_amount
+            self._creditBalance(sp.record(holder=payout.receiver, amount=payout.reward))
+            self.data.accrued_fees += payout.fee
+
+        # Liquidate Batch
+        @sp.entrypoint
+        def liquidateBatch(self, position_holders):
+            sp.cast(position_holders, sp.list[sp.address])
+            self._checkStatus(1)
+            self._isPositionManager()
+            self.updateIndexPrice()
+            liquidated = sp.nat(0)
+            rewards = sp.nat(0)
+            fees = sp.nat(0)
+            # Holders closed or healthy by now are skipped instead of failing
+            for position_holder in position_holders:
+                outcome = self._liquidatePosition(position_holder)
+                if outcome.is_some():
+                    payout = outcome.unwrap_some()
+                    if payout.receiver == sp.sender:
+                        rewards += payout.reward
+                    else:
+                        self._creditBalance(
+                            sp.record(holder=payout.receiver, amount=payout.reward)
+                        )
+                    fees += payout.fee
+                    liquidated += 1
+            if liquidated > 0:
+                self.data.current_mark_price = (
+                    self.data.vmm.usd_amount * self.data.decimal
+                ) / self.data.vmm.token_amount
+                self._creditBalance(sp.record(holder=sp.sender, amount=rewards))
+                self.data.accrued_fees += fees
+            sp.emit(
+                sp.record(
+                    liquidator=sp.sender,
+                    liquidated=liquidated,
+                    rewards=rewards,
+                    fees=fees,
+                ),
+                tag="POSITIONS_LIQUIDATED",
+            )
+
+        # Take Profit
+        @sp.entrypoint
+        def takeProfit(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            self._checkStatus(1)
+            self._isPositionManager()
+            self.updateIndexPrice()
+            self.data.positions[position_holder] = self._settledPosition(
+                position_holder
+            )
+            self._debitBalance(
+                sp.record(
+                    holder=position_holder,
+                    amount=abs(self.data.positions[position_holder].funding_amount),
+                )
+            )
+            self.data.positions[position_holder].funding_amount = sp.int(0)
+
+        # Place a conditional order for position_holder. Limit orders escrow
+        # usd_amount from the holder's balance, stop-loss and take-profit orders
+        # close the holder's current position in direction.
+        @sp.entrypoint
+        def placeConditionalOrder(
+            self,
+            position_holder,
+            kind,
+            direction,
+            trigger_price,
+            usd_amount,
+            leverage_multiple,
+            expiration,
+        ):
+            sp.cast(position_holder, sp.address)
+            sp.cast(kind, sp.int)
+            sp.cast(direction, sp.int)
+            sp.cast(trigger_price, sp.int)
+            sp.cast(usd_amount, sp.int)
+            sp.cast(leverage_multiple, sp.int)
+            sp.cast(expiration, sp.int)
+            self._checkStatus(1)
+            self._isPositionManager()
+            assert self.data.conditional_orders_enabled, "ConditionalOrdersDisabled"
+            assert (kind >= 0) and (kind <= 2), "InvalidOrderKind"
+            assert direction == 1 or direction == 2, "INVALID_DIRECTION"
+            assert trigger_price > 0, "InvalidTriggerPrice"
+            assert not order_expired(expiration), "OrderExpired"
+            order_count = self.data.conditional_order_counts.get(
+                position_holder, default=0
+            )
+            assert order_count < self.data.max_conditional_orders, "TooManyOrders"
+            if kind == 0:
+                assert usd_amount > 0, "INVALID_USD_AMOUNT"
+                assert leverage_multiple >= 0, "INVALID_LEVERAGE_AMOUNT"
+                self._debitBalance(
+                    sp.record(holder=position_holder, amount=abs(usd_amount))
+                )
+            else:
+                assert self.data.positions.contains(position_holder), "InvalidPosition"
+                assert (
+                    self.data.positions[position_holder].position == direction
+                ), "InvalidPosition"
+            self.data.conditional_order_counts[position_holder] = order_count + 1
+            order = sp.record(
+                position_holder=position_holder,
+                kind=kind,
+                direction=direction,
+                trigger_price=trigger_price,
+                usd_amount=usd_amount,
+                leverage_multiple=leverage_multiple,
+                expiration=expiration,
+                position_nonce=self.data.position_nonces.get(
+                    position_holder, default=0
+                ),
+            )
+            self.data.conditional_orders[self.data.last_conditional_order_id] = order
+            sp.emit(
+                sp.record(order_id=self.data.last_conditional_order_id, order=order),
+                tag="CONDITIONAL_ORDER_PLACED",
+            )
+            self.data.last_conditional_order_id += 1
+
+        # Cancel a conditional order of position_holder and refund the escrow of a
+        # limit order
+        @sp.entrypoint
+        def cancelConditionalOrder(self, position_holder, order_id):
+            sp.cast(position_holder, sp.address)
+            sp.cast(order_id, sp.int)
+            self._isPositionManager()
+            assert self.data.conditional_orders.contains(order_id), "InvalidOrderId"
+            order = self.data.conditional_orders[order_id]
+            assert order.position_holder == position_holder, "InvalidPositionHolder"
+            self.data.conditional_order_counts[position_holder] = sp.as_nat(
+                self.data.conditional_order_counts[position_holder] - 1
+            )
+            if order.kind == 0:
+                self._creditBalance(
+                    sp.record(
+                        holder=order.position_holder, amount=abs(order.usd_amount)
+                    )
+                )
+            del self.data.conditional_orders[order_id]
+            sp.emit(order_id, tag="CONDITIONAL_ORDER_CANCELED")
+
+        # Execute the triggered conditional orders against the reserves. Orders
+        # that are not triggered yet stay, the others are executed or dropped and
+        # every order gets an outcome in CONDITIONAL_ORDERS_TRIGGERED. Stop-loss
+        # and take-profit orders whose position has since closed are dropped as
+        # PositionClosed.
+        @sp.entrypoint
+        def triggerConditionalOrders(self, order_ids):
+            sp.cast(order_ids, sp.list[sp.int])
+            self._checkStatus(1)
+            self.updateIndexPrice()
+            outcomes = sp.cast([], sp.list[vmm_types.order_outcome_type])
+            for order_id in order_ids:
+                outcome = "InvalidOrderId"
+                if self.data.conditional_orders.contains(order_id):
+                    order = self.data.conditional_orders[order_id]
+                    mark_price = self.data.current_mark_price
+                    has_position = self.data.positions.contains(order.position_holder)
+                    outcome = "Expired"
+                    if (order.kind != 0) and (
+                        order.position_nonce
+                        != self.data.position_nonces.get(
+                            order.position_holder, default=0
+                        )
+                    ):
+                        outcome = "PositionClosed"
+                    if (outcome == "Expired") and (not order_expired(order.expiration)):
+                        # Limit and stop-loss orders trigger when the price moves
+                        # against the direction, take-profit orders when it moves
+                        # with it
+                        triggered = (
+                            (order.direction == 1)
+                            and (mark_price <= order.trigger_price)
+                        ) or (
+                            (order.direction == 2)
+                            and (mark_price >= order.trigger_price)
+                        )
+                        if order.kind == 2:
+                            triggered = (
+                                (order.direction == 1)
+                                and (mark_price >= order.trigger_price)
+                            ) or (
+                                (order.direction == 2)
+                                and (mark_price <= order.trigger_price)
+                            )
+                        outcome = "NotTriggered"
+                        if triggered:
+                            outcome = "Executed"
+                            if has_position:
+                                if (
+                                    self.data.positions[order.position_holder].position
+                                    != order.direction
+                                ):
+                                    outcome = "InvalidPosition"
+                            else:
+                                if order.kind != 0:
+                                    outcome = "InvalidPosition"
+                    if outcome == "Executed":
+                        if has_position:
+                            self.data.positions[order.position_holder] = (
+                                self._settledPosition(order.position_holder)
+                            )
+                        if order.kind == 0:
+                            self._increasePosition(
+                                sp.record(
+                                    position_holder=order.position_holder,
+                                    direction=order.direction,
+                                    usd_amount=order.usd_amount,
+                                    leverage_multiple=order.leverage_multiple,
+                                )
+                            )
+                        else:
+                            self._creditBalance(
+                                sp.record(
+                                    holder=order.position_holder,
+                                    amount=self._closePosition(order.position_holder),
+                                )
+                            )
+                    if outcome != "NotTriggered":
+                        if (outcome != "Executed") and (order.kind == 0):
+                            self._creditBalance(
+                                sp.record(
+                                    holder=order.position_holder,
+                                    amount=abs(order.usd_amount),
+                                )
+                            )
+                        self.data.conditional_order_counts[order.position_holder] = (
+                            sp.as_nat(
+                                self.data.conditional_order_counts[
+                                    order.position_holder
+                                ]
+                                - 1
+                            )
+                        )
+                        del self.data.conditional_orders[order_id]
+                outcomes.push(sp.record(order_id=order_id, outcome=outcome))
+            sp.emit(outcomes, tag="CONDITIONAL_ORDERS_TRIGGERED")
+
+        # Views
+
+        # Get Position View
+        @sp.onchain_view()
+        def getPositionData(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            return self._settledPosition(position_holder)
+
+        # Get Balance View
+        @sp.onchain_view()
+        def getBalance(self, holder):
+            sp.cast(holder, sp.address)
+            return self.data.balances.get(holder, default=0)
+
+        # Get Balances View
+        @sp.onchain_view()
+        def getBalances(self, holders):
+            sp.cast(holders, sp.list[sp.address])
+            balances = sp.cast({}, sp.map[sp.address, sp.nat])
+            for holder in holders:
+                balances[holder] = self.data.balances.get(holder, default=0)
+            return balances
+
+        # Get Positions Data View, None for holders without a position
+        @sp.onchain_view()
+        def getPositionsData(self, position_holders):
+            sp.cast(position_holders, sp.list[sp.address])
+            positions = sp.cast(
+                {}, sp.map[sp.address, sp.option[vmm_types.positions_value]]
+            )
+            for position_holder in position_holders:
+                if self.data.positions.contains(position_holder):
+                    positions[position_holder] = sp.Some(
+                        self._settledPosition(position_holder)
+                    )
+                else:
+                    positions[position_holder] = None
+            return positions
+
+        # Get Position Health View
+        @sp.onchain_view()
+        def getPositionHealth(self, position_holders):
+            sp.cast(position_holders, sp.list[sp.address])
+            health = sp.cast({}, sp.map[sp.address, vmm_types.position_health_type])
+            for position_holder in position_holders:
+                if self.data.positions.contains(position_holder):
+                    health[position_holder] = position_health(
+                        sp.record(
+                            position=self._settledPosition(position_holder),
+                            vmm=self.data.vmm,
+                            decimal=self.data.decimal,
+                        )
+                    )
+            return health
+
+        # Get Quote View, what increasePosition would execute at
+        @sp.onchain_view()
+        def getQuote(self, direction, usd_amount, leverage_multiple):
+            sp.cast(direction, sp.int)
+            sp.cast(usd_amount, sp.int)
+            sp.cast(leverage_multiple, sp.int)
+            assert direction == sp.int(1) or direction == sp.int(2), "INVALID_DIRECTION"
+            net_usd_amount = (
+                usd_amount - (usd_amount * self.data.transaction_fees) / 100
+            )
+            notional = sp.mul(leverage_multiple, net_usd_amount)
+            k = self.data.vmm.invariant * self.data.decimal
+            position_value = sp.int(0)
+            usd_after = self.data.vmm.usd_amount
+            token_after = self.data.vmm.token_amount
+            if direction == 1:
+                position_value = sp.to_int(
+                    abs(k / (self.data.vmm.usd_amount + notional) - token_after)
+                )
+                usd_after += notional
+                token_after = token_after - position_value
+            else:
+                position_value = k / (self.data.vmm.usd_amount - notional) - token_after
+                usd_after = usd_after - notional
+                token_after += position_value
+            execution_price = sp.int(0)
+            if position_value != 0:
+                execution_price = notional * self.data.decimal / position_value
+            return sp.cast(
+                sp.record(
+                    fee=abs(usd_amount - net_usd_amount),
+                    net_usd_amount=net_usd_amount,
+                    position_value=position_value,
+                    execution_price=execution_price,
+                    mark_price_after=usd_after * self.data.decimal / token_after,
+                ),
+                vmm_types.quote_type,
+            )
+
+        # Get Close Quote View, what closePosition would pay out
+        @sp.onchain_view()
+        def getCloseQuote(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            position = self._settledPosition(position_holder)
+            position_value = closing_value(
+                sp.record(
+                    position=position, vmm=self.data.vmm, decimal=self.data.decimal
+                )
+            )
+            pnl = position_value - position.usd_amount
+            usd_after = self.data.vmm.usd_amount - position_value
+            token_after = self.data.vmm.token_amount + position.position_value
+            if position.position == 2:
+                pnl = position.usd_amount - position_value
+                usd_after = self.data.vmm.usd_amount + position_value
+                token_after = self.data.vmm.token_amount - position.position_value
+            return sp.cast(
+                sp.record(
+                    position_value=position_value,
+                    pnl=pnl,
+                    payout=abs(position.collateral_amount + pnl),
+                    mark_price_after=usd_after * self.data.decimal / token_after,
+                ),
+                vmm_types.close_quote_type,
+            )
+
+        # Get Market State View
+        @sp.onchain_view()
+        def getMarketState(self):
+            return sp.cast(
+                sp.record(
+                    vmm=self.data.vmm,
+                    index_price=self.data.current_index_price,
+                    mark_price=self.data.current_mark_price,
+                    long_funding_rate=self.data.long_funding_rate,
+                    short_funding_rate=self.data.short_funding_rate,
+                    long_funding_index=self.data.long_funding_index,
+                    short_funding_index=self.data.short_funding_index,
+                    total_long=self.data.total_long,
+                    total_short=self.data.total_short,
+                    status=self.data.status,
+                    transaction_fees=self.data.transaction_fees,
+                    accrued_fees=self.data.accrued_fees,
+                    funding_period=self.data.funding_period,
+                    previous_funding_time=self.data.previous_funding_time,
+                    upcoming_funding_time=self.data.upcoming_funding_time,
+                ),
+                vmm_types.market_state_type,
+            )
+
+        # Get VMM View
+        @sp.onchain_view()
+        def getVmmData(self):
+            return self.data.vmm
+
+        # Get Index and Mark Price View
+        @sp.onchain_view()
+        def getIndexAndMarkPrice(self):
+            return sp.record(
+                index_price=self.data.current_index_price,
+                mark_price=self.data.current_mark_price,
+            )
+
+        # Get Funding Rate View
+        @sp.onchain_view()
+        def getFundingRate(self):
+            return sp.record(
+                long_funding_rate=self.data.long_funding_rate,
+                short_funding_rate=self.data.short_funding_rate,
+            )
+
+        # Get Conditional Order View
+        @sp.onchain_view()
+        def getConditionalOrder(self, order_id):
+            sp.cast(order_id, sp.int)
+            assert self.data.conditional_orders.contains(order_id), "InvalidOrderId"
+            return self.data.conditional_orders[order_id]
+
+        # Get Price Cumulative View, accrued to now
+        @sp.onchain_view()
+        def getPriceCumulative(self):
+            return helpers.accrue_prices(
+                sp.record(
+                    cumulative=self.data.price_cumulative,
+                    mark_price=self.data.current_mark_price,
+                    index_price=self.data.current_index_price,
+                )
+            )
+
+        # Get TWAP View, between two price checkpoints or from one until now
+        @sp.onchain_view()
+        def getTwap(self, start, end):
+            sp.cast(start, sp.nat)
+            sp.cast(end, sp.option[sp.nat])
+            assert self.data.price_checkpoints.contains(start), "InvalidCheckpoint"
+            end_cumulative = helpers.accrue_prices(
+                sp.record(
+                    cumulative=self.data.price_cumulative,
+                    mark_price=self.data.current_mark_price,
+                    index_price=self.data.current_index_price,
+                )
+            )
+            if end.is_some():
+                assert self.data.price_checkpoints.contains(
+                    end.unwrap_some()
+                ), "InvalidCheckpoint"
+                end_cumulative = self.data.price_checkpoints[end.unwrap_some()]
+            return helpers.twap(
+                sp.record(start=self.data.price_checkpoints[start], end=end_cumulative)
             )
 
         #  Get Funding Period Data View
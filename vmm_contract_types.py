@@ -18,6 +18,90 @@ def vmm_types():
         position_value=sp.int,
         collateral_amount=sp.int,
         usd_amount=sp.int,
+        funding_index=sp.int,
+    )
+
+    position_health_type: type = sp.record(
+        pnl=sp.int,
+        margin_ratio=sp.int,
+        liquidation_price=sp.nat,
+        liquidatable=sp.bool,
+    )
+
+    funding_rate_type: type = sp.record(value=sp.int, direction=sp.string)
+
+    market_state_type: type = sp.record(
+        vmm=sp.record(token_amount=sp.int, usd_amount=sp.int, invariant=sp.int),
+        index_price=sp.int,
+        mark_price=sp.int,
+        long_funding_rate=funding_rate_type,
+        short_funding_rate=funding_rate_type,
+        long_funding_index=sp.int,
+        short_funding_index=sp.int,
+        total_long=sp.int,
+        total_short=sp.int,
+        status=sp.int,
+        transaction_fees=sp.int,
+        accrued_fees=sp.nat,
+        funding_period=sp.int,
+        previous_funding_time=sp.timestamp,
+        upcoming_funding_time=sp.timestamp,
+    )
+
+    quote_type: type = sp.record(
+        fee=sp.nat,
+        net_usd_amount=sp.int,
+        position_value=sp.int,
+        execution_price=sp.int,
+        mark_price_after=sp.int,
+    )
+
+    close_quote_type: type = sp.record(
+        position_value=sp.int,
+        pnl=sp.int,
+        payout=sp.nat,
+        mark_price_after=sp.int,
+    )
+
+    position_fill_type: type = sp.record(
+        position_holder=sp.address,
+        direction=sp.int,
+        usd_amount=sp.int,
+        leverage_multiple=sp.int,
+    )
+
+    position_action_type: type = sp.variant(
+        increasePosition=position_fill_type,
+        decreasePosition=sp.record(
+            position_holder=sp.address,
+            usd_amount=sp.int,
+            leverage_multiple=sp.int,
+        ),
+        closePosition=sp.address,
+        addMargin=sp.record(position_holder=sp.address, amount=sp.int),
+        removeMargin=sp.record(position_holder=sp.address, amount=sp.int),
+    )
+
+    conditional_order_type: type = sp.record(
+        position_holder=sp.address,
+        kind=sp.int,  # 0: Limit, 1: Stop Loss, 2: Take Profit
+        direction=sp.int,
+        trigger_price=sp.int,
+        usd_amount=sp.int,  # Escrowed from the holder's balance for limit orders
+        leverage_multiple=sp.int,
+        expiration=sp.int,
+        # Closed positions of the holder when a stop-loss or take-profit was placed
+        position_nonce=sp.nat,
+    )
+
+    migrated_position_type: type = sp.record(
+        position_holder=sp.address,
+        position=sp.int,
+        entry_price=sp.int,
+        funding_amount=sp.int,
+        position_value=sp.int,
+        collateral_amount=sp.int,
+        usd_amount=sp.int,
     )
 
     pending_positions_type: type = sp.map[
@@ -58,3 +142,49 @@ def vmm_types():
         expiration=sp.int,
         order_status=sp.int,  # 0: pending, 1: active, 2: canceled
     )
+
+    order_leg_type: type = sp.record(
+        trigger_price=sp.int,
+        limit_price=sp.option[sp.int],
+    )
+
+    # Storage layout of a create_order_type
+    stored_order_type: type = sp.record(
+        position_holder=sp.address,
+        market_id=sp.nat,
+        flags=sp.nat,  # order_type + 4 * direction + 16 * order_status
+        trigger_price=sp.int,
+        limit_price=sp.int,
+        amount_in=sp.int,
+        leverage_multiple=sp.int,
+        stop_leg=sp.option[order_leg_type],
+        take_leg=sp.option[order_leg_type],
+        expiration=sp.int,
+    )
+
+    order_outcome_type: type = sp.record(
+        order_id=sp.int,
+        outcome=sp.string,
+    )
+
+    trigger_key_type: type = sp.record(
+        vmm_address=sp.address,
+        direction=sp.int,
+        kind=sp.int,  # 0: Limit, 1: Stop Loss, 2: Take Profit
+    )
+
+    trigger_bucket_type: type = sp.record(
+        vmm_address=sp.address,
+        direction=sp.int,
+        kind=sp.int,
+        bucket=sp.int,
+    )
+
+    trigger_bounds_type: type = sp.record(
+        low=sp.int,
+        high=sp.int,
+        buckets=sp.nat,  # Number of non-empty buckets between low and high
+    )
+
+    # Next bucket to scan for each direction and kind of a market
+    trigger_cursor_type: type = sp.map[sp.record(direction=sp.int, kind=sp.int), sp.int]
@@ -0,0 +1,238 @@
+"""Liquidation keeper for vmm.VMM.
+
+The keeper consumes the events emitted by the contract, keeps every open
+position in an index ordered by liquidation mark price and, when the mark
+price moves, only checks the positions whose liquidation price was crossed
+before submitting them in one ``liquidateBatch`` call.
+
+Chain access goes through a *source* object:
+
+* ``position(holder)``: the settled position (``getPositionData``) or None,
+* ``position_holders()``: every open position holder (used after events that
+  do not name a holder, e.g. ``POSITIONS_MIGRATED``),
+* ``market()``: an object with ``token_amount``, ``usd_amount``,
+  ``invariant``, ``decimal``, ``current_mark_price`` and both funding
+  indexes, as in ``vmm_simulation.VmmEngine``,
+* ``liquidate_batch(holders)``: submits the ``liquidateBatch`` operation and
+  returns the holders it liquidated.
+
+``EngineSource`` implements it on top of a ``VmmEngine``, which stands in for
+the chain in tests; an adapter for a node only has to provide the same four
+methods.
+"""
+
+import bisect
+import math
+
+import vmm_risk
+from vmm_simulation import LONG, VmmError
+
+# Events after which only the named position has to be re-read
+POSITION_EVENTS = frozenset(
+    (
+        "LONG_POSITION_OPENED",
+        "LONG_POSITION_INCREASED",
+        "LONG_POSITION_DECREASED",
+        "LONG_POSITION_CLOSED",
+        "SHORT_POSITION_OPENED",
+        "SHORT_POSITION_INCREASED",
+        "SHORT_POSITION_DECREASED",
+        "SHORT_POSITION_CLOSED",
+        "MARGIN_ADDED",
+        "MARGIN_REMOVED",
+        "POSITION_LIQUIDATED",
+    )
+)
+
+# Events naming the positions they touched in a ``fills`` list
+FILL_EVENTS = frozenset(("POSITIONS_INCREASED",))
+
+# Events that move every liquidation price
+MARKET_EVENTS = frozenset(
+    ("VMM_CONFIGURED", "FUNDING_DISTRIBUTED", "POSITIONS_MIGRATED")
+)
+
+
+def liquidation_mark_price(position, invariant, decimal):
+    """Mark price at which ``liquidate`` starts accepting the position.
+
+    On the constant product curve ``usd_amount * token_amount`` stays at
+    ``invariant * decimal``, so the margin ratio of ``liquidate`` can be
+    solved for the USD reserve and turned into a mark price. Rounding in the
+    contract moves the real threshold by a few units, which the keeper
+    absorbs with its tolerance before running the exact check.
+    """
+    k = invariant * decimal
+    pv = position.position_value
+    threshold = (85 * decimal) // 1000
+    if pv <= 0 or k <= 0:
+        return 0
+    if position.position == LONG:
+        # Closing value pv * u^2 / (k + pv * u) must fall below target
+        target = (
+            position.usd_amount * (decimal + threshold)
+        ) // decimal - position.collateral_amount
+        if target <= 0:
+            return 0
+        root = math.isqrt(target * target * pv * pv + 4 * pv * target * k)
+        usd_reserve = (target * pv + root) // (2 * pv)
+    else:
+        # Closing value pv * u^2 / (k - pv * u) must rise above target
+        target = (
+            position.usd_amount * (decimal - threshold)
+        ) // decimal + position.collateral_amount
+        if target <= 0:
+            return 0
+        root = math.isqrt(target * target * pv * pv + 4 * pv * target * k)
+        usd_reserve = (root - target * pv) // (2 * pv)
+    return (usd_reserve * usd_reserve * decimal) // k
+
+
+class EngineSource:
+    """Keeper source backed by a ``VmmEngine`` standing in for the chain.
+
+    It turns on the engine's event recording and drains the recorded events
+    on every poll.
+    """
+
+    def __init__(self, engine, liquidator="keeper"):
+        self.engine = engine
+        self.engine.record_events = True
+        self.liquidator = liquidator
+
+    def poll_events(self):
+        events = list(self.engine.events)
+        self.engine.events.clear()
+        return events
+
+    def position(self, holder):
+        if holder not in self.engine.positions:
+            return None
+        return self.engine.settled_position(holder)
+
+    def position_holders(self):
+        return list(self.engine.positions)
+
+    def market(self):
+        return self.engine
+
+    def liquidate_batch(self, holders):
+        return self.engine.liquidate_batch(holders, self.liquidator)
+
+
+class LiquidationKeeper:
+    """Incremental at-risk index over the positions of one market.
+
+    Longs are liquidatable once the mark falls to their liquidation price and
+    shorts once it rises to it, so each side is kept as a sorted list of
+    ``(price, holder)`` and a mark price change only visits the prefix or
+    suffix it crossed. ``tolerance`` (in 1/10000 of the mark) widens that
+    range to cover rounding; candidates are confirmed with the contract's
+    exact arithmetic before being submitted.
+    """
+
+    def __init__(self, source, tolerance=10):
+        self.source = source
+        self.tolerance = tolerance
+        self.prices = {}
+        self.longs = []
+        self.shorts = []
+        self.dirty = set()
+        self.full_refresh = True
+        self.last_mark_price = None
+        self.submitted = []
+        self.failed = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def ingest(self, events):
+        """Mark the positions touched by ``(tag, payload)`` events as stale."""
+        for tag, payload in events:
+            if tag in POSITION_EVENTS:
+                self.dirty.add(payload["position_holder"])
+            if tag in FILL_EVENTS:
+                for fill in payload["fills"]:
+                    self.dirty.add(fill["position_holder"])
+            if tag in MARKET_EVENTS:
+                self.full_refresh = True
+
+    def _remove(self, holder):
+        entry = self.prices.pop(holder, None)
+        if entry is None:
+            return
+        side, price = entry
+        book = self.longs if side == LONG else self.shorts
+        del book[bisect.bisect_left(book, (price, holder))]
+
+    def _insert(self, holder, position, market):
+        price = liquidation_mark_price(position, market.invariant, market.decimal)
+        self.prices[holder] = (position.position, price)
+        book = self.longs if position.position == LONG else self.shorts
+        bisect.insort(book, (price, holder))
+
+    def refresh(self):
+        """Re-read the stale positions and re-index them."""
+        market = self.source.market()
+        if self.full_refresh:
+            self.dirty.update(self.prices)
+            self.dirty.update(self.source.position_holders())
+            self.full_refresh = False
+        for holder in self.dirty:
+            self._remove(holder)
+            position = self.source.position(holder)
+            if position is not None:
+                self._insert(holder, position, market)
+        changed = bool(self.dirty)
+        self.dirty.clear()
+        return changed
+
+    def candidates(self, mark_price):
+        """Holders whose liquidation price ``mark_price`` reached or crossed."""
+        band = (mark_price * self.tolerance) // 10000
+        low = bisect.bisect_left(self.longs, (mark_price - band,))
+        high = bisect.bisect_left(self.shorts, (mark_price + band + 1,))
+        return [holder for _, holder in self.longs[low:]] + [
+            holder for _, holder in self.shorts[:high]
+        ]
+
+    def check(self):
+        """Liquidate the crossed positions the contract would accept.
+
+        Returns the submitted holders. Nothing is scanned when neither the
+        mark price nor the index changed since the previous check.
+        """
+        changed = self.refresh()
+        market = self.source.market()
+        mark_price = market.current_mark_price
+        if not changed and mark_price == self.last_mark_price:
+            return []
+        self.last_mark_price = mark_price
+        holders = self.candidates(mark_price)
+        if not holders:
+            return []
+        positions = {}
+        for holder in holders:
+            position = self.source.position(holder)
+            if position is not None:
+                positions[holder] = position
+        columns = vmm_risk.PositionColumns.from_positions(positions)
+        flagged = vmm_risk.liquidatable(columns, market)
+        batch = [h for h, liquidatable in zip(columns.holders, flagged) if liquidatable]
+        if not batch:
+            return []
+        # The contract skips the holders earlier liquidations in the batch
+        # pushed back above the maintenance margin
+        try:
+            submitted = self.source.liquidate_batch(batch)
+        except VmmError as e:
+            self.failed.extend((holder, e.error) for holder in batch)
+            return []
+        self.dirty.update(submitted)
+        self.submitted.extend(submitted)
+        return submitted
+
+    def run(self, events):
+        """Ingest a batch of events, then check the mark price."""
+        self.ingest(events)
+        return self.check()
@@ -0,0 +1,114 @@
+import random
+
+import vmm_risk
+from vmm_keeper import EngineSource, LiquidationKeeper
+from vmm_simulation import LONG, SHORT, VmmEngine, VmmError
+
+
+def open_positions(engine, rng, holders):
+    for i in range(holders):
+        holder = "holder%d" % i
+        direction = rng.choice((LONG, SHORT))
+        usd_amount = rng.randrange(1000000, 200000000)
+        engine.deposit(holder, usd_amount)
+        try:
+            engine.increase_position(
+                holder, direction, usd_amount, rng.randrange(1, 11)
+            )
+        except VmmError:
+            pass
+
+
+def missed_liquidations(engine):
+    columns = vmm_risk.PositionColumns.from_positions(engine.positions)
+    flagged = vmm_risk.liquidatable(columns, engine)
+    return [holder for holder, f in zip(columns.holders, flagged) if f]
+
+
+def run(seed, holders=300, steps=60):
+    rng = random.Random(seed)
+    engine = VmmEngine(record_events=True)
+    engine.update_index_price(8000000)
+    engine.set_vmm(12500000000000)
+    source = EngineSource(engine)
+    keeper = LiquidationKeeper(source)
+    keeper.run(source.poll_events())
+
+    open_positions(engine, rng, holders)
+    while keeper.run(source.poll_events()):
+        pass
+    assert sorted(keeper.prices) == sorted(engine.positions)
+    assert missed_liquidations(engine) == []
+
+    scanned = 0
+    now = 0
+    for step in range(steps):
+        # A whale moves the mark price, margin and funding change in between
+        try:
+            if step % 3 == 0:
+                direction = rng.choice((LONG, SHORT))
+                usd_amount = rng.randrange(100000000000, 1000000000000)
+                engine.deposit("whale%d" % step, usd_amount)
+                engine.increase_position(
+                    "whale%d" % step, direction, usd_amount, rng.randrange(1, 5)
+                )
+            if step % 3 == 1 and engine.positions:
+                holder = rng.choice(list(engine.positions))
+                amount = rng.randrange(1000000, 50000000)
+                engine.deposit(holder, amount)
+                engine.add_margin(holder, amount)
+            if step % 3 == 2:
+                now += engine.funding_period
+                engine.update_index_price(rng.randrange(6000000, 10000000))
+                engine.distribute_funding(now)
+        except VmmError:
+            pass
+        mark_price = engine.current_mark_price
+        scanned += len(keeper.candidates(mark_price))
+        # Liquidations move the mark and may push more positions under water
+        while keeper.run(source.poll_events()):
+            pass
+        assert missed_liquidations(engine) == [], step
+        assert sorted(keeper.prices) == sorted(engine.positions)
+    return len(keeper.submitted), scanned
+
+
+def check_batch_fills(seed, holders=50):
+    """Positions opened through increase_positions reach the index."""
+    rng = random.Random(seed)
+    engine = VmmEngine(record_events=True)
+    engine.update_index_price(8000000)
+    engine.set_vmm(12500000000000)
+    source = EngineSource(engine)
+    keeper = LiquidationKeeper(source)
+    keeper.run(source.poll_events())
+
+    fills = []
+    for i in range(holders):
+        holder = "batch%d" % i
+        usd_amount = rng.randrange(1000000, 200000000)
+        engine.deposit(holder, usd_amount)
+        fills.append((holder, rng.choice((LONG, SHORT)), usd_amount, 10))
+    engine.increase_positions(fills)
+    keeper.run(source.poll_events())
+    assert sorted(keeper.prices) == sorted(engine.positions) != []
+
+    # A whale pushes some of the 10x positions under water
+    engine.deposit("whale", 1000000000000)
+    engine.increase_position("whale", LONG, 1000000000000, 4)
+    while keeper.run(source.poll_events()):
+        pass
+    assert keeper.submitted
+    assert missed_liquidations(engine) == []
+    assert sorted(keeper.prices) == sorted(engine.positions)
+
+
+if __name__ == "__main__":
+    for seed in range(5):
+        check_batch_fills(seed)
+    for seed in range(5):
+        liquidated, scanned = run(seed)
+        print(
+            "seed %d: %d liquidations submitted, %d candidates checked"
+            % (seed, liquidated, scanned)
+        )
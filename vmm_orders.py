@@ -5,6 +5,107 @@ from vmm_contract_types import vmm_types
 
 @sp.module
 def orders():
+    # Trigger prices an order is currently waiting on, by trigger kind
+    def trigger_legs(order):
+        sp.cast(order, vmm_types.create_order_type)
+        legs = sp.cast([], sp.list[sp.record(kind=sp.int, price=sp.int)])
+        if (order.order_status == 0) and (order.order_type == 1):
+            legs.push(sp.record(kind=0, price=order.trigger_price))
+        if order.order_status == 1:
+            if order.stop_trigger_price.is_some():
+                legs.push(
+                    sp.record(kind=1, price=order.stop_trigger_price.unwrap_some())
+                )
+            if (order.direction == 1) and order.take_trigger_price.is_some():
+                legs.push(
+                    sp.record(kind=2, price=order.take_trigger_price.unwrap_some())
+                )
+        return legs
+
+    # Expiration is in seconds since the epoch, 0 for orders that never expire
+    def order_expired(order):
+        sp.cast(order, vmm_types.create_order_type)
+        return (order.expiration != 0) and (
+            sp.add_seconds(sp.timestamp(0), order.expiration) < sp.now
+        )
+
+    # Storage layout of an order, see vmm_types.stored_order_type. A leg keeps
+    # its optional limit price as given and needs a trigger price to have one.
+    def pack_order(params):
+        sp.cast(params, sp.record(order=vmm_types.create_order_type, market_id=sp.nat))
+        order = params.order
+        assert (order.order_type >= 0) and (order.order_type < 4), "InvalidOrderType"
+        assert (order.direction >= 0) and (order.direction < 4), "InvalidDirection"
+        assert order.order_status >= 0, "InvalidOrderStatus"
+        assert (
+            order.stop_trigger_price.is_some() or order.stop_limit_price.is_none()
+        ), "InvalidLimitPrice"
+        assert (
+            order.take_trigger_price.is_some() or order.take_limit_price.is_none()
+        ), "InvalidLimitPrice"
+        stop_leg = sp.cast(None, sp.option[vmm_types.order_leg_type])
+        if order.stop_trigger_price.is_some():
+            stop_leg = sp.Some(
+                sp.record(
+                    trigger_price=order.stop_trigger_price.unwrap_some(),
+                    limit_price=order.stop_limit_price,
+                )
+            )
+        take_leg = sp.cast(None, sp.option[vmm_types.order_leg_type])
+        if order.take_trigger_price.is_some():
+            take_leg = sp.Some(
+                sp.record(
+                    trigger_price=order.take_trigger_price.unwrap_some(),
+                    limit_price=order.take_limit_price,
+                )
+            )
+        return sp.record(
+            position_holder=order.position_holder,
+            market_id=params.market_id,
+            flags=sp.as_nat(order.order_type)
+            + 4 * sp.as_nat(order.direction)
+            + 16 * sp.as_nat(order.order_status),
+            trigger_price=order.trigger_price,
+            limit_price=order.limit_price,
+            amount_in=order.amount_in,
+            leverage_multiple=order.leverage_multiple,
+            stop_leg=stop_leg,
+            take_leg=take_leg,
+            expiration=order.expiration,
+        )
+
+    def unpack_order(params):
+        sp.cast(
+            params, sp.record(order=vmm_types.stored_order_type, vmm_address=sp.address)
+        )
+        order = params.order
+        stop_trigger_price = sp.cast(None, sp.option[sp.int])
+        stop_limit_price = sp.cast(None, sp.option[sp.int])
+        if order.stop_leg.is_some():
+            stop_trigger_price = sp.Some(order.stop_leg.unwrap_some().trigger_price)
+            stop_limit_price = order.stop_leg.unwrap_some().limit_price
+        take_trigger_price = sp.cast(None, sp.option[sp.int])
+        take_limit_price = sp.cast(None, sp.option[sp.int])
+        if order.take_leg.is_some():
+            take_trigger_price = sp.Some(order.take_leg.unwrap_some().trigger_price)
+            take_limit_price = order.take_leg.unwrap_some().limit_price
+        return sp.record(
+            position_holder=order.position_holder,
+            vmm_address=params.vmm_address,
+            order_type=sp.to_int(sp.mod(order.flags, 4)),
+            trigger_price=order.trigger_price,
+            limit_price=order.limit_price,
+            amount_in=order.amount_in,
+            leverage_multiple=order.leverage_multiple,
+            direction=sp.to_int(sp.mod(order.flags / 4, 4)),
+            stop_trigger_price=stop_trigger_price,
+            stop_limit_price=stop_limit_price,
+            take_trigger_price=take_trigger_price,
+            take_limit_price=take_limit_price,
+            expiration=order.expiration,
+            order_status=sp.to_int(order.flags / 16),
+        )
+
     class VmmOrders(sp.Contract):
         def __init__(self, metadata, administrator, fund_manager):
             # Metadata of the contract
@@ -21,16 +122,57 @@ def orders():
             )
             # Orders Bigmap
             self.data.orders = sp.cast(
-                sp.big_map(), sp.big_map[sp.int, vmm_types.create_order_type]
+                sp.big_map(), sp.big_map[sp.int, vmm_types.stored_order_type]
             )
             # Last order id
             self.data.last_order_id = sp.int(0)
+            # Market id of each vmm address used by an order, and back
+            self.data.markets = sp.cast(sp.big_map(), sp.big_map[sp.address, sp.nat])
+            self.data.market_addresses = sp.cast(
+                sp.big_map(), sp.big_map[sp.nat, sp.address]
+            )
+            # Last market id
+            self.data.last_market_id = sp.nat(0)
+            # Pending and active order ids of each position holder
+            self.data.holder_orders = sp.cast(
+                sp.big_map(), sp.big_map[sp.address, sp.set[sp.int]]
+            )
+            # Width of a price bucket in the trigger index
+            self.data.trigger_bucket_size = sp.cast(1_000_000, sp.int)
+            # Bucket width of the markets that do not use trigger_bucket_size
+            self.data.trigger_bucket_sizes = sp.cast(
+                sp.big_map(), sp.big_map[sp.address, sp.int]
+            )
+            # Order ids waiting on a trigger price, by market, direction, kind and price bucket
+            self.data.trigger_index = sp.cast(
+                sp.big_map(),
+                sp.big_map[vmm_types.trigger_bucket_type, sp.set[sp.int]],
+            )
+            # Range covering the non-empty price buckets of each market, direction
+            # and kind, dropped once they are all empty
+            self.data.trigger_bounds = sp.cast(
+                sp.big_map(),
+                sp.big_map[vmm_types.trigger_key_type, vmm_types.trigger_bounds_type],
+            )
             # Decimal precision of contract
             self.data.decimal = sp.cast(6, sp.int)
             # Decimal amount of contract
             self.data.decimal_amount = sp.cast(1_000_000, sp.int)
             # Status of the contract (0: notInitialized, 1: active, 2: closeOnly, 3: paused)
             self.data.status = sp.cast(1, sp.int)
+            # Queue market orders for settleBatch instead of executing them
+            self.data.batch_auction = False
+            # Queued market order ids by market, newest first
+            self.data.batch_queue = sp.cast(
+                sp.big_map(), sp.big_map[sp.address, sp.list[sp.int]]
+            )
+            # Most orders a market's batch queue holds, so settleBatch stays
+            # within one operation's gas
+            self.data.max_batch_size = sp.nat(100)
+            # Level of each market's last settleBatch, one settlement per block
+            self.data.batch_levels = sp.cast(
+                sp.big_map(), sp.big_map[sp.address, sp.nat]
+            )
 
         @sp.private(with_storage="read-only")
         def _isAdmin(self):
@@ -47,6 +189,152 @@ def orders():
             sp.cast(statusCode, sp.int)
             assert self.data.status == statusCode, "InvalidContractStatus"
 
+        # Read an order from storage
+        @sp.private(with_storage="read-only")
+        def _loadOrder(self, order_id):
+            sp.cast(order_id, sp.int)
+            stored_order = self.data.orders[order_id]
+            return unpack_order(
+                sp.record(
+                    order=stored_order,
+                    vmm_address=self.data.market_addresses[stored_order.market_id],
+                )
+            )
+
+        # Write an order to storage, registering its market on first use
+        @sp.private(with_storage="read-write")
+        def _storeOrder(self, params):
+            sp.cast(
+                params,
+                sp.record(order_id=sp.int, order=vmm_types.create_order_type),
+            )
+            order_id = params.order_id
+            order = params.order
+            if not self.data.markets.contains(order.vmm_address):
+                self.data.markets[order.vmm_address] = self.data.last_market_id
+                self.data.market_addresses[self.data.last_market_id] = order.vmm_address
+                self.data.last_market_id += 1
+            self.data.orders[order_id] = pack_order(
+                sp.record(order=order, market_id=self.data.markets[order.vmm_address])
+            )
+
+        # Add an order to the trigger and holder indexes
+        @sp.private(with_storage="read-write")
+        def _indexOrder(self, params):
+            sp.cast(
+                params,
+                sp.record(order_id=sp.int, order=vmm_types.create_order_type),
+            )
+            order_id = params.order_id
+            order = params.order
+            if self.data.holder_orders.contains(order.position_holder):
+                self.data.holder_orders[order.position_holder].add(order_id)
+            else:
+                self.data.holder_orders[order.position_holder] = {order_id}
+            bucket_size = self.data.trigger_bucket_sizes.get(
+                order.vmm_address, default=self.data.trigger_bucket_size
+            )
+            for leg in trigger_legs(order):
+                bucket = leg.price / bucket_size
+                bucket_key = sp.record(
+                    vmm_address=order.vmm_address,
+                    direction=order.direction,
+                    kind=leg.kind,
+                    bucket=bucket,
+                )
+                key = sp.record(
+                    vmm_address=order.vmm_address,
+                    direction=order.direction,
+                    kind=leg.kind,
+                )
+                if self.data.trigger_index.contains(bucket_key):
+                    self.data.trigger_index[bucket_key].add(order_id)
+                else:
+                    self.data.trigger_index[bucket_key] = {order_id}
+                    if self.data.trigger_bounds.contains(key):
+                        bounds = self.data.trigger_bounds[key]
+                        if bucket < bounds.low:
+                            bounds.low = bucket
+                        if bucket > bounds.high:
+                            bounds.high = bucket
+                        bounds.buckets += 1
+                        self.data.trigger_bounds[key] = bounds
+                    else:
+                        self.data.trigger_bounds[key] = sp.record(
+                            low=bucket, high=bucket, buckets=1
+                        )
+
+        # Remove an order from the trigger and holder indexes
+        @sp.private(with_storage="read-write")
+        def _unindexOrder(self, params):
+            sp.cast(
+                params,
+                sp.record(order_id=sp.int, order=vmm_types.create_order_type),
+            )
+            order_id = params.order_id
+            order = params.order
+            if self.data.holder_orders.contains(order.position_holder):
+                self.data.holder_orders[order.position_holder].remove(order_id)
+                if sp.len(self.data.holder_orders[order.position_holder]) == 0:
+                    del self.data.holder_orders[order.position_holder]
+            bucket_size = self.data.trigger_bucket_sizes.get(
+                order.vmm_address, default=self.data.trigger_bucket_size
+            )
+            for leg in trigger_legs(order):
+                bucket_key = sp.record(
+                    vmm_address=order.vmm_address,
+                    direction=order.direction,
+                    kind=leg.kind,
+                    bucket=leg.price / bucket_size,
+                )
+                if self.data.trigger_index.contains(bucket_key):
+                    self.data.trigger_index[bucket_key].remove(order_id)
+                    if sp.len(self.data.trigger_index[bucket_key]) == 0:
+                        del self.data.trigger_index[bucket_key]
+                        key = sp.record(
+                            vmm_address=order.vmm_address,
+                            direction=order.direction,
+                            kind=leg.kind,
+                        )
+                        bounds = self.data.trigger_bounds[key]
+                        bounds.buckets = sp.as_nat(bounds.buckets - 1)
+                        if bounds.buckets == 0:
+                            del self.data.trigger_bounds[key]
+                        else:
+                            # Move an emptied edge inwards past at most 16 empty
+                            # buckets, the bounds only have to cover the orders
+                            if bucket_key.bucket == bounds.low:
+                                bounds.low += 1
+                                steps = 0
+                                while (steps < 16) and (
+                                    not self.data.trigger_index.contains(
+                                        sp.record(
+                                            vmm_address=order.vmm_address,
+                                            direction=order.direction,
+                                            kind=leg.kind,
+                                            bucket=bounds.low,
+                                        )
+                                    )
+                                ):
+                                    bounds.low += 1
+                                    steps += 1
+                            if bucket_key.bucket == bounds.high:
+                                bounds.high -= 1
+                                steps = 0
+                                while (steps < 16) and (
+                                    not self.data.trigger_index.contains(
+                                        sp.record(
+                                            vmm_address=order.vmm_address,
+                                            direction=order.direction,
+                                            kind=leg.kind,
+                                            bucket=bounds.high,
+                                        )
+                                    )
+                                ):
+                                    bounds.high -= 1
+                                    steps += 1
+                            self.data.trigger_bounds[key] = bounds
+
         # Call Get Mark and Index Price from VMM Contract View
         @sp.private(with_operations=True)
         def callGetIndexAndMarkPriceView(self, vmm_address):
@@ -59,6 +347,29 @@ def orders():
             ).unwrap_some(error="ErrorInCallGetIndexAndMarkPriceView")
             return view_data
 
+        # Directions of the VMM positions of the holders of order_ids, from a
+        # single getPositionsData view. Holders without a position are missing.
+        @sp.private(with_storage="read-only", with_operations=True)
+        def callGetPositionDirections(self, params):
+            sp.cast(
+                params, sp.record(vmm_address=sp.address, order_ids=sp.list[sp.int])
+            )
+            holders = sp.cast([], sp.list[sp.address])
+            for order_id in params.order_ids:
+                if self.data.orders.contains(order_id):
+                    holders.push(self.data.orders[order_id].position_holder)
+            positions = sp.view(
+                "getPositionsData",
+                params.vmm_address,
+                holders,
+                sp.map[sp.address, sp.option[vmm_types.positions_value]],
+            ).unwrap_some(error="ErrorInCallGetPositionsDataView")
+            directions = sp.cast({}, sp.map[sp.address, sp.int])
+            for item in positions.items():
+                if item.value.is_some():
+                    directions[item.key] = item.value.unwrap_some().position
+            return directions
+
         # Call Get Position Data from VMM Contract View
         @sp.private(with_operations=True)
         def callGetPositionDataView(self, vmm_address, position_holder):
@@ -105,6 +416,30 @@ def orders():
 
             sp.transfer(dataToBeSent, sp.mutez(0), contractParams)
 
+        # Call Increase Positions from VMM Contract
+        @sp.private(with_operations=True)
+        def callIncreasePositions(self, params):
+            sp.cast(
+                params,
+                sp.record(
+                    vmm_address=sp.address,
+                    fills=sp.list[vmm_types.position_fill_type],
+                    match_at_mark=sp.bool,
+                ),
+            )
+            contractParams = sp.contract(
+                sp.record(
+                    fills=sp.list[vmm_types.position_fill_type],
+                    match_at_mark=sp.bool,
+                ),
+                params.vmm_address,
+                "increasePositions",
+            ).unwrap_some(error="ErrorInCallIncreasePositions")
+            dataToBeSent = sp.record(
+                fills=params.fills, match_at_mark=params.match_at_mark
+            )
+            sp.transfer(dataToBeSent, sp.mutez(0), contractParams)
+
         # Call Close Position from VMM Contract
         @sp.private(with_operations=True)
         def callClosePosition(self, params):
@@ -271,23 +606,75 @@ def orders():
             sp.cast(decimal_amount, sp.int)
             self.data.decimal_amount = decimal_amount
 
+        # Update Batch Auction
+        @sp.entrypoint
+        def updateBatchAuction(self, enabled):
+            self._isAdmin()
+            sp.cast(enabled, sp.bool)
+            self.data.batch_auction = enabled
+
+        # Update the batch queue capacity of every market
+        @sp.entrypoint
+        def updateMaxBatchSize(self, max_batch_size):
+            self._isAdmin()
+            sp.cast(max_batch_size, sp.nat)
+            assert max_batch_size > 0, "InvalidBatchSize"
+            self.data.max_batch_size = max_batch_size
+
+        # Update the trigger bucket width of a market without indexed orders
+        @sp.entrypoint
+        def updateTriggerBucketSize(self, vmm_address, bucket_size):
+            self._isAdmin()
+            sp.cast(vmm_address, sp.address)
+            sp.cast(bucket_size, sp.int)
+            assert bucket_size > 0, "InvalidBucketSize"
+            for direction in [1, 2]:
+                for kind in [0, 1, 2]:
+                    assert not self.data.trigger_bounds.contains(
+                        sp.record(
+                            vmm_address=vmm_address, direction=direction, kind=kind
+                        )
+                    ), "MarketHasOrders"
+            self.data.trigger_bucket_sizes[vmm_address] = bucket_size
+
         # Create Order
         @sp.entrypoint
         def createOrder(self, params):
             sp.cast(params, vmm_types.create_order_type)
             self._checkStatus(1)
             assert params.position_holder == sp.sender, "InvalidPositionHolder"
-            self.data.orders[self.data.last_order_id] = params
+            order = params
             if params.order_type == 0:
-                order_params = sp.record(
-                    vmm_address=params.vmm_address,
-                    position_holder=params.position_holder,
-                    direction=params.direction,
-                    usd_amount=params.amount_in,
-                    leverage_multiple=params.leverage_multiple,
-                )
-                self.callIncreasePosition(order_params)
-                self.data.orders[self.data.last_order_id].order_status = 1
+                if self.data.batch_auction:
+                    order.order_status = 0
+                    if self.data.batch_queue.contains(params.vmm_address):
+                        assert (
+                            sp.len(self.data.batch_queue[params.vmm_address])
+                            < self.data.max_batch_size
+                        ), "BatchFull"
+                        self.data.batch_queue[params.vmm_address].push(
+                            self.data.last_order_id
+                        )
+                    else:
+                        self.data.batch_queue[params.vmm_address] = [
+                            self.data.last_order_id
+                        ]
+                else:
+                    order_params = sp.record(
+                        vmm_address=params.vmm_address,
+                        position_holder=params.position_holder,
+                        direction=params.direction,
+                        usd_amount=params.amount_in,
+                        leverage_multiple=params.leverage_multiple,
+                    )
+                    self.callIncreasePosition(order_params)
+                    order.order_status = 1
+            self._storeOrder(sp.record(order_id=self.data.last_order_id, order=order))
+            self._indexOrder(sp.record(order_id=self.data.last_order_id, order=order))
+            sp.emit(
+                sp.record(order_id=self.data.last_order_id, order=order),
+                tag="ORDER_CREATED",
+            )
             self.data.last_order_id += 1
 
         # Update Pending Order
@@ -296,11 +683,12 @@ def orders():
             sp.cast(params, vmm_types.create_order_type)
             self._checkStatus(1)
             assert self.data.orders.contains(order_id), "InvalidOrderId"
-            assert (
-                self.data.orders[order_id].position_holder == sp.sender
-            ), "NotAuthorized"
-            assert self.data.orders[order_id].order_status == 0, "InvalidOrderStatus"
-            self.data.orders[order_id] = params
+            order = self._loadOrder(order_id)
+            assert order.position_holder == sp.sender, "NotAuthorized"
+            assert order.order_status == 0, "InvalidOrderStatus"
+            self._unindexOrder(sp.record(order_id=order_id, order=order))
+            self._storeOrder(sp.record(order_id=order_id, order=params))
+            self._indexOrder(sp.record(order_id=order_id, order=params))
 
         # Update Active Order
         @sp.entrypoint
@@ -320,30 +708,24 @@ def orders():
             )
             self._checkStatus(1)
             assert self.data.orders.contains(params.order_id), "InvalidOrderId"
-            assert (
-                self.data.orders[params.order_id].position_holder == sp.sender
-            ), "NotAuthorized"
-            assert (
-                self.data.orders[params.order_id].order_status == 1
-            ), "InvalidOrderStatus"
-            self.data.orders[params.order_id].amount_in += params.amount_in
-            self.data.orders[params.order_id].leverage_multiple = (
-                params.leverage_multiple
-            )
-            self.data.orders[params.order_id].stop_trigger_price = (
-                params.stop_trigger_price
-            )
-            self.data.orders[params.order_id].stop_limit_price = params.stop_limit_price
-            self.data.orders[params.order_id].take_trigger_price = (
-                params.take_trigger_price
-            )
-            self.data.orders[params.order_id].take_limit_price = params.take_limit_price
-            self.data.orders[params.order_id].expiration = params.expiration
+            order = self._loadOrder(params.order_id)
+            assert order.position_holder == sp.sender, "NotAuthorized"
+            assert order.order_status == 1, "InvalidOrderStatus"
+            self._unindexOrder(sp.record(order_id=params.order_id, order=order))
+            order.amount_in += params.amount_in
+            order.leverage_multiple = params.leverage_multiple
+            order.stop_trigger_price = params.stop_trigger_price
+            order.stop_limit_price = params.stop_limit_price
+            order.take_trigger_price = params.take_trigger_price
+            order.take_limit_price = params.take_limit_price
+            order.expiration = params.expiration
+            self._storeOrder(sp.record(order_id=params.order_id, order=order))
+            self._indexOrder(sp.record(order_id=params.order_id, order=order))
 
             order_params = sp.record(
-                vmm_address=self.data.orders[params.order_id].vmm_address,
-                position_holder=self.data.orders[params.order_id].position_holder,
-                direction=self.data.orders[params.order_id].direction,
+                vmm_address=order.vmm_address,
+                position_holder=order.position_holder,
+                direction=order.direction,
                 usd_amount=params.amount_in,
                 leverage_multiple=params.leverage_multiple,
             )
@@ -367,32 +749,24 @@ def orders():
             )
             self._checkStatus(1)
             assert self.data.orders.contains(params.order_id), "InvalidOrderId"
-            assert (
-                self.data.orders[params.order_id].position_holder == sp.sender
-            ), "NotAuthorized"
-            assert (
-                self.data.orders[params.order_id].order_status == 1
-            ), "InvalidOrderStatus"
-            assert (
-                self.data.orders[params.order_id].amount_in >= params.amount_in
-            ), "InvalidAmount"
-            self.data.orders[params.order_id].amount_in -= params.amount_in
-            self.data.orders[params.order_id].leverage_multiple = (
-                params.leverage_multiple
-            )
-            self.data.orders[params.order_id].stop_trigger_price = (
-                params.stop_trigger_price
-            )
-            self.data.orders[params.order_id].stop_limit_price = params.stop_limit_price
-            self.data.orders[params.order_id].take_trigger_price = (
-                params.take_trigger_price
-            )
-            self.data.orders[params.order_id].take_limit_price = params.take_limit_price
-            self.data.orders[params.order_id].expiration = params.expiration
+            order = self._loadOrder(params.order_id)
+            assert order.position_holder == sp.sender, "NotAuthorized"
+            assert order.order_status == 1, "InvalidOrderStatus"
+            assert order.amount_in >= params.amount_in, "InvalidAmount"
+            self._unindexOrder(sp.record(order_id=params.order_id, order=order))
+            order.amount_in -= params.amount_in
+            order.leverage_multiple = params.leverage_multiple
+            order.stop_trigger_price = params.stop_trigger_price
+            order.stop_limit_price = params.stop_limit_price
+            order.take_trigger_price = params.take_trigger_price
+            order.take_limit_price = params.take_limit_price
+            order.expiration = params.expiration
+            self._storeOrder(sp.record(order_id=params.order_id, order=order))
+            self._indexOrder(sp.record(order_id=params.order_id, order=order))
             order_params = sp.record(
-                vmm_address=self.data.orders[params.order_id].vmm_address,
-                position_holder=self.data.orders[params.order_id].position_holder,
-                direction=self.data.orders[params.order_id].direction,
+                vmm_address=order.vmm_address,
+                position_holder=order.position_holder,
+                direction=order.direction,
                 usd_amount=params.amount_in,
                 leverage_multiple=params.leverage_multiple,
             )
@@ -415,24 +789,20 @@ def orders():
             )
             self._checkStatus(1)
             assert self.data.orders.contains(params.order_id), "InvalidOrderId"
-            assert (
-                self.data.orders[params.order_id].position_holder == sp.sender
-            ), "NotAuthorized"
-            assert (
-                self.data.orders[params.order_id].order_status == 1
-            ), "InvalidOrderStatus"
-            self.data.orders[params.order_id].stop_trigger_price = (
-                params.stop_trigger_price
-            )
-            self.data.orders[params.order_id].stop_limit_price = params.stop_limit_price
-            self.data.orders[params.order_id].take_trigger_price = (
-                params.take_trigger_price
-            )
-            self.data.orders[params.order_id].take_limit_price = params.take_limit_price
-            self.data.orders[params.order_id].expiration = params.expiration
+            order = self._loadOrder(params.order_id)
+            assert order.position_holder == sp.sender, "NotAuthorized"
+            assert order.order_status == 1, "InvalidOrderStatus"
+            self._unindexOrder(sp.record(order_id=params.order_id, order=order))
+            order.stop_trigger_price = params.stop_trigger_price
+            order.stop_limit_price = params.stop_limit_price
+            order.take_trigger_price = params.take_trigger_price
+            order.take_limit_price = params.take_limit_price
+            order.expiration = params.expiration
+            self._storeOrder(sp.record(order_id=params.order_id, order=order))
+            self._indexOrder(sp.record(order_id=params.order_id, order=order))
             order_params = sp.record(
-                vmm_address=self.data.orders[params.order_id].vmm_address,
-                position_holder=self.data.orders[params.order_id].position_holder,
+                vmm_address=order.vmm_address,
+                position_holder=order.position_holder,
                 amount=params.amount,
             )
             self.callAddMargin(order_params)
@@ -454,24 +824,20 @@ def orders():
             )
             self._checkStatus(1)
             assert self.data.orders.contains(params.order_id), "InvalidOrderId"
-            assert (
-                self.data.orders[params.order_id].position_holder == sp.sender
-            ), "NotAuthorized"
-            assert (
-                self.data.orders[params.order_id].order_status == 1
-            ), "InvalidOrderStatus"
-            self.data.orders[params.order_id].stop_trigger_price = (
-                params.stop_trigger_price
-            )
-            self.data.orders[params.order_id].stop_limit_price = params.stop_limit_price
-            self.data.orders[params.order_id].take_trigger_price = (
-                params.take_trigger_price
-            )
-            self.data.orders[params.order_id].take_limit_price = params.take_limit_price
-            self.data.orders[params.order_id].expiration = params.expiration
+            order = self._loadOrder(params.order_id)
+            assert order.position_holder == sp.sender, "NotAuthorized"
+            assert order.order_status == 1, "InvalidOrderStatus"
+            self._unindexOrder(sp.record(order_id=params.order_id, order=order))
+            order.stop_trigger_price = params.stop_trigger_price
+            order.stop_limit_price = params.stop_limit_price
+            order.take_trigger_price = params.take_trigger_price
+            order.take_limit_price = params.take_limit_price
+            order.expiration = params.expiration
+            self._storeOrder(sp.record(order_id=params.order_id, order=order))
+            self._indexOrder(sp.record(order_id=params.order_id, order=order))
             order_params = sp.record(
-                vmm_address=self.data.orders[params.order_id].vmm_address,
-                position_holder=self.data.orders[params.order_id].position_holder,
+                vmm_address=order.vmm_address,
+                position_holder=order.position_holder,
                 amount=params.amount,
             )
             self.callRemoveMargin(order_params)
@@ -481,110 +847,627 @@ def orders():
         def cancelOrder(self, order_id):
             self._checkStatus(1)
             assert self.data.orders.contains(order_id), "InvalidOrderId"
+            self._unindexOrder(
+                sp.record(order_id=order_id, order=self._loadOrder(order_id))
+            )
             del self.data.orders[order_id]
 
+        # Delete closed and expired pending orders
+        @sp.entrypoint
+        def pruneOrders(self, order_ids):
+            sp.cast(order_ids, sp.list[sp.int])
+            pruned = sp.cast(
+                [],
+                sp.list[sp.record(order_id=sp.int, order=vmm_types.create_order_type)],
+            )
+            for order_id in order_ids:
+                if self.data.orders.contains(order_id):
+                    order = self._loadOrder(order_id)
+                    if (order.order_status == 2) or (
+                        (order.order_status == 0) and order_expired(order)
+                    ):
+                        self._unindexOrder(sp.record(order_id=order_id, order=order))
+                        del self.data.orders[order_id]
+                        pruned.push(sp.record(order_id=order_id, order=order))
+            sp.emit(pruned, tag="ORDERS_PRUNED")
+
         # Execute Limit Order
         @sp.entrypoint
         def executeLimitOrder(self, order_id):
             self._checkStatus(1)
             assert self.data.orders.contains(order_id), "InvalidOrderId"
+            order = self._loadOrder(order_id)
+            assert not order_expired(order), "OrderExpired"
             # TODO: Check the Trigger Price and Current Mark Price are in range of execution
             current_index_and_mark_price = self.callGetIndexAndMarkPriceView(
-                self.data.orders[order_id].vmm_address
+                order.vmm_address
             )
-            if (self.data.orders[order_id].direction == 1) and (
-                current_index_and_mark_price.mark_price
-                <= self.data.orders[order_id].trigger_price
+            if (order.direction == 1) and (
+                current_index_and_mark_price.mark_price <= order.trigger_price
             ):
                 order_params = sp.record(
-                    vmm_address=self.data.orders[order_id].vmm_address,
-                    position_holder=self.data.orders[order_id].position_holder,
-                    direction=self.data.orders[order_id].direction,
-                    usd_amount=self.data.orders[order_id].amount_in,
-                    leverage_multiple=self.data.orders[order_id].leverage_multiple,
+                    vmm_address=order.vmm_address,
+                    position_holder=order.position_holder,
+                    direction=order.direction,
+                    usd_amount=order.amount_in,
+                    leverage_multiple=order.leverage_multiple,
                 )
                 self.callIncreasePosition(order_params)
-                self.data.orders[order_id].order_status = 1
-            if (self.data.orders[order_id].direction == 2) and (
-                current_index_and_mark_price.mark_price
-                >= self.data.orders[order_id].trigger_price
+                self._unindexOrder(sp.record(order_id=order_id, order=order))
+                order.order_status = 1
+                self._storeOrder(sp.record(order_id=order_id, order=order))
+                self._indexOrder(sp.record(order_id=order_id, order=order))
+            if (order.direction == 2) and (
+                current_index_and_mark_price.mark_price >= order.trigger_price
             ):
                 order_params = sp.record(
-                    vmm_address=self.data.orders[order_id].vmm_address,
-                    position_holder=self.data.orders[order_id].position_holder,
-                    direction=self.data.orders[order_id].direction,
-                    usd_amount=self.data.orders[order_id].amount_in,
-                    leverage_multiple=self.data.orders[order_id].leverage_multiple,
+                    vmm_address=order.vmm_address,
+                    position_holder=order.position_holder,
+                    direction=order.direction,
+                    usd_amount=order.amount_in,
+                    leverage_multiple=order.leverage_multiple,
                 )
                 self.callIncreasePosition(order_params)
-                self.data.orders[order_id].order_status = 1
+                self._unindexOrder(sp.record(order_id=order_id, order=order))
+                order.order_status = 1
+                self._storeOrder(sp.record(order_id=order_id, order=order))
+                self._indexOrder(sp.record(order_id=order_id, order=order))
 
         # Execute Close Position
         @sp.entrypoint
         def executeCloseOrder(self, order_id):
             self._checkStatus(1)
             assert self.data.orders.contains(order_id), "InvalidOrderId"
-            assert (
-                sp.sender == self.data.orders[order_id].position_holder
-            ), "NotAuthorized"
-            assert self.data.orders[order_id].order_status == 1, "InvalidOrderStatus"
+            order = self._loadOrder(order_id)
+            assert sp.sender == order.position_holder, "NotAuthorized"
+            assert order.order_status == 1, "InvalidOrderStatus"
             order_params = sp.record(
-                vmm_address=self.data.orders[order_id].vmm_address,
-                position_holder=self.data.orders[order_id].position_holder,
+                vmm_address=order.vmm_address,
+                position_holder=order.position_holder,
             )
             self.callClosePosition(order_params)
-            self.data.orders[order_id].order_status = 2
+            self._unindexOrder(sp.record(order_id=order_id, order=order))
+            order.order_status = 2
+            self._storeOrder(sp.record(order_id=order_id, order=order))
 
         # Trigger Stop Loss
         @sp.entrypoint
         def triggerStopLoss(self, order_id):
             self._checkStatus(1)
             assert self.data.orders.contains(order_id), "InvalidOrderId"
+            order = self._loadOrder(order_id)
+            assert not order_expired(order), "OrderExpired"
             current_index_and_mark_price = self.callGetIndexAndMarkPriceView(
-                self.data.orders[order_id].vmm_address
+                order.vmm_address
             )
-            if (self.data.orders[order_id].direction == 1) and (
+            if (order.direction == 1) and (
                 current_index_and_mark_price.mark_price
-                <= self.data.orders[order_id].stop_trigger_price.unwrap_some(
-                    error="ErrorInStopTriggerPrice"
-                )
+                <= order.stop_trigger_price.unwrap_some(error="ErrorInStopTriggerPrice")
             ):
                 order_params = sp.record(
-                    vmm_address=self.data.orders[order_id].vmm_address,
-                    position_holder=self.data.orders[order_id].position_holder,
+                    vmm_address=order.vmm_address,
+                    position_holder=order.position_holder,
                 )
                 self.callClosePosition(order_params)
-                self.data.orders[order_id].order_status = 2
-            if (self.data.orders[order_id].direction == 2) and (
+                self._unindexOrder(sp.record(order_id=order_id, order=order))
+                order.order_status = 2
+                self._storeOrder(sp.record(order_id=order_id, order=order))
+            if (order.direction == 2) and (
                 current_index_and_mark_price.mark_price
-                >= self.data.orders[order_id].stop_trigger_price.unwrap_some(
-                    error="ErrorInStopTriggerPrice"
-                )
+                >= order.stop_trigger_price.unwrap_some(error="ErrorInStopTriggerPrice")
             ):
                 order_params = sp.record(
-                    vmm_address=self.data.orders[order_id].vmm_address,
-                    position_holder=self.data.orders[order_id].position_holder,
+                    vmm_address=order.vmm_address,
+                    position_holder=order.position_holder,
                 )
                 self.callClosePosition(order_params)
-                self.data.orders[order_id].order_status = 2
+                self._unindexOrder(sp.record(order_id=order_id, order=order))
+                order.order_status = 2
+                self._storeOrder(sp.record(order_id=order_id, order=order))
 
         # Trigger Take Profit
         @sp.entrypoint
         def triggerTakeProfit(self, order_id):
             self._checkStatus(1)
             assert self.data.orders.contains(order_id), "InvalidOrderId"
+            order = self._loadOrder(order_id)
+            assert not order_expired(order), "OrderExpired"
             current_index_and_mark_price = self.callGetIndexAndMarkPriceView(
-                self.data.orders[order_id].vmm_address
+                order.vmm_address
             )
-            if (self.data.orders[order_id].direction == 1) and (
+            if (order.direction == 1) and (
                 current_index_and_mark_price.mark_price
-                >= self.data.orders[order_id].take_trigger_price.unwrap_some(
-                    error="ErrorInTakeTriggerPrice"
-                )
+                >= order.take_trigger_price.unwrap_some(error="ErrorInTakeTriggerPrice")
             ):
                 order_params = sp.record(
-                    vmm_address=self.data.orders[order_id].vmm_address,
-                    position_holder=self.data.orders[order_id].position_holder,
+                    vmm_address=order.vmm_address,
+                    position_holder=order.position_holder,
                 )
                 self.callTakeProfit(order_params)
-                self.data.orders[order_id].order_status = 2
+                self._unindexOrder(sp.record(order_id=order_id, order=order))
+                order.order_status = 2
+                self._storeOrder(sp.record(order_id=order_id, order=order))
+
+        # Fill the queued market orders of a market at one clearing price, at
+        # most once per block. Orders the VMM would reject are closed instead,
+        # so that one bad order cannot fail the whole batch.
+        @sp.entrypoint
+        def settleBatch(self, vmm_address):
+            sp.cast(vmm_address, sp.address)
+            self._checkStatus(1)
+            assert self.data.batch_queue.contains(vmm_address), "EmptyBatch"
+            if self.data.batch_levels.contains(vmm_address):
+                assert (
+                    self.data.batch_levels[vmm_address] < sp.level
+                ), "BatchAlreadySettled"
+            self.data.batch_levels[vmm_address] = sp.level
+            order_ids = sp.cast([], sp.list[sp.int])
+            for order_id in self.data.batch_queue[vmm_address]:
+                order_ids.push(order_id)
+            del self.data.batch_queue[vmm_address]
+
+            holders = sp.cast([], sp.list[sp.address])
+            for order_id in order_ids:
+                if self.data.orders.contains(order_id):
+                    holders.push(self.data.orders[order_id].position_holder)
+            positions = sp.view(
+                "getPositionsData",
+                vmm_address,
+                holders,
+                sp.map[sp.address, sp.option[vmm_types.positions_value]],
+            ).unwrap_some(error="ErrorInCallGetPositionsDataView")
+            balances = sp.view(
+                "getBalances", vmm_address, holders, sp.map[sp.address, sp.nat]
+            ).unwrap_some(error="ErrorInCallGetBalancesView")
+            directions = sp.cast({}, sp.map[sp.address, sp.int])
+            for item in positions.items():
+                if item.value.is_some():
+                    directions[item.key] = item.value.unwrap_some().position
+
+            fills = sp.cast([], sp.list[vmm_types.position_fill_type])
+            outcomes = sp.cast([], sp.list[vmm_types.order_outcome_type])
+            for order_id in order_ids:
+                outcome = "InvalidOrderId"
+                if self.data.orders.contains(order_id):
+                    order = self._loadOrder(order_id)
+                    holder = order.position_holder
+                    outcome = "InvalidOrderStatus"
+                    if (order.order_type == 0) and (order.order_status == 0):
+                        outcome = "Expired"
+                        if not order_expired(order):
+                            outcome = "InvalidOrder"
+                            if (
+                                ((order.direction == 1) or (order.direction == 2))
+                                and (order.amount_in >= 0)
+                                and (order.leverage_multiple >= 0)
+                            ):
+                                outcome = "InvalidPosition"
+                                if (
+                                    directions.get(holder, default=order.direction)
+                                    == order.direction
+                                ):
+                                    outcome = "InsufficientBalance"
+                                    if balances[holder] >= abs(order.amount_in):
+                                        balances[holder] = sp.as_nat(
+                                            balances[holder] - abs(order.amount_in)
+                                        )
+                                        directions[holder] = order.direction
+                                        fills.push(
+                                            sp.record(
+                                                position_holder=holder,
+                                                direction=order.direction,
+                                                usd_amount=order.amount_in,
+                                                leverage_multiple=order.leverage_multiple,
+                                            )
+                                        )
+                                        outcome = "Executed"
+                        if outcome != "Expired":
+                            self._unindexOrder(
+                                sp.record(order_id=order_id, order=order)
+                            )
+                            order.order_status = 2
+                            if outcome == "Executed":
+                                order.order_status = 1
+                            self._storeOrder(sp.record(order_id=order_id, order=order))
+                            if outcome == "Executed":
+                                self._indexOrder(
+                                    sp.record(order_id=order_id, order=order)
+                                )
+                outcomes.push(sp.record(order_id=order_id, outcome=outcome))
+            if sp.len(fills) > 0:
+                self.callIncreasePositions(
+                    sp.record(vmm_address=vmm_address, fills=fills, match_at_mark=False)
+                )
+            sp.emit(
+                sp.record(vmm_address=vmm_address, outcomes=outcomes),
+                tag="BATCH_SETTLED",
+            )
+
+        # Execute Limit Orders in batch
+        @sp.entrypoint
+        def executeLimitOrders(self, vmm_address, order_ids):
+            sp.cast(vmm_address, sp.address)
+            sp.cast(order_ids, sp.list[sp.int])
+            self._checkStatus(1)
+            current_index_and_mark_price = self.callGetIndexAndMarkPriceView(
+                vmm_address
+            )
+            # No order was stored for a market without a market id
+            market_id = sp.cast(-1, sp.int)
+            if self.data.markets.contains(vmm_address):
+                market_id = sp.to_int(self.data.markets[vmm_address])
+            # Orders the VMM would reject are skipped, as in settleBatch, so
+            # that one order cannot fail the whole batch
+            holders = sp.cast([], sp.list[sp.address])
+            for order_id in order_ids:
+                if self.data.orders.contains(order_id):
+                    holders.push(self.data.orders[order_id].position_holder)
+            positions = sp.view(
+                "getPositionsData",
+                vmm_address,
+                holders,
+                sp.map[sp.address, sp.option[vmm_types.positions_value]],
+            ).unwrap_some(error="ErrorInCallGetPositionsDataView")
+            balances = sp.view(
+                "getBalances", vmm_address, holders, sp.map[sp.address, sp.nat]
+            ).unwrap_some(error="ErrorInCallGetBalancesView")
+            directions = sp.cast({}, sp.map[sp.address, sp.int])
+            for item in positions.items():
+                if item.value.is_some():
+                    directions[item.key] = item.value.unwrap_some().position
+
+            # Triggered orders are filled together: opposing orders are matched
+            # at the mark price and only the residual moves the VMM reserves
+            fills = sp.cast([], sp.list[vmm_types.position_fill_type])
+            outcomes = sp.cast([], sp.list[vmm_types.order_outcome_type])
+            for order_id in order_ids:
+                outcome = "InvalidOrderId"
+                if self.data.orders.contains(order_id):
+                    stored_order = self.data.orders[order_id]
+                    outcome = "InvalidMarket"
+                    if sp.to_int(stored_order.market_id) == market_id:
+                        order = unpack_order(
+                            sp.record(order=stored_order, vmm_address=vmm_address)
+                        )
+                        holder = order.position_holder
+                        outcome = "InvalidOrderStatus"
+                        if (order.order_type == 1) and (order.order_status == 0):
+                            outcome = "Expired"
+                            if not order_expired(order):
+                                outcome = "NotTriggered"
+                            if (outcome == "NotTriggered") and (
+                                (
+                                    (order.direction == 1)
+                                    and (
+                                        current_index_and_mark_price.mark_price
+                                        <= order.trigger_price
+                                    )
+                                )
+                                or (
+                                    (order.direction == 2)
+                                    and (
+                                        current_index_and_mark_price.mark_price
+                                        >= order.trigger_price
+                                    )
+                                )
+                            ):
+                                outcome = "InvalidOrder"
+                                if (order.amount_in >= 0) and (
+                                    order.leverage_multiple >= 0
+                                ):
+                                    outcome = "InvalidPosition"
+                                    if (
+                                        directions.get(holder, default=order.direction)
+                                        == order.direction
+                                    ):
+                                        outcome = "InsufficientBalance"
+                                        if balances[holder] >= abs(order.amount_in):
+                                            outcome = "Executed"
+                            if outcome == "Executed":
+                                balances[holder] = sp.as_nat(
+                                    balances[holder] - abs(order.amount_in)
+                                )
+                                directions[holder] = order.direction
+                                fills.push(
+                                    sp.record(
+                                        position_holder=holder,
+                                        direction=order.direction,
+                                        usd_amount=order.amount_in,
+                                        leverage_multiple=order.leverage_multiple,
+                                    )
+                                )
+                                self._unindexOrder(
+                                    sp.record(order_id=order_id, order=order)
+                                )
+                                order.order_status = 1
+                                self._storeOrder(
+                                    sp.record(order_id=order_id, order=order)
+                                )
+                                self._indexOrder(
+                                    sp.record(order_id=order_id, order=order)
+                                )
+                outcomes.push(sp.record(order_id=order_id, outcome=outcome))
+            if sp.len(fills) > 0:
+                self.callIncreasePositions(
+                    sp.record(vmm_address=vmm_address, fills=fills, match_at_mark=True)
+                )
+            sp.emit(
+                sp.record(vmm_address=vmm_address, outcomes=outcomes),
+                tag="LIMIT_ORDERS_EXECUTED",
+            )
+
+        # Trigger Stop Losses in batch. An order whose position was closed or
+        # liquidated, or closed by an earlier order of the batch, is closed
+        # without calling the VMM so that it cannot fail the whole batch.
+        @sp.entrypoint
+        def triggerStopLosses(self, vmm_address, order_ids):
+            sp.cast(vmm_address, sp.address)
+            sp.cast(order_ids, sp.list[sp.int])
+            self._checkStatus(1)
+            current_index_and_mark_price = self.callGetIndexAndMarkPriceView(
+                vmm_address
+            )
+            # No order was stored for a market without a market id
+            market_id = sp.cast(-1, sp.int)
+            if self.data.markets.contains(vmm_address):
+                market_id = sp.to_int(self.data.markets[vmm_address])
+            directions = self.callGetPositionDirections(
+                sp.record(vmm_address=vmm_address, order_ids=order_ids)
+            )
+            outcomes = sp.cast([], sp.list[vmm_types.order_outcome_type])
+            for order_id in order_ids:
+                outcome = "InvalidOrderId"
+                if self.data.orders.contains(order_id):
+                    stored_order = self.data.orders[order_id]
+                    outcome = "InvalidMarket"
+                    if sp.to_int(stored_order.market_id) == market_id:
+                        order = unpack_order(
+                            sp.record(order=stored_order, vmm_address=vmm_address)
+                        )
+                        outcome = "InvalidOrderStatus"
+                        if order.order_status == 1:
+                            outcome = "NoTriggerPrice"
+                            if order.stop_trigger_price.is_some():
+                                stop_trigger_price = (
+                                    order.stop_trigger_price.unwrap_some()
+                                )
+                                outcome = "Expired"
+                                if not order_expired(order):
+                                    outcome = "NotTriggered"
+                                if (outcome == "NotTriggered") and (
+                                    (
+                                        (order.direction == 1)
+                                        and (
+                                            current_index_and_mark_price.mark_price
+                                            <= stop_trigger_price
+                                        )
+                                    )
+                                    or (
+                                        (order.direction == 2)
+                                        and (
+                                            current_index_and_mark_price.mark_price
+                                            >= stop_trigger_price
+                                        )
+                                    )
+                                ):
+                                    holder = order.position_holder
+                                    outcome = "NoPosition"
+                                    if directions.contains(holder):
+                                        outcome = "InvalidPosition"
+                                        if directions[holder] == order.direction:
+                                            outcome = "Executed"
+                                    if outcome == "Executed":
+                                        self.callClosePosition(
+                                            sp.record(
+                                                vmm_address=order.vmm_address,
+                                                position_holder=holder,
+                                            )
+                                        )
+                                        del directions[holder]
+                                    self._unindexOrder(
+                                        sp.record(order_id=order_id, order=order)
+                                    )
+                                    order.order_status = 2
+                                    self._storeOrder(
+                                        sp.record(order_id=order_id, order=order)
+                                    )
+                outcomes.push(sp.record(order_id=order_id, outcome=outcome))
+            sp.emit(
+                sp.record(vmm_address=vmm_address, outcomes=outcomes),
+                tag="STOP_LOSSES_TRIGGERED",
+            )
+
+        # Trigger Take Profits in batch. An order whose position was closed or
+        # liquidated is closed without calling the VMM so that it cannot fail
+        # the whole batch.
+        @sp.entrypoint
+        def triggerTakeProfits(self, vmm_address, order_ids):
+            sp.cast(vmm_address, sp.address)
+            sp.cast(order_ids, sp.list[sp.int])
+            self._checkStatus(1)
+            current_index_and_mark_price = self.callGetIndexAndMarkPriceView(
+                vmm_address
+            )
+            # No order was stored for a market without a market id
+            market_id = sp.cast(-1, sp.int)
+            if self.data.markets.contains(vmm_address):
+                market_id = sp.to_int(self.data.markets[vmm_address])
+            directions = self.callGetPositionDirections(
+                sp.record(vmm_address=vmm_address, order_ids=order_ids)
+            )
+            outcomes = sp.cast([], sp.list[vmm_types.order_outcome_type])
+            for order_id in order_ids:
+                outcome = "InvalidOrderId"
+                if self.data.orders.contains(order_id):
+                    stored_order = self.data.orders[order_id]
+                    outcome = "InvalidMarket"
+                    if sp.to_int(stored_order.market_id) == market_id:
+                        order = unpack_order(
+                            sp.record(order=stored_order, vmm_address=vmm_address)
+                        )
+                        outcome = "InvalidOrderStatus"
+                        if order.order_status == 1:
+                            outcome = "NoTriggerPrice"
+                            if order.take_trigger_price.is_some():
+                                outcome = "Expired"
+                                if not order_expired(order):
+                                    outcome = "NotTriggered"
+                                if (
+                                    (outcome == "NotTriggered")
+                                    and (order.direction == 1)
+                                ) and (
+                                    current_index_and_mark_price.mark_price
+                                    >= order.take_trigger_price.unwrap_some()
+                                ):
+                                    holder = order.position_holder
+                                    outcome = "NoPosition"
+                                    if directions.contains(holder):
+                                        outcome = "InvalidPosition"
+                                        if directions[holder] == order.direction:
+                                            outcome = "Executed"
+                                    if outcome == "Executed":
+                                        self.callTakeProfit(
+                                            sp.record(
+                                                vmm_address=order.vmm_address,
+                                                position_holder=holder,
+                                            )
+                                        )
+                                    self._unindexOrder(
+                                        sp.record(order_id=order_id, order=order)
+                                    )
+                                    order.order_status = 2
+                                    self._storeOrder(
+                                        sp.record(order_id=order_id, order=order)
+                                    )
+                outcomes.push(sp.record(order_id=order_id, outcome=outcome))
+            sp.emit(
+                sp.record(vmm_address=vmm_address, outcomes=outcomes),
+                tag="TAKE_PROFITS_TRIGGERED",
+            )
+
+        # Get Triggered Orders View. Scans at most max_buckets buckets for each
+        # direction and kind, and returns in resume where to continue the scans
+        # that did not reach the last bucket; pass it back to get the next page.
+        @sp.onchain_view()
+        def getTriggeredOrders(self, params):
+            sp.cast(
+                params,
+                sp.record(
+                    vmm_address=sp.address,
+                    mark_price=sp.int,
+                    max_buckets=sp.int,
+                    resume=vmm_types.trigger_cursor_type,
+                ),
+            )
+            triggered = sp.record(
+                limit_orders=sp.cast([], sp.list[sp.int]),
+                stop_loss_orders=sp.cast([], sp.list[sp.int]),
+                take_profit_orders=sp.cast([], sp.list[sp.int]),
+                resume=sp.cast({}, vmm_types.trigger_cursor_type),
+            )
+            mark_bucket = params.mark_price / self.data.trigger_bucket_sizes.get(
+                params.vmm_address, default=self.data.trigger_bucket_size
+            )
+            for direction in [1, 2]:
+                for kind in [0, 1, 2]:
+                    key = sp.record(
+                        vmm_address=params.vmm_address, direction=direction, kind=kind
+                    )
+                    cursor = sp.record(direction=direction, kind=kind)
+                    # A later page only continues the scans that did not finish
+                    if self.data.trigger_bounds.contains(key) and (
+                        (sp.len(params.resume) == 0) or params.resume.contains(cursor)
+                    ):
+                        # Longs' limits and stop losses fire at or below their price,
+                        # take profits at or above it
+                        fires_below = kind != 2
+                        if direction == 2:
+                            fires_below = kind == 2
+                        # Scan at most max_buckets buckets, moving away from the
+                        # mark from where the previous page stopped
+                        first = self.data.trigger_bounds[key].low
+                        last = self.data.trigger_bounds[key].high
+                        if fires_below:
+                            start = params.resume.get(cursor, default=mark_bucket)
+                            if start > first:
+                                first = start
+                            if first + params.max_buckets - 1 < last:
+                                last = first + params.max_buckets - 1
+                                triggered.resume[cursor] = last + 1
+                        else:
+                            start = params.resume.get(cursor, default=mark_bucket)
+                            if start < last:
+                                last = start
+                            if last - params.max_buckets + 1 > first:
+                                first = last - params.max_buckets + 1
+                                triggered.resume[cursor] = first - 1
+                        bucket = first
+                        while bucket <= last:
+                            bucket_key = sp.record(
+                                vmm_address=params.vmm_address,
+                                direction=direction,
+                                kind=kind,
+                                bucket=bucket,
+                            )
+                            if self.data.trigger_index.contains(bucket_key):
+                                for order_id in self.data.trigger_index[
+                                    bucket_key
+                                ].elements():
+                                    order = unpack_order(
+                                        sp.record(
+                                            order=self.data.orders[order_id],
+                                            vmm_address=params.vmm_address,
+                                        )
+                                    )
+                                    for leg in trigger_legs(order):
+                                        if (leg.kind == kind) and (
+                                            not order_expired(order)
+                                        ):
+                                            crossed = params.mark_price >= leg.price
+                                            if fires_below:
+                                                crossed = params.mark_price <= leg.price
+                                            if crossed:
+                                                if kind == 0:
+                                                    triggered.limit_orders.push(
+                                                        order_id
+                                                    )
+                                                if kind == 1:
+                                                    triggered.stop_loss_orders.push(
+                                                        order_id
+                                                    )
+                                                if kind == 2:
+                                                    triggered.take_profit_orders.push(
+                                                        order_id
+                                                    )
+                            bucket += 1
+            return triggered
+
+        # Get Holder Orders View
+        @sp.onchain_view()
+        def getHolderOrders(self, position_holder):
+            sp.cast(position_holder, sp.address)
+            holder_orders = sp.cast({}, sp.map[sp.int, vmm_types.create_order_type])
+            if self.data.holder_orders.contains(position_holder):
+                for order_id in self.data.holder_orders[position_holder].elements():
+                    stored_order = self.data.orders[order_id]
+                    holder_orders[order_id] = unpack_order(
+                        sp.record(
+                            order=stored_order,
+                            vmm_address=self.data.market_addresses[
+                                stored_order.market_id
+                            ],
+                        )
+                    )
+            return holder_orders
+
+        # Get Order View
+        @sp.onchain_view()
+        def getOrder(self, order_id):
+            sp.cast(order_id, sp.int)
+            stored_order = self.data.orders.get(order_id, error="InvalidOrderId")
+            return unpack_order(
+                sp.record(
+                    order=stored_order,
+                    vmm_address=self.data.market_addresses[stored_order.market_id],
+                )
+            )
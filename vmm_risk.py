@@ -0,0 +1,270 @@
+"""Vectorized risk metrics over a whole vmm.VMM positions table.
+
+``PositionColumns`` holds the positions big_map as one NumPy array per
+field, and the functions below evaluate the formulas of ``closePosition``,
+``removeMargin``, ``liquidate`` and ``distributeFunding`` for every row at
+once. Results are bit-for-bit equal to the contract (and to
+``vmm_simulation.VmmEngine``): divisions are Michelson ``EDIV`` quotients and
+funding is rounded towards zero. ``RiskSweep`` evaluates every metric of one
+mark price tick, computing the close values and pending funding only once.
+
+The market scalars (reserves, invariant, funding indexes, decimal) are read
+from a ``VmmEngine``, which can be kept in sync with the chain or used as a
+simulation.
+"""
+
+import functools
+
+import numpy as np
+
+from vmm_simulation import LONG
+
+_INT64_MAX = np.iinfo(np.int64).max
+
+FIELDS = (
+    "position",
+    "entry_price",
+    "funding_amount",
+    "position_value",
+    "collateral_amount",
+    "usd_amount",
+    "funding_index",
+)
+
+
+class PositionColumns:
+    """Columnar, int64 copy of the ``positions`` big_map."""
+
+    def __init__(self, holders, **columns):
+        self.holders = list(holders)
+        for field in FIELDS:
+            setattr(self, field, np.asarray(columns[field], dtype=np.int64))
+
+    @classmethod
+    def from_positions(cls, positions):
+        """Build the columns from a ``{holder: position}`` mapping."""
+        holders = list(positions)
+        rows = [positions[holder] for holder in holders]
+        columns = {
+            field: np.fromiter(
+                (getattr(row, field) for row in rows), dtype=np.int64, count=len(rows)
+            )
+            for field in FIELDS
+        }
+        return cls(holders, **columns)
+
+    def __len__(self):
+        return len(self.holders)
+
+    @functools.cached_property
+    def is_long(self):
+        return self.position == LONG
+
+    @functools.cached_property
+    def direction(self):
+        """+1 for longs and -1 for shorts."""
+        return np.where(self.is_long, 1, -1)
+
+
+def _checked_mul(a, b):
+    """Exact ``a * b`` for int64 arrays, raising instead of wrapping around."""
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    # The product of the largest magnitudes bounds every row
+    bound = float(np.abs(a).max(initial=0)) * float(np.abs(b).max(initial=0))
+    if bound >= 2.0**62:
+        magnitude = np.abs(a.astype(np.float64)) * np.abs(b.astype(np.float64))
+        if magnitude.max(initial=0) >= 2.0**62:
+            raise OverflowError("product does not fit in int64")
+    return np.multiply(a, b, dtype=np.int64)
+
+
+def ediv(numerator, denominator):
+    """Element-wise quotient of the Michelson EDIV instruction."""
+    numerator = np.asarray(numerator, dtype=np.int64)
+    denominator = np.asarray(denominator, dtype=np.int64)
+    if np.any(denominator == 0):
+        raise ZeroDivisionError("EDIV by zero")
+    quotient = numerator // np.abs(denominator)
+    return np.where(denominator > 0, quotient, -quotient)
+
+
+def _scalar_ediv(numerator, denominators):
+    """Exact ``numerator // denominators`` for a non-negative Python int
+    numerator that may exceed int64 and positive int64 denominators.
+
+    The quotient is estimated in float64 and corrected with the remainder,
+    which is small enough to be computed exactly modulo 2**64. Numerators too
+    large for that bound are divided limb by limb instead.
+    """
+    denominators = np.asarray(denominators, dtype=np.int64)
+    if len(denominators) == 0:
+        return denominators.copy()
+    if numerator < 0 or denominators.min() <= 0:
+        raise ValueError("expected a non-negative numerator and positive reserves")
+    if numerator <= _INT64_MAX:
+        return np.int64(numerator) // denominators
+    if numerator // int(denominators.min()) > _INT64_MAX:
+        raise OverflowError("quotient does not fit in int64")
+    if numerator < 2**100 and denominators.max() < 2**61:
+        # The estimate times the denominator is off by less than
+        # numerator * 2**-50 plus one denominator, so the remainder stays
+        # inside int64 and wraps back to its exact value
+        estimate = np.floor(numerator / denominators.astype(np.float64))
+        estimate = np.minimum(estimate, np.nextafter(2.0**63, 0)).astype(np.int64)
+        low = numerator & (2**64 - 1)
+        low = np.array(low - 2**64 if low > _INT64_MAX else low, dtype=np.int64)
+        with np.errstate(over="ignore"):
+            remainder = low - estimate * denominators
+        return estimate + remainder // denominators
+    shift = 62 - int(denominators.max()).bit_length()
+    if shift < 1:
+        raise OverflowError("reserve does not fit the limb division")
+    mask = (1 << shift) - 1
+    limbs = []
+    while numerator:
+        limbs.append(numerator & mask)
+        numerator >>= shift
+    quotient = np.zeros_like(denominators)
+    remainder = np.zeros_like(denominators)
+    for limb in reversed(limbs):
+        current = (remainder << shift) | limb
+        digit, remainder = np.divmod(current, denominators)
+        quotient = (quotient << shift) + digit
+    return quotient
+
+
+def pending_funding(columns, engine):
+    """Funding accrued since each position's index snapshot."""
+    funding_index = np.where(
+        columns.is_long, engine.long_funding_index, engine.short_funding_index
+    )
+    return funding_payments(columns, funding_index - columns.funding_index, engine)
+
+
+def funding_payments(columns, index_delta, engine):
+    """Funding booked to each position for a move of its side's funding index.
+
+    ``index_delta`` is a per-position array, or a ``(long_delta, short_delta)``
+    pair such as ``engine.funding_index_deltas()`` for one funding round.
+    """
+    if isinstance(index_delta, tuple):
+        long_delta, short_delta = index_delta
+        index_delta = np.where(columns.is_long, long_delta, short_delta)
+    index_delta = np.asarray(index_delta, dtype=np.int64)
+    magnitude = np.abs(index_delta)
+    largest = float(magnitude.max(initial=0))
+    if largest == 0:
+        # Every index snapshot is current
+        return np.zeros(len(columns), dtype=np.int64)
+    bound = float(np.abs(columns.position_value).max(initial=0)) * largest
+    if bound < 2.0**62:
+        funding = np.multiply(columns.position_value, magnitude) // engine.decimal
+    else:
+        # pv * |delta| // decimal, split so the intermediate product stays in int64
+        whole, fraction = np.divmod(magnitude, engine.decimal)
+        funding = _checked_mul(columns.position_value, whole) + (
+            _checked_mul(columns.position_value, fraction) // engine.decimal
+        )
+    return np.where(index_delta < 0, -funding, funding)
+
+
+def settled_collateral(columns, engine):
+    """Collateral after settling pending funding, as the contract uses it."""
+    return columns.collateral_amount + pending_funding(columns, engine)
+
+
+def close_values(columns, engine):
+    """USD value each position would be closed at against the current reserves."""
+    quotient = _close_quotients(columns, engine)
+    return columns.direction * (engine.usd_amount - quotient)
+
+
+def _close_quotients(columns, engine):
+    # USD reserve after selling back (long) or buying back (short) the tokens
+    reserves = engine.token_amount + columns.direction * columns.position_value
+    return _scalar_ediv(engine.invariant * engine.decimal, reserves)
+
+
+def unrealized_pnl(columns, engine):
+    """PnL realised by ``closePosition`` at the current reserves."""
+    return _pnl(columns, engine, _close_quotients(columns, engine))
+
+
+def _pnl(columns, engine, quotients):
+    # Long: (usd - q) - usd_amount, short: usd_amount - (q - usd)
+    return (engine.usd_amount - quotients) - columns.direction * columns.usd_amount
+
+
+def final_values(columns, engine):
+    """Settled collateral plus PnL (``final_value`` in ``liquidate``)."""
+    return settled_collateral(columns, engine) + unrealized_pnl(columns, engine)
+
+
+def _ratios(numerator, columns, engine):
+    numerator = np.asarray(numerator, dtype=np.int64)
+    # Open positions all have a positive notional
+    all_positive = columns.usd_amount.min(initial=1) > 0
+    if all_positive:
+        denominator = columns.usd_amount
+    else:
+        # Rows without notional make the contract fail; they evaluate to 0 here
+        has_notional = columns.usd_amount != 0
+        denominator = np.where(has_notional, np.abs(columns.usd_amount), 1)
+    if float(np.abs(numerator).max(initial=0)) * engine.decimal < 2.0**62:
+        ratios = (numerator * engine.decimal) // denominator
+    else:
+        # numerator * decimal // denominator without the int64 product
+        whole, rest = np.divmod(numerator, denominator)
+        ratios = _checked_mul(whole, engine.decimal) + (
+            _checked_mul(rest, engine.decimal) // denominator
+        )
+    if all_positive:
+        return ratios
+    ratios = np.where(columns.usd_amount > 0, ratios, -ratios)
+    return np.where(has_notional, ratios, 0)
+
+
+def _below_threshold(final, ratios, columns, engine):
+    threshold = (85 * engine.decimal) // 1000
+    return (final <= 0) | ((columns.usd_amount != 0) & (ratios < threshold))
+
+
+def margin_ratios(columns, engine):
+    """Margin ratio ``liquidate`` compares against the 85/1000 threshold."""
+    return _ratios(final_values(columns, engine), columns, engine)
+
+
+def remove_margin_ratios(columns, engine, amounts):
+    """Margin ratio ``removeMargin`` checks after withdrawing ``amounts``."""
+    return _ratios(settled_collateral(columns, engine) - amounts, columns, engine)
+
+
+def liquidatable(columns, engine):
+    """Rows ``liquidate`` would accept, i.e. below the 85/1000 margin ratio."""
+    final = final_values(columns, engine)
+    return _below_threshold(final, _ratios(final, columns, engine), columns, engine)
+
+
+class RiskSweep:
+    """Every metric of one mark price tick over ``columns``.
+
+    The close values and the pending funding are evaluated once and shared by
+    all the metrics, where calling ``unrealized_pnl``, ``margin_ratios`` and
+    ``liquidatable`` in turn evaluates them once per call.
+    """
+
+    def __init__(self, columns, engine):
+        self.columns = columns
+        self.engine = engine
+        self.collateral = settled_collateral(columns, engine)
+        self.pnl = _pnl(columns, engine, _close_quotients(columns, engine))
+        self.final_values = self.collateral + self.pnl
+        self.margin_ratios = _ratios(self.final_values, columns, engine)
+        self.liquidatable = _below_threshold(
+            self.final_values, self.margin_ratios, columns, engine
+        )
+
+    def remove_margin_ratios(self, amounts):
+        """Margin ratio ``removeMargin`` checks after withdrawing ``amounts``."""
+        return _ratios(self.collateral - amounts, self.columns, self.engine)
@@ -0,0 +1,129 @@
+import smartpy as sp  # type: ignore
+from USDt import usdt
+from vmm_contract import vmm
+from vmm_orders import orders
+import utilities.Address as Address
+from Oracle import oracle
+
+# USDt minted to each of admin, alice and bob
+INITIAL_BALANCE = 1000000000000
+# Positions imported per migratePositions call
+MIGRATION_CHUNK = 500
+
+
+def originate(sc, positions=(), token_amount=12500000000):
+    """Open the vmm.test.py scenario: originate the contracts, hand the VMM over
+    to admin, set it at 20 and fund admin, alice and bob. alice, the VMM's
+    original administrator, stays its position manager. ``positions`` are
+    migrated before the VMM is set with ``token_amount`` tokens.
+
+    Returns ``(usdt_token, oracle_contract, vmm_contract, vmm_orders)``.
+    """
+    sc.h2("Originate USDt Contract")
+    usdt_token = usdt.USDt(
+        administrator=Address.admin,
+        metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
+    )
+    sc += usdt_token
+
+    sc.h2("Originate Oracle Contract")
+    oracle_contract = oracle.Oracle()
+    sc += oracle_contract
+    oracle_contract.updatePrice(8000000, _now=sp.timestamp(12))
+
+    sc.h2("Originate VMM Contract")
+    vmm_contract = vmm.VMM(
+        metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
+        administrator=Address.alice,
+        usd_contract_address=usdt_token.address,
+        oracle_address=oracle_contract.address,
+        fund_manager=Address.elon,
+    )
+    sc += vmm_contract
+
+    sc.h2("Originate Orders Contract")
+    vmm_orders = orders.VmmOrders(
+        metadata=sp.scenario_utils.metadata_of_url("https://example.com"),
+        administrator=Address.admin,
+        fund_manager=Address.elon,
+    )
+    sc += vmm_orders
+
+    sc.h2("Testing Propose Admin")
+    vmm_contract.proposeAdmin(Address.admin, _sender=Address.alice)
+    vmm_contract.updateAdmin(_sender=Address.bob, _valid=False)
+    vmm_contract.updateAdmin(_sender=Address.admin)
+
+    if positions:
+        sc.h2("Migrate %d Positions" % len(positions))
+        for start in range(0, len(positions), MIGRATION_CHUNK):
+            vmm_contract.migratePositions(
+                vmm_state=None,
+                positions=positions[start : start + MIGRATION_CHUNK],
+                _sender=Address.admin,
+            )
+
+    sc.h2("Testing Set VMM")
+    vmm_contract.setVmm(token_amount, _sender=Address.admin, _now=sp.timestamp(20))
+
+    sc.h2("Testing Set Position Manager")
+    vmm_contract.addPositionManager(vmm_orders.address, _sender=Address.admin)
+
+    usdt_token.mint(
+        sp.record(
+            amount=sp.nat(INITIAL_BALANCE),
+            to_=Address.admin,
+            token=sp.variant("new", {"0": sp.bytes("0x746f6b656e30")}),
+        ),
+        _sender=Address.admin,
+    )
+    usdt_token.mint(
+        sp.record(
+            amount=sp.nat(INITIAL_BALANCE),
+            to_=Address.alice,
+            token=sp.variant("existing", sp.nat(0)),
+        ),
+        _sender=Address.admin,
+    )
+    usdt_token.mint(
+        sp.record(
+            amount=sp.nat(INITIAL_BALANCE),
+            to_=Address.bob,
+            token=sp.variant("existing", sp.nat(0)),
+        ),
+        _sender=Address.admin,
+    )
+
+    usdt_token.update_operators(
+        [
+            sp.variant(
+                "add_operator",
+                sp.record(
+                    owner=Address.alice, operator=vmm_contract.address, token_id=0
+                ),
+            )
+        ],
+        _sender=Address.alice,
+    )
+    usdt_token.update_operators(
+        [
+            sp.variant(
+                "add_operator",
+                sp.record(owner=Address.bob, operator=vmm_contract.address, token_id=0),
+            )
+        ],
+        _sender=Address.bob,
+    )
+    usdt_token.update_operators(
+        [
+            sp.variant(
+                "add_operator",
+                sp.record(
+                    owner=Address.admin, operator=vmm_contract.address, token_id=0
+                ),
+            )
+        ],
+        _sender=Address.admin,
+    )
+
+    return usdt_token, oracle_contract, vmm_contract, vmm_orders
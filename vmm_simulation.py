@@ -0,0 +1,767 @@
+"""Pure-Python replica of the vmm.VMM arithmetic for off-chain simulation.
+
+The engine reproduces the integer arithmetic of the contract entrypoints
+without the SmartPy interpreter, so that millions of trades can be replayed
+for risk sizing. Divisions follow the Michelson ``EDIV`` semantics used by
+the contract, conversions to ``nat`` are ``abs``, and failures raise
+``VmmError`` with the same error string as the contract.
+
+Authorization, the oracle view and the FA2 contract are not simulated: the
+index price is set with ``update_index_price`` and every USD transfer the
+contract would emit (``deposit``, ``withdraw`` and ``sweep_fees``) is booked
+as a net balance change in ``balances``. The contract's internal balances are
+in ``ledger`` and the fees not swept yet in ``accrued_fees``.
+With ``record_events`` on, emitted events are appended to the ``events``
+deque as ``(tag, payload)`` pairs until a consumer drains it; replays leave
+it off so that memory does not grow with the number of trades.
+Funding uses the spot mark and index prices, as the contract does while
+``twap_funding`` is off; the price accumulators are not simulated.
+"""
+
+import copy
+from collections import defaultdict, deque
+
+DECIMAL = 1_000_000
+
+LONG = 1
+SHORT = 2
+
+NOT_INITIALIZED = 0
+ACTIVE = 1
+CLOSE_ONLY = 2
+PAUSED = 3
+
+
+class VmmError(Exception):
+    """Raised where the contract would fail, with the contract's error."""
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+def ediv(numerator, denominator):
+    """Quotient of the Michelson EDIV instruction (remainder is never < 0)."""
+    if denominator > 0:
+        return numerator // denominator
+    return -(numerator // -denominator)
+
+
+class Position:
+    """Mirror of ``vmm_types.positions_value``."""
+
+    __slots__ = (
+        "position",
+        "entry_price",
+        "funding_amount",
+        "position_value",
+        "collateral_amount",
+        "usd_amount",
+        "funding_index",
+    )
+
+    def __init__(
+        self,
+        position,
+        entry_price,
+        funding_amount,
+        position_value,
+        collateral_amount,
+        usd_amount,
+        funding_index,
+    ):
+        self.position = position
+        self.entry_price = entry_price
+        self.funding_amount = funding_amount
+        self.position_value = position_value
+        self.collateral_amount = collateral_amount
+        self.usd_amount = usd_amount
+        self.funding_index = funding_index
+
+    def __repr__(self):
+        fields = ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__)
+        return "Position(%s)" % fields
+
+
+class VmmEngine:
+    """State and entrypoints of one vmm.VMM market.
+
+    ``address`` and ``fund_manager`` are the keys the contract's own balance
+    and the swept fees are booked under in ``balances``.
+    """
+
+    def __init__(
+        self,
+        transaction_fees=2,
+        funding_period=3600,
+        decimal=DECIMAL,
+        address="vmm",
+        fund_manager="fund_manager",
+        record_events=False,
+    ):
+        self.transaction_fees = transaction_fees
+        self.funding_period = funding_period
+        self.decimal = decimal
+        self.address = address
+        self.fund_manager = fund_manager
+        self.status = NOT_INITIALIZED
+
+        self.token_amount = 0
+        self.usd_amount = 0
+        self.invariant = 0
+        self.current_index_price = 0
+        self.current_mark_price = 0
+
+        self.positions = {}
+        self.total_long = 0
+        self.total_short = 0
+
+        self.long_funding_index = 0
+        self.short_funding_index = 0
+        self.long_funding_rate = (0, "NA")
+        self.short_funding_rate = (0, "NA")
+        self.previous_funding_time = 0
+        self.upcoming_funding_time = funding_period
+
+        self.balances = defaultdict(int)
+        self.ledger = defaultdict(int)
+        self.accrued_fees = 0
+        self.record_events = record_events
+        self.events = deque()
+
+    # Helpers
+
+    def _emit(self, tag, **payload):
+        if self.record_events:
+            self.events.append((tag, payload))
+
+    def _transfer(self, sender, receiver, amount):
+        self.balances[sender] -= amount
+        self.balances[receiver] += amount
+
+    def _credit(self, holder, amount):
+        self.ledger[holder] += amount
+
+    def _check_balance(self, holder, amount):
+        if self.ledger[holder] < amount:
+            raise VmmError("INSUFFICIENT_BALANCE")
+
+    def _debit(self, holder, amount):
+        self._check_balance(holder, amount)
+        self.ledger[holder] -= amount
+
+    def _update_mark_price(self):
+        self.current_mark_price = (self.usd_amount * self.decimal) // self.token_amount
+
+    def _check_status(self, status):
+        if self.status != status:
+            raise VmmError("InvalidStatus")
+
+    def _position(self, position_holder):
+        try:
+            return self.positions[position_holder]
+        except KeyError:
+            raise VmmError(None) from None
+
+    def _settle(self, position):
+        if position.position == SHORT:
+            funding_index = self.short_funding_index
+        else:
+            funding_index = self.long_funding_index
+        index_delta = funding_index - position.funding_index
+        if index_delta:
+            funding = (position.position_value * abs(index_delta)) // self.decimal
+            if index_delta < 0:
+                funding = -funding
+            position.funding_amount += funding
+            position.collateral_amount += funding
+        position.funding_index = funding_index
+        return position
+
+    def settled_position(self, position_holder):
+        """Position as returned by the ``getPositionData`` view."""
+        position = self._position(position_holder)
+        copy = Position(*(getattr(position, k) for k in Position.__slots__))
+        return self._settle(copy)
+
+    def quote(self, direction, usd_amount, leverage_multiple):
+        """Result of the ``getQuote`` view, as a dict."""
+        if direction != LONG and direction != SHORT:
+            raise VmmError("INVALID_DIRECTION")
+        net_usd_amount = usd_amount - (usd_amount * self.transaction_fees) // 100
+        notional = leverage_multiple * net_usd_amount
+        k = self.invariant * self.decimal
+        if direction == LONG:
+            position_value = abs(
+                ediv(k, self.usd_amount + notional) - self.token_amount
+            )
+            usd_after = self.usd_amount + notional
+            token_after = self.token_amount - position_value
+        else:
+            position_value = ediv(k, self.usd_amount - notional) - self.token_amount
+            usd_after = self.usd_amount - notional
+            token_after = self.token_amount + position_value
+        execution_price = 0
+        if position_value != 0:
+            execution_price = ediv(notional * self.decimal, position_value)
+        return dict(
+            fee=abs(usd_amount - net_usd_amount),
+            net_usd_amount=net_usd_amount,
+            position_value=position_value,
+            execution_price=execution_price,
+            mark_price_after=ediv(usd_after * self.decimal, token_after),
+        )
+
+    def close_quote(self, position_holder):
+        """Result of the ``getCloseQuote`` view, as a dict."""
+        position = self.settled_position(position_holder)
+        k = self.invariant * self.decimal
+        if position.position == LONG:
+            position_value = self.usd_amount - ediv(
+                k, self.token_amount + position.position_value
+            )
+            pnl = position_value - position.usd_amount
+            usd_after = self.usd_amount - position_value
+            token_after = self.token_amount + position.position_value
+        else:
+            position_value = (
+                ediv(k, self.token_amount - position.position_value) - self.usd_amount
+            )
+            pnl = position.usd_amount - position_value
+            usd_after = self.usd_amount + position_value
+            token_after = self.token_amount - position.position_value
+        return dict(
+            position_value=position_value,
+            pnl=pnl,
+            payout=abs(position.collateral_amount + pnl),
+            mark_price_after=ediv(usd_after * self.decimal, token_after),
+        )
+
+    def update_index_price(self, index_price):
+        """Equivalent of a successful ``Helpers.updateIndexPrice``."""
+        self.current_index_price = index_price
+
+    # Entrypoints
+
+    def deposit(self, holder, amount):
+        if amount <= 0:
+            raise VmmError("INVALID_AMOUNT")
+        self._transfer(holder, self.address, amount)
+        self._credit(holder, amount)
+        self._emit("USD_DEPOSITED", holder=holder, amount=amount)
+
+    def withdraw(self, holder, amount):
+        if amount <= 0:
+            raise VmmError("INVALID_AMOUNT")
+        self._debit(holder, amount)
+        self._transfer(self.address, holder, amount)
+        self._emit("USD_WITHDRAWN", holder=holder, amount=amount)
+
+    def set_vmm(self, token_amount, now=0):
+        if self.token_amount or self.usd_amount or self.invariant:
+            raise VmmError("VMM_ALREADY_SET")
+        if token_amount < 0:
+            raise VmmError("INVALID_TOKEN_AMOUNT")
+        usd_amount = (token_amount * self.current_index_price) // self.decimal
+        self.token_amount = token_amount
+        self.usd_amount = usd_amount
+        self.invariant = (token_amount * usd_amount) // self.decimal
+        self.status = ACTIVE
+        self._update_mark_price()
+        self.previous_funding_time = now
+        self.upcoming_funding_time = now + self.funding_period
+        self._emit(
+            "VMM_CONFIGURED",
+            token_amount=self.token_amount,
+            usd_amount=self.usd_amount,
+            invariant=self.invariant,
+        )
+
+    def calculate_funding_rate(self):
+        """Mirror of ``Helpers.calculateFundingRate``."""
+        decimal = self.decimal
+        mark, index = self.current_mark_price, self.current_index_price
+        price_difference = mark - index
+        funding_rate = price_difference // 24
+        average_value = (mark + index) // 2
+        percentage = ediv(funding_rate * decimal * 100, average_value)
+        if percentage >= 5 * decimal:
+            percentage = 5 * decimal
+        if price_difference > 0:
+            long_value = 0 if self.total_long == 0 else percentage
+            self.long_funding_rate = (long_value, "NEGATIVE")
+            if self.total_short == 0:
+                self.short_funding_rate = (0, "POSITIVE")
+            else:
+                self.short_funding_rate = (
+                    ediv(self.total_long * percentage, self.total_short),
+                    "POSITIVE",
+                )
+        if price_difference < 0:
+            short_value = 0 if self.total_short == 0 else percentage
+            self.short_funding_rate = (short_value, "NEGATIVE")
+            if self.total_long == 0:
+                self.long_funding_rate = (0, "POSITIVE")
+            else:
+                self.long_funding_rate = (
+                    ediv(self.total_short * percentage, self.total_long),
+                    "POSITIVE",
+                )
+
+    def funding_index_deltas(self):
+        """Long and short funding index moves of a round at the current rates."""
+        long_delta = short_delta = 0
+        price_difference = self.current_mark_price - self.current_index_price
+        if price_difference < 0:
+            if self.total_short > 0:
+                short_delta = -self.short_funding_rate[0]
+            if self.total_long > 0:
+                long_delta = self.long_funding_rate[0]
+        if price_difference > 0:
+            if self.total_long > 0:
+                long_delta = -self.long_funding_rate[0]
+            if self.total_short > 0:
+                short_delta = self.short_funding_rate[0]
+        return long_delta, short_delta
+
+    def distribute_funding(self, now):
+        self._check_status(ACTIVE)
+        if self.upcoming_funding_time > now:
+            raise VmmError("FUNDING_NOT_DUE")
+        self._update_mark_price()
+        self.calculate_funding_rate()
+        long_delta, short_delta = self.funding_index_deltas()
+        self.long_funding_index += long_delta
+        self.short_funding_index += short_delta
+        self.previous_funding_time = now
+        self.upcoming_funding_time = now + self.funding_period
+        self._update_mark_price()
+        self._emit(
+            "FUNDING_DISTRIBUTED",
+            funding_time=now,
+            long_funding_index=self.long_funding_index,
+            short_funding_index=self.short_funding_index,
+        )
+
+    def sweep_fees(self):
+        if self.accrued_fees <= 0:
+            raise VmmError("NO_FEES_ACCRUED")
+        self._transfer(self.address, self.fund_manager, self.accrued_fees)
+        self._emit(
+            "FEES_SWEPT", fund_manager=self.fund_manager, amount=self.accrued_fees
+        )
+        self.accrued_fees = 0
+
+    def increase_position(
+        self, position_holder, direction, usd_amount, leverage_multiple
+    ):
+        self._check_status(ACTIVE)
+        if direction != LONG and direction != SHORT:
+            raise VmmError("INVALID_DIRECTION")
+        if usd_amount < 0:
+            raise VmmError("INVALID_USD_AMOUNT")
+        if leverage_multiple < 0:
+            raise VmmError("INVALID_LEVERAGE_AMOUNT")
+        self._check_balance(position_holder, usd_amount)
+        position = self.positions.get(position_holder)
+        if position is not None and position.position != direction:
+            raise VmmError("INVALID_POSITION")
+        self._debit(position_holder, usd_amount)
+
+        net_usd_amount = usd_amount - (usd_amount * self.transaction_fees) // 100
+        notional = leverage_multiple * net_usd_amount
+        if direction == LONG:
+            position_value = abs(
+                ediv(self.invariant * self.decimal, self.usd_amount + notional)
+                - self.token_amount
+            )
+            if position is None:
+                self.positions[position_holder] = Position(
+                    LONG,
+                    self.current_mark_price,
+                    0,
+                    position_value,
+                    net_usd_amount,
+                    notional,
+                    self.long_funding_index,
+                )
+            else:
+                self._settle(position)
+                position.entry_price = (
+                    position.entry_price + self.current_mark_price
+                ) // 2
+                position.position_value += position_value
+                position.collateral_amount += net_usd_amount
+                position.usd_amount += notional
+            self.usd_amount += notional
+            self.token_amount -= position_value
+            self.total_long += position_value
+        else:
+            position_value = (
+                ediv(self.invariant * self.decimal, self.usd_amount - notional)
+                - self.token_amount
+            )
+            if position is None:
+                self.positions[position_holder] = Position(
+                    SHORT,
+                    self.current_mark_price,
+                    0,
+                    position_value,
+                    net_usd_amount,
+                    notional,
+                    self.short_funding_index,
+                )
+            else:
+                self._settle(position)
+                position.entry_price = (
+                    position.entry_price + self.current_mark_price
+                ) // 2
+                position.position_value += position_value
+                position.collateral_amount += net_usd_amount
+                position.usd_amount += notional
+            self.usd_amount -= notional
+            self.token_amount += position_value
+            self.total_short += position_value
+
+        self.accrued_fees += abs(usd_amount - net_usd_amount)
+        self._update_mark_price()
+        side = "LONG" if direction == LONG else "SHORT"
+        change = "OPENED" if position is None else "INCREASED"
+        position = self.positions[position_holder]
+        self._emit(
+            "%s_POSITION_%s" % (side, change),
+            position_value=position.position_value,
+            collateral_amount=position.collateral_amount,
+            usd_amount=position.usd_amount,
+            position_holder=position_holder,
+        )
+
+    def increase_positions(self, fills, match_at_mark=False):
+        """``fills`` are ``(position_holder, direction, usd_amount,
+        leverage_multiple)`` tuples, all booked at one clearing price, or with
+        ``match_at_mark`` the matched notional at the mark price."""
+        self._check_status(ACTIVE)
+        # The contract fails the whole batch, so validate before booking
+        debits = defaultdict(int)
+        for position_holder, direction, usd_amount, leverage_multiple in fills:
+            if direction != LONG and direction != SHORT:
+                raise VmmError("INVALID_DIRECTION")
+            if usd_amount < 0:
+                raise VmmError("INVALID_USD_AMOUNT")
+            if leverage_multiple < 0:
+                raise VmmError("INVALID_LEVERAGE_AMOUNT")
+            debits[position_holder] += usd_amount
+            self._check_balance(position_holder, debits[position_holder])
+        directions = {}
+        for position_holder, direction, _, _ in fills:
+            position = self.positions.get(position_holder)
+            held = directions.get(
+                position_holder, direction if position is None else position.position
+            )
+            if held != direction:
+                raise VmmError("INVALID_POSITION")
+            directions[position_holder] = direction
+
+        long_notional = short_notional = fees = 0
+        for position_holder, direction, usd_amount, leverage_multiple in fills:
+            self._debit(position_holder, usd_amount)
+            net_usd_amount = usd_amount - (usd_amount * self.transaction_fees) // 100
+            fees += usd_amount - net_usd_amount
+            if direction == LONG:
+                long_notional += leverage_multiple * net_usd_amount
+            else:
+                short_notional += leverage_multiple * net_usd_amount
+
+        net_notional = long_notional - short_notional
+        mark_price = self.current_mark_price
+        clearing_price = mark_price
+        if net_notional != 0:
+            token_amount = ediv(
+                self.invariant * self.decimal, self.usd_amount + net_notional
+            )
+            if token_amount != self.token_amount:
+                clearing_price = (abs(net_notional) * self.decimal) // abs(
+                    token_amount - self.token_amount
+                )
+            self.usd_amount += net_notional
+            self.token_amount = token_amount
+        prices = {LONG: clearing_price, SHORT: clearing_price}
+        if match_at_mark and net_notional != 0:
+            if net_notional > 0:
+                matched_notional, residual_side = short_notional, LONG
+            else:
+                matched_notional, residual_side = long_notional, SHORT
+            if matched_notional > 0:
+                tokens = ediv(matched_notional * self.decimal, mark_price) + ediv(
+                    abs(net_notional) * self.decimal, clearing_price
+                )
+                if tokens > 0:
+                    prices = {LONG: mark_price, SHORT: mark_price}
+                    prices[residual_side] = ediv(
+                        (matched_notional + abs(net_notional)) * self.decimal, tokens
+                    )
+
+        filled = []
+        for position_holder, direction, usd_amount, leverage_multiple in fills:
+            net_usd_amount = usd_amount - (usd_amount * self.transaction_fees) // 100
+            notional = leverage_multiple * net_usd_amount
+            position_value = ediv(notional * self.decimal, prices[direction])
+            position = self.positions.get(position_holder)
+            if position is None:
+                if direction == LONG:
+                    funding_index = self.long_funding_index
+                else:
+                    funding_index = self.short_funding_index
+                self.positions[position_holder] = Position(
+                    direction,
+                    prices[direction],
+                    0,
+                    position_value,
+                    net_usd_amount,
+                    notional,
+                    funding_index,
+                )
+            else:
+                self._settle(position)
+                position.entry_price = (position.entry_price + prices[direction]) // 2
+                position.position_value += position_value
+                position.collateral_amount += net_usd_amount
+                position.usd_amount += notional
+            if direction == LONG:
+                self.total_long += position_value
+            else:
+                self.total_short += position_value
+            filled.append(
+                dict(
+                    position_holder=position_holder,
+                    direction=direction,
+                    position_value=position_value,
+                )
+            )
+
+        self.accrued_fees += abs(fees)
+        self._update_mark_price()
+        self._emit(
+            "POSITIONS_INCREASED",
+            long_price=prices[LONG],
+            short_price=prices[SHORT],
+            long_notional=long_notional,
+            short_notional=short_notional,
+            fills=filled,
+        )
+        return prices[LONG], prices[SHORT]
+
+    def decrease_position(self, position_holder, usd_amount, leverage_multiple):
+        self._check_status(ACTIVE)
+        position = self.positions.get(position_holder)
+        if position is None:
+            raise VmmError("POSITION_NOT_FOUND")
+        if leverage_multiple <= 0:
+            raise VmmError("LEVERAGE_MULTIPLE_INVALID")
+        if usd_amount <= 0:
+            raise VmmError("POSITION_AMOUNT_INVALID")
+        self._settle(position)
+
+        notional = leverage_multiple * usd_amount
+        position_value = abs(
+            ediv(self.invariant * self.decimal, self.usd_amount + notional)
+            - self.token_amount
+        )
+        if position.position_value < position_value:
+            raise VmmError("DECREASE_MORE_THAN_ACTUAL_POSITION")
+        position.position_value -= position_value
+        position.usd_amount -= notional
+        if position.position == LONG:
+            self.total_long -= position_value
+            self.token_amount += position_value
+            self.usd_amount -= notional
+        else:
+            self.total_short -= position_value
+            self.token_amount -= position_value
+            self.usd_amount += notional
+        self._update_mark_price()
+        self._credit(position_holder, position_value)
+        self._emit(
+            "%s_POSITION_DECREASED"
+            % ("LONG" if position.position == LONG else "SHORT"),
+            position_value=position.position_value,
+            collateral_amount=position.collateral_amount,
+            usd_amount=position.usd_amount,
+            position_holder=position_holder,
+        )
+
+    def close_position(self, position_holder):
+        if self.status != ACTIVE and self.status != CLOSE_ONLY:
+            raise VmmError("InvalidStatus")
+        position = self.positions.get(position_holder)
+        if position is None:
+            raise VmmError("InvalidPosition")
+        self._settle(position)
+
+        if position.position == LONG:
+            position_value = self.usd_amount - ediv(
+                self.invariant * self.decimal,
+                self.token_amount + position.position_value,
+            )
+            pnl = position_value - position.usd_amount
+            self._credit(position_holder, abs(position.collateral_amount + pnl))
+            self.usd_amount -= position_value
+            self.token_amount += position.position_value
+            self.total_long -= position.position_value
+        else:
+            position_value = (
+                ediv(
+                    self.invariant * self.decimal,
+                    self.token_amount - position.position_value,
+                )
+                - self.usd_amount
+            )
+            pnl = position.usd_amount - position_value
+            self._credit(position_holder, abs(position.collateral_amount + pnl))
+            self.usd_amount += position_value
+            self.token_amount -= position.position_value
+            self.total_short -= position.position_value
+        del self.positions[position_holder]
+        self._update_mark_price()
+        self._emit(
+            "%s_POSITION_CLOSED" % ("LONG" if position.position == LONG else "SHORT"),
+            pnl=pnl,
+            position_holder=position_holder,
+        )
+        return pnl
+
+    def add_margin(self, position_holder, amount):
+        self._check_status(ACTIVE)
+        position = self._position(position_holder)
+        self._debit(position_holder, abs(amount))
+        self._settle(position)
+        net_amount = amount - (amount * self.transaction_fees) // 100
+        position.collateral_amount += net_amount
+        self._update_mark_price()
+        self.accrued_fees += abs(amount - net_amount)
+        self._emit("MARGIN_ADDED", amount=net_amount, position_holder=position_holder)
+
+    def remove_margin(self, position_holder, amount):
+        self._check_status(ACTIVE)
+        position = self._settle(self._position(position_holder))
+        margin_ratio = ediv(
+            (position.collateral_amount - amount) * self.decimal, position.usd_amount
+        )
+        if margin_ratio <= (30 * self.decimal) // 100:
+            raise VmmError("INVALID_MARGIN")
+        self._credit(position_holder, abs(amount))
+        position.collateral_amount -= amount
+        self._update_mark_price()
+        self._emit("MARGIN_REMOVED", amount=amount, position_holder=position_holder)
+
+    def multicall(self, actions):
+        """``actions`` are ``(entrypoint, arguments)`` pairs named after the
+        contract entrypoints; a failing action reverts all of them."""
+        handlers = {
+            "increasePosition": self.increase_position,
+            "decreasePosition": self.decrease_position,
+            "closePosition": self.close_position,
+            "addMargin": self.add_margin,
+            "removeMargin": self.remove_margin,
+        }
+        snapshot = copy.deepcopy(self.__dict__)
+        try:
+            for action, args in actions:
+                handlers[action](*args)
+        except VmmError:
+            self.__dict__ = snapshot
+            raise
+
+    def _liquidate_position(self, position_holder, liquidator):
+        """Mirror of ``_liquidatePosition``: ``(receiver, reward, fee)`` or None."""
+        if position_holder not in self.positions:
+            return None
+        position = self.settled_position(position_holder)
+
+        if position.position == LONG:
+            position_value = self.usd_amount - ediv(
+                self.invariant * self.decimal,
+                self.token_amount + position.position_value,
+            )
+            final_value = position.collateral_amount + (
+                position_value - position.usd_amount
+            )
+            receiver = liquidator
+        else:
+            position_value = (
+                ediv(
+                    self.invariant * self.decimal,
+                    self.token_amount - position.position_value,
+                )
+                - self.usd_amount
+            )
+            final_value = position.collateral_amount + (
+                position.usd_amount - position_value
+            )
+            # The contract pays the short side's remainder to the position holder
+            receiver = position_holder
+        if final_value > 0:
+            margin_ratio = ediv(final_value * self.decimal, position.usd_amount)
+            if margin_ratio >= (85 * self.decimal) // 1000:
+                return None
+
+        if position.position == LONG:
+            self.usd_amount -= position_value
+            self.token_amount += position.position_value
+            self.total_long -= position.position_value
+        else:
+            self.usd_amount += position_value
+            self.token_amount -= position.position_value
+            self.total_short -= position.position_value
+        del self.positions[position_holder]
+        fee = (abs(final_value) * 3) // 100
+        self._emit("POSITION_LIQUIDATED", position_holder=position_holder)
+        return receiver, abs(abs(final_value) - fee), fee
+
+    def liquidate(self, position_holder, liquidator):
+        self._check_status(ACTIVE)
+        if position_holder not in self.positions:
+            raise VmmError("POSITION_NOT_FOUND")
+        outcome = self._liquidate_position(position_holder, liquidator)
+        if outcome is None:
+            raise VmmError("MARIGN_RATIO_GREATER")
+        receiver, reward, fee = outcome
+        self._update_mark_price()
+        self._credit(receiver, reward)
+        self.accrued_fees += fee
+
+    def liquidate_batch(self, position_holders, liquidator):
+        """Returns the holders that were liquidated, in order."""
+        self._check_status(ACTIVE)
+        liquidated = []
+        rewards = fees = 0
+        for position_holder in position_holders:
+            outcome = self._liquidate_position(position_holder, liquidator)
+            if outcome is None:
+                continue
+            receiver, reward, fee = outcome
+            if receiver == liquidator:
+                rewards += reward
+            else:
+                self._credit(receiver, reward)
+            fees += fee
+            liquidated.append(position_holder)
+        if liquidated:
+            self._update_mark_price()
+            self._credit(liquidator, rewards)
+            self.accrued_fees += fees
+        self._emit(
+            "POSITIONS_LIQUIDATED",
+            liquidator=liquidator,
+            liquidated=len(liquidated),
+            rewards=rewards,
+            fees=fees,
+        )
+        return liquidated
+
+    def take_profit(self, position_holder):
+        self._check_status(ACTIVE)
+        settled = self.settled_position(position_holder)
+        self._debit(position_holder, abs(settled.funding_amount))
+        self.positions[position_holder] = settled
+        settled.funding_amount = 0
@@ -0,0 +1,409 @@
+import copy
+import random
+import time
+
+import smartpy as sp  # type: ignore
+from USDt import usdt
+from vmm_contract import vmm
+from vmm_orders import orders
+import utilities.Address as Address
+from utilities.FA2 import fa2
+from utilities.Helpers import helpers
+from Oracle import oracle
+from vmm_contract_types import vmm_types
+from vmm_keeper import liquidation_mark_price
+from vmm_scenario import INITIAL_BALANCE, originate
+from vmm_simulation import LONG, SHORT, VmmEngine, VmmError, ediv
+
+# Trades per second a random open/close replay must sustain
+MIN_THROUGHPUT = 100000
+
+
+def engine_health(engine, name):
+    """What getPositionHealth should return, from the engine and the keeper."""
+    position = engine.settled_position(name)
+    pnl = copy.deepcopy(engine).close_position(name)
+    try:
+        copy.deepcopy(engine).liquidate(name, "alice")
+        liquidatable = True
+    except VmmError:
+        liquidatable = False
+    return sp.record(
+        pnl=pnl,
+        margin_ratio=ediv(
+            (position.collateral_amount + pnl) * engine.decimal, position.usd_amount
+        ),
+        liquidation_price=liquidation_mark_price(
+            position, engine.invariant, engine.decimal
+        ),
+        liquidatable=liquidatable,
+    )
+
+
+def position_action(holders, action, args):
+    """The position_action_type variant for an engine ``multicall`` action."""
+    holder = holders[args[0]]
+    if action == "increasePosition":
+        return sp.variant(
+            action,
+            sp.record(
+                position_holder=holder,
+                direction=args[1],
+                usd_amount=args[2],
+                leverage_multiple=args[3],
+            ),
+        )
+    if action == "decreasePosition":
+        return sp.variant(
+            action,
+            sp.record(
+                position_holder=holder, usd_amount=args[1], leverage_multiple=args[2]
+            ),
+        )
+    if action == "closePosition":
+        return sp.variant(action, holder)
+    return sp.variant(action, sp.record(position_holder=holder, amount=args[1]))
+
+
+def check_throughput(trades=200000, runs=3):
+    """Replay random opens and closes and check the best run's trade rate."""
+    best = 0
+    for seed in range(runs):
+        rng = random.Random(seed)
+        engine = VmmEngine()
+        engine.update_index_price(8000000)
+        engine.set_vmm(12500000000000)
+        holders = ["holder%d" % i for i in range(1000)]
+        for holder in holders:
+            engine.deposit(holder, INITIAL_BALANCE)
+        trades_plan = [
+            (
+                rng.choice(holders),
+                rng.choice((LONG, SHORT)),
+                rng.randrange(1000000, 100000000),
+                rng.randrange(1, 11),
+            )
+            for _ in range(trades)
+        ]
+        start = time.perf_counter()
+        for holder, direction, usd_amount, leverage_multiple in trades_plan:
+            try:
+                if holder in engine.positions:
+                    engine.close_position(holder)
+                else:
+                    engine.increase_position(
+                        holder, direction, usd_amount, leverage_multiple
+                    )
+            except VmmError:
+                pass
+        best = max(best, trades / (time.perf_counter() - start))
+    assert best >= MIN_THROUGHPUT, "%d trades/s" % best
+    return best
+
+
+def verify_state(sc, vmm_contract, usdt_token, engine, holders):
+    market = vmm_contract.getMarketState()
+    sc.verify(market.vmm.token_amount == engine.token_amount)
+    sc.verify(market.vmm.usd_amount == engine.usd_amount)
+    sc.verify(market.index_price == engine.current_index_price)
+    sc.verify(market.mark_price == engine.current_mark_price)
+    sc.verify(market.long_funding_rate.value == engine.long_funding_rate[0])
+    sc.verify(market.short_funding_rate.value == engine.short_funding_rate[0])
+    sc.verify(market.total_long == engine.total_long)
+    sc.verify(market.total_short == engine.total_short)
+    sc.verify(market.status == engine.status)
+    sc.verify(market.accrued_fees == engine.accrued_fees)
+    sc.verify(vmm_contract.data.vmm.token_amount == engine.token_amount)
+    sc.verify(vmm_contract.data.vmm.usd_amount == engine.usd_amount)
+    sc.verify(vmm_contract.data.vmm.invariant == engine.invariant)
+    sc.verify(vmm_contract.data.current_mark_price == engine.current_mark_price)
+    sc.verify(vmm_contract.data.total_long == engine.total_long)
+    sc.verify(vmm_contract.data.total_short == engine.total_short)
+    sc.verify(vmm_contract.data.long_funding_index == engine.long_funding_index)
+    sc.verify(vmm_contract.data.short_funding_index == engine.short_funding_index)
+    health = vmm_contract.getPositionHealth(list(holders.values()))
+    positions = vmm_contract.getPositionsData(list(holders.values()))
+    for name, address in holders.items():
+        if name in engine.positions:
+            sc.verify_equal(health[address], engine_health(engine, name))
+            position = engine.settled_position(name)
+            expected = sp.record(
+                position=position.position,
+                entry_price=position.entry_price,
+                funding_amount=position.funding_amount,
+                position_value=position.position_value,
+                collateral_amount=position.collateral_amount,
+                usd_amount=position.usd_amount,
+                funding_index=position.funding_index,
+            )
+            sc.verify_equal(vmm_contract.getPositionData(address), expected)
+            sc.verify_equal(positions[address].unwrap_some(), expected)
+        else:
+            sc.verify(vmm_contract.data.positions.contains(address) == False)
+            sc.verify(positions[address].is_none())
+        sc.verify(
+            usdt_token.data.ledger[(address, 0)]
+            == INITIAL_BALANCE + engine.balances[name]
+        )
+        sc.verify(vmm_contract.getBalance(address) == engine.ledger[name])
+    sc.verify(vmm_contract.data.accrued_fees == engine.accrued_fees)
+    if engine.fund_manager in engine.balances:
+        sc.verify(
+            usdt_token.data.ledger[(Address.elon, 0)]
+            == engine.balances[engine.fund_manager]
+        )
+    sc.verify(
+        usdt_token.data.ledger[(vmm_contract.address, 0)]
+        == INITIAL_BALANCE + engine.balances[engine.address]
+    )
+
+
+if __name__ == "__main__":
+    print("engine replays %d trades/s" % check_throughput())
+
+    @sp.add_test()
+    def test():
+        sc = sp.test_scenario(
+            "vmm_simulation_test",
+            [vmm_types, sp.utils, oracle, fa2, usdt, helpers, vmm, orders],
+        )
+        sc.h1("VMM Simulation Engine")
+
+        usdt_token, oracle_contract, vmm_contract, vmm_orders = originate(sc)
+
+        holders = {
+            "admin": Address.admin,
+            "alice": Address.alice,
+            "bob": Address.bob,
+        }
+        engine = VmmEngine(fund_manager="elon")
+        engine.update_index_price(8000000)
+        engine.set_vmm(12500000000, now=20)
+
+        # Reserve the VMM pays profits out of
+        usdt_token.mint(
+            sp.record(
+                amount=sp.nat(INITIAL_BALANCE),
+                to_=vmm_contract.address,
+                token=sp.variant("existing", sp.nat(0)),
+            ),
+            _sender=Address.admin,
+        )
+
+        sc.h2("Initial State")
+        verify_state(sc, vmm_contract, usdt_token, engine, holders)
+
+        # (entrypoint, arguments) replayed on both the contract and the engine
+        steps = [
+            ("deposit", ("alice", 3000000000)),
+            ("deposit", ("bob", 4000000000)),
+            ("deposit", ("admin", 2000000000)),
+            ("increasePosition", ("alice", 1, 2000000000, 2)),
+            ("increasePosition", ("bob", 2, 1500000000, 3)),
+            ("increasePosition", ("alice", 1, 500000000, 2)),
+            ("increasePosition", ("bob", 1, 500000000, 2)),
+            ("increasePosition", ("admin", 1, 1000000000, 10)),
+            ("increasePosition", ("bob", 2, 1000000000, 3)),
+            ("liquidate", ("alice",)),
+            ("liquidate", ("admin",)),
+            ("increasePosition", ("admin", 1, 900000000, 15)),
+            ("liquidateBatch", (("alice", "admin", "bob", "admin"),)),
+            ("updatePrice", (8100000, 3618)),
+            ("distributeFunding", (3620,)),
+            ("addMargin", ("bob", 100000000)),
+            ("decreasePosition", ("alice", 300000000, 2)),
+            ("removeMargin", ("bob", 10000000)),
+            ("removeMargin", ("bob", 100000000000)),
+            ("decreasePosition", ("bob", 100000000, 3)),
+            ("closePosition", ("alice",)),
+            ("closePosition", ("bob",)),
+            ("closePosition", ("bob",)),
+            ("increasePosition", ("admin", 2, 1000000000, 2)),
+            (
+                "increasePositions",
+                (
+                    (
+                        ("alice", 1, 400000000, 2),
+                        ("bob", 2, 300000000, 3),
+                        ("alice", 1, 100000000, 2),
+                    ),
+                    False,
+                ),
+            ),
+            (
+                "increasePositions",
+                ((("alice", 1, 300000000, 2), ("admin", 2, 200000000, 3)), False),
+            ),
+            (
+                "increasePositions",
+                ((("bob", 2, 100000000, 2), ("admin", 1, 1, 2)), False),
+            ),
+            (
+                "increasePositions",
+                ((("alice", 1, 200000000, 2), ("bob", 2, 100000000, 3)), True),
+            ),
+            (
+                "increasePositions",
+                ((("alice", 1, 100000000, 2), ("bob", 2, 300000000, 3)), True),
+            ),
+            (
+                "increasePositions",
+                ((("alice", 1, 100000000, 3), ("bob", 2, 150000000, 2)), True),
+            ),
+            (
+                "multicall",
+                (
+                    (
+                        ("addMargin", ("admin", 100000000)),
+                        ("increasePosition", ("admin", 2, 200000000, 2)),
+                        ("decreasePosition", ("admin", 100000000, 2)),
+                    ),
+                ),
+            ),
+            (
+                "multicall",
+                (
+                    (
+                        ("increasePosition", ("alice", 1, 100000000, 2)),
+                        ("removeMargin", ("alice", 100000000000)),
+                    ),
+                ),
+            ),
+            (
+                "multicall",
+                ((("closePosition", ("bob",)), ("closePosition", ("bob",))),),
+            ),
+            ("withdraw", ("alice", 1000000000)),
+            ("withdraw", ("bob", 100000000000)),
+            ("sweepFees", ()),
+            ("sweepFees", ()),
+        ]
+        now = 20
+        for action, args in steps:
+            sc.h2("Differential %s%r" % (action, args))
+            if action == "updatePrice":
+                price, now = args
+                oracle_contract.updatePrice(price, _now=sp.timestamp(now))
+                engine.update_index_price(price)
+                continue
+            quote = None
+            if action == "increasePosition":
+                holder, direction, usd_amount, leverage_multiple = args
+                quote = engine.quote(direction, usd_amount, leverage_multiple)
+                sc.verify_equal(
+                    vmm_contract.getQuote(
+                        sp.record(
+                            direction=direction,
+                            usd_amount=usd_amount,
+                            leverage_multiple=leverage_multiple,
+                        )
+                    ),
+                    sp.record(**quote),
+                )
+            if action == "closePosition" and args[0] in engine.positions:
+                quote = engine.close_quote(args[0])
+                sc.verify_equal(
+                    vmm_contract.getCloseQuote(holders[args[0]]), sp.record(**quote)
+                )
+            error = None
+            valid = True
+            try:
+                if action == "deposit":
+                    engine.deposit(*args)
+                if action == "withdraw":
+                    engine.withdraw(*args)
+                if action == "sweepFees":
+                    engine.sweep_fees()
+                if action == "increasePosition":
+                    engine.increase_position(*args)
+                if action == "increasePositions":
+                    engine.increase_positions(*args)
+                if action == "multicall":
+                    engine.multicall(args[0])
+                if action == "decreasePosition":
+                    engine.decrease_position(*args)
+                if action == "closePosition":
+                    engine.close_position(*args)
+                if action == "addMargin":
+                    engine.add_margin(*args)
+                if action == "removeMargin":
+                    engine.remove_margin(*args)
+                if action == "liquidate":
+                    engine.liquidate(args[0], "alice")
+                if action == "liquidateBatch":
+                    engine.liquidate_batch(args[0], "alice")
+                if action == "distributeFunding":
+                    now = args[0]
+                    engine.distribute_funding(now)
+            except VmmError as e:
+                valid = False
+                error = e.error
+            if valid and quote is not None:
+                # The quote predicted the trade that followed it
+                assert engine.current_mark_price == quote["mark_price_after"]
+            kwargs = dict(_sender=Address.alice, _now=sp.timestamp(now), _valid=valid)
+            if error is not None:
+                kwargs["_exception"] = error
+            if action == "deposit":
+                kwargs["_sender"] = holders[args[0]]
+                vmm_contract.deposit(args[1], **kwargs)
+            if action == "withdraw":
+                kwargs["_sender"] = holders[args[0]]
+                vmm_contract.withdraw(args[1], **kwargs)
+            if action == "sweepFees":
+                kwargs["_sender"] = Address.elon
+                vmm_contract.sweepFees(**kwargs)
+            if action == "increasePosition":
+                holder, direction, usd_amount, leverage_multiple = args
+                vmm_contract.increasePosition(
+                    position_holder=holders[holder],
+                    direction=direction,
+                    usd_amount=usd_amount,
+                    leverage_multiple=leverage_multiple,
+                    **kwargs
+                )
+            if action == "increasePositions":
+                vmm_contract.increasePositions(
+                    fills=[
+                        sp.record(
+                            position_holder=holders[holder],
+                            direction=direction,
+                            usd_amount=usd_amount,
+                            leverage_multiple=leverage_multiple,
+                        )
+                        for holder, direction, usd_amount, leverage_multiple in args[0]
+                    ],
+                    match_at_mark=args[1],
+                    **kwargs
+                )
+            if action == "multicall":
+                vmm_contract.multicall(
+                    [position_action(holders, *action) for action in args[0]], **kwargs
+                )
+            if action == "decreasePosition":
+                holder, usd_amount, leverage_multiple = args
+                vmm_contract.decreasePosition(
+                    position_holder=holders[holder],
+                    usd_amount=usd_amount,
+                    leverage_multiple=leverage_multiple,
+                    **kwargs
+                )
+            if action == "closePosition":
+                vmm_contract.closePosition(holders[args[0]], **kwargs)
+            if action == "addMargin":
+                vmm_contract.addMargin(
+                    position_holder=holders[args[0]], amount=args[1], **kwargs
+                )
+            if action == "removeMargin":
+                vmm_contract.removeMargin(
+                    position_holder=holders[args[0]], amount=args[1], **kwargs
+                )
+            if action == "liquidate":
+                vmm_contract.liquidate(holders[args[0]], **kwargs)
+            if action == "liquidateBatch":
+                vmm_contract.liquidateBatch(
+                    [holders[holder] for holder in args[0]], **kwargs
+                )
+            if action == "distributeFunding":
+                vmm_contract.distributeFunding(**kwargs)
+            verify_state(sc, vmm_contract, usdt_token, engine, holders)